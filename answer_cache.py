@@ -0,0 +1,264 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+from concurrency import run_blocking
+from prefork import after_fork
+from telemetry import record_cache
+
+VERSION_FILE = ".ingest_version"
+
+
+# --- Collection versions ---
+# Ingest scripts stamp the persist directory after writing; caches compare the
+# stamp on every lookup and drop everything when it changes.
+
+def collection_version(persist_dir):
+    try:
+        with open(os.path.join(persist_dir, VERSION_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip() or "0"
+    except FileNotFoundError:
+        return "0"
+
+def stamp_collection(persist_dir):
+    version = f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+    os.makedirs(persist_dir, exist_ok=True)
+    tmp = os.path.join(persist_dir, VERSION_FILE + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(tmp, os.path.join(persist_dir, VERSION_FILE))
+    return version
+
+
+_SPACES = re.compile(r"\s+")
+_KEY_TOKENS = re.compile(r"\b\w*\d\w*(?:\.\d+)?\b")
+
+def normalize_query(query):
+    return _SPACES.sub(" ", query.strip().lower()).rstrip("?!. ")
+
+def _key_tokens(text):
+    # IDs and numbers (T1056.001, M1043, A03) must match exactly; two queries
+    # that differ only by technique ID embed almost identically.
+    return frozenset(_KEY_TOKENS.findall(text))
+
+
+class AnswerCache:
+    def __init__(self, name, persist_dir, embeddings=None, max_entries=1024, ttl=86400,
+                 threshold=0.95, db_path=None):
+        self.name = name
+        self.persist_dir = persist_dir
+        # Zero-arg callable returning a LangChain Embeddings object, or None to
+        # disable the semantic tier. Called lazily so the model loads on first use.
+        self._embeddings = embeddings
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+
+        self._entries = OrderedDict()   # key -> (answer, created, vector)
+        self._matrix = None
+        self._matrix_keys = []
+        self._lock = threading.Lock()
+        self._version = collection_version(persist_dir)
+
+        self.hits = {"exact": 0, "semantic": 0}
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        self._db = None
+        self._db_path = db_path
+        if db_path:
+            self._open_db(db_path)
+            # SQLite connections must not be shared across fork; entries
+            # already loaded stay in the inherited memory.
+            after_fork(self._reconnect_db)
+
+    @classmethod
+    def from_env(cls, name, persist_dir, embeddings=None):
+        semantic = os.getenv("ANSWER_CACHE_SEMANTIC", "true").lower() == "true"
+        return cls(
+            name,
+            persist_dir,
+            embeddings=embeddings if semantic else None,
+            max_entries=int(os.getenv("ANSWER_CACHE_SIZE", "1024")),
+            ttl=float(os.getenv("ANSWER_CACHE_TTL", "86400")),
+            threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95")),
+            db_path=os.getenv("ANSWER_CACHE_DB") or None,
+        )
+
+    # --- Persistence ---
+
+    def _open_db(self, db_path):
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            " cache TEXT, key TEXT, answer TEXT, vector BLOB, created REAL, version TEXT,"
+            " PRIMARY KEY (cache, key))"
+        )
+        self._db.execute("DELETE FROM answers WHERE cache = ? AND version != ?", (self.name, self._version))
+        self._db.commit()
+
+        rows = self._db.execute(
+            "SELECT key, answer, vector, created FROM answers WHERE cache = ? AND created > ?"
+            " ORDER BY created DESC LIMIT ?",
+            (self.name, time.time() - self.ttl, self.max_entries),
+        ).fetchall()
+        for key, answer, vector, created in reversed(rows):
+            vec = np.frombuffer(vector, dtype=np.float32) if vector else None
+            self._entries[key] = (answer, created, vec)
+
+    def _reconnect_db(self):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self._db_path, check_same_thread=False)
+
+    def _db_write(self, sql, args):
+        if self._db is not None:
+            self._db.execute(sql, args)
+            self._db.commit()
+
+    # --- Internals (call with self._lock held) ---
+
+    def _check_version(self):
+        version = collection_version(self.persist_dir)
+        if version != self._version:
+            self._entries.clear()
+            self._matrix = None
+            self._version = version
+            self.invalidations += 1
+            self._db_write("DELETE FROM answers WHERE cache = ?", (self.name,))
+
+    def _drop(self, key):
+        self._entries.pop(key, None)
+        self._matrix = None
+        self._db_write("DELETE FROM answers WHERE cache = ? AND key = ?", (self.name, key))
+
+    def _semantic_match(self, key, vector):
+        if self._matrix is None:
+            self._matrix_keys = [k for k, e in self._entries.items() if e[2] is not None]
+            if not self._matrix_keys:
+                return None
+            self._matrix = np.stack([self._entries[k][2] for k in self._matrix_keys])
+        if not self._matrix_keys:
+            return None
+
+        scores = self._matrix @ vector
+        wanted = _key_tokens(key)
+        for i in np.argsort(-scores)[:5]:
+            if scores[i] < self.threshold:
+                break
+            candidate = self._matrix_keys[i]
+            if candidate in self._entries and _key_tokens(candidate) == wanted:
+                return candidate
+        return None
+
+    def _normalize(self, vector):
+        vec = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def _embed(self, key):
+        return self._normalize(self._embeddings().embed_query(key))
+
+    # --- Public API ---
+
+    def lookup(self, query, vector=None):
+        # Returns (answer or None, vector, version) so a miss can reuse the
+        # embedding on store(), and store() can tell whether the collection
+        # was re-ingested while the answer was being computed.
+        # Batch callers may pass a pre-computed query embedding.
+        key = normalize_query(query)
+        now = time.time()
+        with self._lock:
+            self._check_version()
+            version = self._version
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[1] <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits["exact"] += 1
+                    record_cache(self.name, True)
+                    return entry[0], entry[2], version
+                self._drop(key)
+
+        if self._embeddings is None:
+            with self._lock:
+                self.misses += 1
+            record_cache(self.name, False)
+            return None, None, version
+
+        vector = self._embed(key) if vector is None else self._normalize(vector)
+        with self._lock:
+            match = self._semantic_match(key, vector)
+            if match is not None and now - self._entries[match][1] <= self.ttl:
+                self._entries.move_to_end(match)
+                self.hits["semantic"] += 1
+                record_cache(self.name, True)
+                return self._entries[match][0], vector, version
+            self.misses += 1
+        record_cache(self.name, False)
+        return None, vector, version
+
+    def store(self, query, answer, vector=None, version=None):
+        # version: what lookup() returned. An answer computed from the
+        # collection before a re-ingest is dropped rather than cached
+        # under the new version.
+        key = normalize_query(query)
+        created = time.time()
+        with self._lock:
+            self._check_version()
+            if version is not None and version != self._version:
+                return
+            self._entries[key] = (answer, created, vector)
+            self._entries.move_to_end(key)
+            self._matrix = None
+            blob = vector.tobytes() if vector is not None else None
+            self._db_write(
+                "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?)",
+                (self.name, key, answer, blob, created, self._version),
+            )
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def get_or_compute(self, query, compute, vector=None):
+        answer, vector, version = self.lookup(query, vector)
+        if answer is not None:
+            return answer
+        answer = compute()
+        self.store(query, answer, vector, version)
+        return answer
+
+    async def aget_or_compute(self, query, acompute):
+        # Lookups may embed the query, so keep them off the event loop
+        # (run_blocking carries the request trace along).
+        answer, vector, version = await run_blocking(self.lookup, query)
+        if answer is not None:
+            return answer
+        answer = await acompute()
+        await run_blocking(self.store, query, answer, vector, version)
+        return answer
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+            self._db_write("DELETE FROM answers WHERE cache = ?", (self.name,))
+
+    def stats(self):
+        lookups = self.hits["exact"] + self.hits["semantic"] + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": dict(self.hits),
+            "misses": self.misses,
+            "hit_rate": round((lookups - self.misses) / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "version": self._version,
+        }
@@ -1,9 +1,119 @@
-from fastapi import FastAPI
+import json
+import logging
+import os
+import time
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
+import rag_components
+from chain_registry import registry
+from corpora import corpora
+from concurrency import PRIORITIES, EndpointLimiter, Overloaded, install_default_executor, run_blocking
+from corpus_chain import acorpus_print, cache_stats as corpus_cache_stats
+from embedding_service import embedding_stats
+from intent_classifier import ID_PATTERN
+from mitre_chain import mitre_cache, mitre_flight
+from owasp_chain import abatch_owasp, aowasp_print, astream_owasp, owasp_cache, owasp_flight
+from telemetry import REQUEST_SECONDS, configure_logging, current_trace, emit_trace, render_metrics, shutdown_logging, trace
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
+# --- 1. WARM-UP ---
+# Load embeddings, Chroma collections and the LLM client once per process,
+# in the background so /healthz answers immediately while /readyz holds
+# traffic until every chain is built. Under gunicorn (gunicorn.conf.py) the
+# master has already built them and this returns immediately.
+@app.on_event("startup")
+async def warm_chains():
+    configure_logging()
+    install_default_executor()
+    registry.warm_in_background()
+
+@app.on_event("shutdown")
+async def flush_logs():
+    shutdown_logging()
+
+# --- Tracing ---
+# One trace per request: spans from embedding, vector search, context
+# assembly and the LLM call attach to it (see telemetry).
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+
+    def finish():
+        # Route templates keep label cardinality bounded.
+        route = request.scope.get("route")
+        endpoint = route.path if route is not None else "unmatched"
+        t.attrs.update(endpoint=endpoint, status=status)
+        REQUEST_SECONDS.labels(endpoint, str(status)).observe(time.perf_counter() - started)
+        emit_trace(t)
+
+    # The trace and timer end with the body, not the headers, so streamed
+    # answers (/askowasp/stream) are measured to their last token.
+    with trace(request.url.path, emit=False) as t:
+        try:
+            response = await call_next(request)
+        except BaseException:
+            finish()
+            raise
+        status = response.status_code
+        return FinishingResponse(response, finish)
+
+class FinishingResponse:
+    # Sends the wrapped response, then runs finish however sending ends:
+    # body done, client gone mid-stream or before the body started.
+    def __init__(self, response, finish):
+        self.response = response
+        self._finish = finish
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await self.response(scope, receive, send)
+        finally:
+            self._finish()
+
+# Per-endpoint concurrency limits; excess requests queue briefly and are
+# rejected with 503 once the queue is full.
+limiters = {
+    'owasp': EndpointLimiter.from_env('owasp', max_concurrency=4, max_queue=16),
+    'mitre': EndpointLimiter.from_env('mitre', max_concurrency=8, max_queue=32),
+    # Shared by every generic ("rag") corpus behind /ask/{corpus}.
+    'corpus': EndpointLimiter.from_env('corpus', max_concurrency=4, max_queue=16),
+    'batch': EndpointLimiter.from_env('batch', max_concurrency=2, max_queue=4, queue_timeout=60.0),
+}
+
+class SlotStreamingResponse(StreamingResponse):
+    # Frees an endpoint limiter slot however the response ends: body done,
+    # client gone mid-stream, or gone before the body ever started (the
+    # generator then never runs, so its own finally cannot be relied on).
+    def __init__(self, content, release, **kwargs):
+        super().__init__(content, **kwargs)
+        self._release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self._release()
+
+def request_priority(request: Request):
+    # X-Priority: interactive (default, UI traffic) or bulk (SOAR playbooks,
+    # scripts). Interactive requests are admitted first; bulk ones age in.
+    value = request.headers.get('x-priority', PRIORITIES[0]).lower()
+    return value if value in PRIORITIES else PRIORITIES[0]
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    return JSONResponse(
+        status_code=503,
+        content={'detail': str(exc)},
+        headers={'Retry-After': str(exc.retry_after)},
+    )
+
 # --- 2. CORS MIDDLEWARE ---
 app.add_middleware(
     CORSMiddleware,
@@ -16,28 +126,145 @@ app.add_middleware(
 class QueryRequest(BaseModel):
     query: str
 
-@app.post('/askowasp')
-def ask_owasp_endpoint(req: QueryRequest):
-    print(f"DEBUG: Received OWASP query: {req.query}")
-    # Lazy import avoids heavy model loading during app startup.
-    from owasp_chain import owasp_print
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '1000'))
+
+class BatchQueryRequest(BaseModel):
+    queries: list[str] = Field(..., min_length=1, max_length=BATCH_MAX_ITEMS)
+
+LOOKUP_MAX_IDS = int(os.getenv('LOOKUP_MAX_IDS', '50'))
+
+@app.get('/healthz')
+def healthz():
+    return {'status': 'ok'}
 
-    answer = owasp_print(req.query)
+@app.get('/readyz')
+def readyz():
+    status = registry.status()
+    code = 200 if registry.is_ready() else 503
+    return JSONResponse(status_code=code, content={
+        'ready': code == 200,
+        'chains': status,
+        'memory': registry.memory_stats(),
+        'limits': {name: l.stats() for name, l in limiters.items()},
+        'llm': rag_components._llm.stats() if rag_components._llm is not None else None,
+    })
+
+@app.get('/metrics')
+def metrics():
+    body, content_type = render_metrics()
+    if body is None:
+        return PlainTextResponse('prometheus_client is not installed', status_code=501)
+    return Response(content=body, media_type=content_type)
+
+@app.get('/cache/stats')
+def cache_stats():
+    return {
+        'owasp': owasp_cache.stats(),
+        'mitre': mitre_cache.stats(),
+        'embeddings': embedding_stats(),
+        'coalescing': {'owasp': owasp_flight.stats(), 'mitre': mitre_flight.stats()},
+        'corpora': corpus_cache_stats(),
+    }
+
+@app.post('/askowasp')
+async def ask_owasp_endpoint(req: QueryRequest, request: Request):
+    logger.debug("Received OWASP query: %s", req.query)
+    # Only the request that computes takes a slot; identical concurrent
+    # queries wait for its answer instead.
+    priority = request_priority(request)
+    answer = await aowasp_print(req.query, slot=lambda: limiters['owasp'].slot(priority))
     
-    print(f"DEBUG: OWASP Answer: {answer}") 
+    logger.debug("OWASP answer: %d chars", len(answer))
     
     # --- 3. FIX: Return a Dictionary (JSON), not just the string ---
     return {'answer': answer} 
 
+@app.post('/askowasp/stream')
+async def ask_owasp_stream_endpoint(req: QueryRequest, request: Request):
+    # Take the slot before the response starts so overload is still a clean 503.
+    limiter = limiters['owasp']
+    await limiter.acquire(request_priority(request))
+    released = False
+
+    def release():
+        nonlocal released
+        if not released:
+            released = True
+            limiter.release()
+
+    try:
+        use_sse = 'text/event-stream' in request.headers.get('accept', '')
+
+        async def frames():
+            try:
+                async for frame in astream_owasp(req.query):
+                    data = json.dumps(frame)
+                    yield f"event: {frame['type']}\ndata: {data}\n\n" if use_sse else data + "\n"
+            except Exception:
+                # Details (paths, upstream URLs) stay in the server log; the
+                # client gets the trace id to quote.
+                t = current_trace()
+                logger.exception("OWASP stream failed (trace %s)", t.id if t else None)
+                error = json.dumps({'type': 'error', 'detail': 'Answer generation failed', 'trace_id': t.id if t else None})
+                yield f"event: error\ndata: {error}\n\n" if use_sse else error + "\n"
+
+        media_type = 'text/event-stream' if use_sse else 'application/x-ndjson'
+        return SlotStreamingResponse(frames(), release, media_type=media_type, headers={'Cache-Control': 'no-cache'})
+    except BaseException:
+        release()
+        raise
+
 @app.post('/askmitre')
-def ask_mitre_endpoint(req: QueryRequest):
-    print(f"DEBUG: Received MITRE query: {req.query}")
+async def ask_mitre_endpoint(req: QueryRequest, request: Request):
+    logger.debug("Received MITRE query: %s", req.query)
 
-    from mitre_chain import router
-    answer = router.solve(req.query)
+    priority = request_priority(request)
+    router = await run_blocking(registry.get, "mitre")
+    answer = await router.asolve(req.query, slot=lambda: limiters['mitre'].slot(priority))
     
-    print(f"DEBUG: MITRE Answer: {answer}")
+    logger.debug("MITRE answer: %d chars", len(answer))
+
+    return {'answer': answer}
+
+@app.post('/ask/{corpus}')
+async def ask_corpus_endpoint(corpus: str, req: QueryRequest, request: Request):
+    # Any corpus declared with the generic "rag" chain in corpora.json (e.g.
+    # /ask/nist). Loaded on first use, and evicted under the memory budget.
+    declared = corpora().get(corpus)
+    if declared is None or declared.chain != 'rag':
+        raise HTTPException(status_code=404, detail=f"Unknown corpus '{corpus}'")
+    logger.debug("Received %s query: %s", corpus, req.query)
 
+    priority = request_priority(request)
+    answer = await acorpus_print(corpus, req.query, slot=lambda: limiters['corpus'].slot(priority))
     return {'answer': answer}
 
-# To run: uvicorn run:app --reload
+@app.get('/mitre/lookup')
+async def mitre_lookup_endpoint(ids: str):
+    # e.g. /mitre/lookup?ids=T1056.001,M1043 -> full records, no embedding.
+    wanted = list(dict.fromkeys(i.strip().upper() for i in ids.split(',') if i.strip()))
+    if not wanted or len(wanted) > LOOKUP_MAX_IDS:
+        raise HTTPException(status_code=422, detail=f"Pass between 1 and {LOOKUP_MAX_IDS} ids")
+    invalid = [i for i in wanted if not ID_PATTERN.fullmatch(i)]
+    if invalid:
+        raise HTTPException(status_code=422, detail=f"Not technique or mitigation ids: {', '.join(invalid[:5])}")
+    router = await run_blocking(registry.get, "mitre")
+    return {'records': await run_blocking(router.lookup_ids, wanted)}
+
+@app.post('/askowasp/batch')
+async def ask_owasp_batch_endpoint(req: BatchQueryRequest):
+    # Batches are bulk traffic: they also queue behind interactive requests
+    # for the framework's own slots.
+    async with limiters['batch'].slot('bulk'), limiters['owasp'].slot('bulk'):
+        results = await abatch_owasp(req.queries)
+    return {'results': results}
+
+@app.post('/askmitre/batch')
+async def ask_mitre_batch_endpoint(req: BatchQueryRequest):
+    async with limiters['batch'].slot('bulk'), limiters['mitre'].slot('bulk'):
+        router = await run_blocking(registry.get, "mitre")
+        results = await router.asolve_batch(req.queries)
+    return {'results': results}
+
+# To run: uvicorn backend:app --reload
+
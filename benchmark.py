@@ -0,0 +1,353 @@
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+# Offline by default: the stub backend answers instantly, so the numbers
+# measure retrieval, routing and serving overhead rather than the endpoint.
+os.environ.setdefault("LLM_BACKENDS", "stub")
+
+QUERIES_FILE = "benchmark_queries.json"
+RETRIEVAL_K = 5
+# Relative slack before a latency/throughput/memory change counts as a
+# regression; quality metrics use an absolute drop instead.
+TOLERANCE = 0.10
+QUALITY_TOLERANCE = 0.01
+
+
+def load_queries(path=QUERIES_FILE):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    # Nearest-rank definition.
+    rank = max(1, math.ceil(p / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+def summarize(values_ms):
+    return {
+        "count": len(values_ms),
+        "p50_ms": _round(percentile(values_ms, 50)),
+        "p95_ms": _round(percentile(values_ms, 95)),
+        "p99_ms": _round(percentile(values_ms, 99)),
+        "max_ms": _round(max(values_ms) if values_ms else None),
+    }
+
+def _round(value):
+    return round(value, 2) if value is not None else None
+
+def memory_mb():
+    # Current and peak resident set size of this process.
+    current = peak = None
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    current = int(line.split()[1]) / 1024
+                elif line.startswith("VmHWM:"):
+                    peak = int(line.split()[1]) / 1024
+    except OSError:
+        # ru_maxrss is KiB on Linux, bytes on macOS.
+        scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    return {"rss": _round(current), "peak": _round(peak)}
+
+
+# --- Cold start (fresh interpreter) ---
+
+_COLD_START = """
+import json, time
+t0 = time.perf_counter()
+import backend
+t1 = time.perf_counter()
+from chain_registry import registry
+registry.warm()
+t2 = time.perf_counter()
+print(json.dumps({"import_s": t1 - t0, "warm_s": t2 - t1, "total_s": t2 - t0}))
+"""
+
+def measure_cold_start():
+    started = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-c", _COLD_START], capture_output=True, text=True, env=os.environ.copy())
+    if proc.returncode != 0:
+        return {"error": proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "failed"}
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result["process_s"] = time.perf_counter() - started
+    return {k: round(v, 3) for k, v in result.items()}
+
+
+# --- In-process latency and quality ---
+
+def _run_traced(name, fn, query):
+    from telemetry import trace
+
+    with trace(name) as t:
+        started = time.perf_counter()
+        answer = fn(query)
+        elapsed = (time.perf_counter() - started) * 1000
+    return answer, elapsed, t.spans
+
+def _ids_in(docs):
+    return [d.metadata.get("mitre_id") for d in docs]
+
+def bench_mitre(cases, repeat, cold_cache):
+    from chain_registry import registry
+    from mitre_chain import mitre_cache
+
+    router = registry.get("mitre")
+    latencies, stages, intents = [], defaultdict(list), defaultdict(list)
+    answer_hits = retrieval_hits = scored = 0
+    misses = []
+
+    for rnd in range(repeat):
+        for case in cases:
+            if cold_cache:
+                mitre_cache.clear()
+            answer, elapsed, spans = _run_traced("bench:mitre", router.solve, case["query"])
+            latencies.append(elapsed)
+            for s in spans:
+                stages[s["stage"]].append(s["ms"])
+                if s["stage"] == "route":
+                    intents[s["intent"]].append(s["ms"])
+
+            expected = set(case.get("expected") or [])
+            if rnd or not expected:
+                continue
+            scored += 1
+            if any(e in answer.upper() for e in expected):
+                answer_hits += 1
+            else:
+                misses.append(case["query"])
+            top = [doc for doc, _ in router.search(case["query"], RETRIEVAL_K)]
+            if expected & set(_ids_in(top)):
+                retrieval_hits += 1
+
+    return {
+        "latency": summarize(latencies),
+        "stages": {k: summarize(v) for k, v in stages.items()},
+        "intents": {k: summarize(v) for k, v in intents.items()},
+        "quality": {
+            "scored": scored,
+            "answer_hit_rate": round(answer_hits / scored, 4) if scored else None,
+            f"retrieval_hit_at_{RETRIEVAL_K}": round(retrieval_hits / scored, 4) if scored else None,
+            "answer_misses": misses,
+        },
+    }
+
+def bench_owasp(cases, repeat, cold_cache):
+    from owasp_chain import owasp_cache, owasp_print
+    from owasp_store import search
+
+    latencies, stages = [], defaultdict(list)
+    retrieval_hits = scored = 0
+    misses = []
+
+    for rnd in range(repeat):
+        for case in cases:
+            if cold_cache:
+                owasp_cache.clear()
+            _, elapsed, spans = _run_traced("bench:owasp", owasp_print, case["query"])
+            latencies.append(elapsed)
+            for s in spans:
+                stages[s["stage"]].append(s["ms"])
+
+            expected = case.get("expected") or []
+            if rnd or not expected:
+                continue
+            scored += 1
+            # The stub LLM cannot be graded, so quality is judged on retrieval.
+            # Expected values are page slugs; every chunk's source is just "OWASP".
+            urls = [d.metadata.get("url") or "" for d in search(case["query"])]
+            if any(e in url for e in expected for url in urls):
+                retrieval_hits += 1
+            else:
+                misses.append(case["query"])
+
+    return {
+        "latency": summarize(latencies),
+        "stages": {k: summarize(v) for k, v in stages.items()},
+        "quality": {
+            "scored": scored,
+            "retrieval_hit_rate": round(retrieval_hits / scored, 4) if scored else None,
+            "retrieval_misses": misses,
+        },
+    }
+
+
+# --- Load (concurrent HTTP against the FastAPI app) ---
+
+async def _load(url, workload, concurrency, total):
+    import httpx
+
+    if url:
+        client = httpx.AsyncClient(base_url=url, timeout=60.0)
+    else:
+        # In-process: ASGI transport, no sockets. Startup hooks do not run
+        # under ASGITransport, so the executor is installed here.
+        import backend
+        from concurrency import install_default_executor
+
+        install_default_executor()
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=backend.app), base_url="http://bench", timeout=60.0)
+
+    jobs = itertools.islice(itertools.cycle(workload), total)
+    latencies, statuses = defaultdict(list), defaultdict(int)
+
+    async def worker():
+        for path, query in jobs:
+            started = time.perf_counter()
+            try:
+                resp = await client.post(path, json={"query": query})
+                statuses[str(resp.status_code)] += 1
+            except Exception as e:
+                statuses[type(e).__name__] += 1
+                continue
+            latencies[path].append((time.perf_counter() - started) * 1000)
+
+    async with client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall = time.perf_counter() - started
+
+    completed = sum(len(v) for v in latencies.values())
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "wall_s": round(wall, 3),
+        "rps": round(completed / wall, 2) if wall else None,
+        "statuses": dict(statuses),
+        "endpoints": {path: summarize(v) for path, v in latencies.items()},
+        "all": summarize([x for v in latencies.values() for x in v]),
+    }
+
+def bench_load(queries, frameworks, concurrency, total, url=None):
+    paths = {"mitre": "/askmitre", "owasp": "/askowasp"}
+    workload = [(paths[fw], case["query"]) for fw in frameworks for case in queries[fw]]
+    return asyncio.run(_load(url, workload, concurrency, total))
+
+
+# --- Baseline comparison ---
+
+def _flatten(data, prefix=""):
+    out = {}
+    for key, value in data.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            out.update(_flatten(value, path + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            out[path] = value
+    return out
+
+def _direction(path):
+    # +1: higher is worse, -1: lower is worse, 0: informational.
+    leaf = path.rsplit(".", 1)[-1]
+    if leaf in ("p95_ms", "p99_ms") or path.startswith(("memory_mb.", "cold_start.")):
+        return 1
+    if leaf == "rps" or "hit" in leaf:
+        return -1
+    return 0
+
+def compare(current, baseline, tolerance=TOLERANCE):
+    cur, base = _flatten(current), _flatten(baseline)
+    regressions, improvements = [], []
+    for path, new in cur.items():
+        old = base.get(path)
+        direction = _direction(path)
+        if old is None or not direction:
+            continue
+        if "hit" in path:
+            worse, better = new < old - QUALITY_TOLERANCE, new > old + QUALITY_TOLERANCE
+        elif old <= 0:
+            continue
+        else:
+            change = (new - old) / old * direction
+            worse, better = change > tolerance, change < -tolerance
+        entry = {"metric": path, "baseline": old, "current": new}
+        if worse:
+            regressions.append(entry)
+        elif better:
+            improvements.append(entry)
+    return {"regressions": regressions, "improvements": improvements}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark latency, throughput, memory and retrieval quality.")
+    parser.add_argument("--queries", default=QUERIES_FILE)
+    parser.add_argument("--frameworks", default="mitre,owasp", help="Comma-separated subset of mitre,owasp.")
+    parser.add_argument("--repeat", type=int, default=3, help="Passes over the query set for latency percentiles.")
+    parser.add_argument("--warm-cache", action="store_true", help="Keep answer caches between passes.")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200, help="Total requests in the load phase (0 skips it).")
+    parser.add_argument("--url", help="Load-test a running server (e.g. http://127.0.0.1:8000) instead of in-process.")
+    parser.add_argument("--skip-cold-start", action="store_true")
+    parser.add_argument("--out", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="Earlier results file to compare against.")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    queries = load_queries(args.queries)
+    frameworks = [f.strip() for f in args.frameworks.split(",") if f.strip()]
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "env": {k: v for k, v in os.environ.items() if k.startswith(("LLM_", "EMBED", "VECTOR_", "ANSWER_CACHE", "OWASP_", "EXECUTOR_"))},
+        },
+    }
+
+    if not args.skip_cold_start:
+        print("⏱️ Measuring cold start...")
+        results["cold_start"] = measure_cold_start()
+
+    from chain_registry import registry
+    registry.warm(frameworks)
+    results["memory_mb"] = {"after_warm": memory_mb()}
+
+    benches = {"mitre": bench_mitre, "owasp": bench_owasp}
+    for fw in frameworks:
+        print(f"⏱️ {fw}: {len(queries[fw])} queries x {args.repeat}")
+        results[fw] = benches[fw](queries[fw], args.repeat, cold_cache=not args.warm_cache)
+
+    if args.requests:
+        print(f"🔥 Load: {args.requests} requests at concurrency {args.concurrency}")
+        results["load"] = bench_load(queries, frameworks, args.concurrency, args.requests, args.url)
+    results["memory_mb"]["final"] = memory_mb()
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        results["comparison"] = compare(results, baseline, args.tolerance)
+        for r in results["comparison"]["regressions"]:
+            print(f"❌ REGRESSION {r['metric']}: {r['baseline']} -> {r['current']}")
+        for r in results["comparison"]["improvements"]:
+            print(f"✅ improved {r['metric']}: {r['baseline']} -> {r['current']}")
+        exit_code = 1 if results["comparison"]["regressions"] else 0
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"💾 Wrote {args.out}")
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
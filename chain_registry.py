@@ -0,0 +1,237 @@
+import gc
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from corpora import corpora, model_memory_mb
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on what loaded corpora may hold resident: their indexes plus
+# one copy of each embedding model they use. Loading past it evicts the least
+# recently used corpora first. 0 disables eviction.
+MEMORY_BUDGET_MB = float(os.getenv("CORPUS_MEMORY_BUDGET_MB", "0"))
+
+
+class ChainRegistry:
+    def __init__(self, memory_budget_mb=MEMORY_BUDGET_MB):
+        self._builders = {}
+        self._unloaders = {}
+        self._corpora = {}
+        self._preload = []
+        self._chains = OrderedDict()    # least recently used first
+        self._costs = {}                # name -> index MB while loaded
+        self._loaded_once = set()
+        self._errors = {}
+        self._load_times = {}
+        # One lock per chain so a slow OWASP build never blocks MITRE.
+        self._locks = {}
+        self._registry_lock = threading.Lock()
+        self._budget_lock = threading.Lock()
+        # Guards _chains and _costs themselves. Held only for the dict
+        # operations, so get()'s fast path never waits on an eviction.
+        self._chains_lock = threading.Lock()
+        self.memory_budget_mb = memory_budget_mb
+        self.evictions = 0
+
+    def register(self, name, builder, unload=None, corpus=None, preload=True):
+        with self._registry_lock:
+            self._builders[name] = builder
+            self._locks[name] = threading.Lock()
+            if unload is not None:
+                self._unloaders[name] = unload
+            if corpus is not None:
+                self._corpora[name] = corpus
+            if preload:
+                self._preload.append(name)
+
+    def names(self):
+        return list(self._builders)
+
+    def get(self, name):
+        # Fast path: already built, no per-chain lock needed.
+        with self._chains_lock:
+            chain = self._chains.get(name)
+            if chain is not None:
+                self._chains.move_to_end(name)
+        if chain is not None:
+            return chain
+
+        if name not in self._builders:
+            raise KeyError(f"Unknown chain '{name}'")
+
+        with self._locks[name]:
+            chain = self._chains.get(name)
+            if chain is None:
+                self._make_room(name)
+                started = time.perf_counter()
+                try:
+                    chain = self._builders[name]()
+                except Exception as e:
+                    self._errors[name] = repr(e)
+                    raise
+                corpus = self._corpora.get(name)
+                cost = corpus.index_mb() if corpus is not None else 0.0
+                with self._budget_lock, self._chains_lock:
+                    self._costs[name] = cost
+                    self._chains[name] = chain
+                self._loaded_once.add(name)
+                self._errors.pop(name, None)
+                self._load_times[name] = round(time.perf_counter() - started, 3)
+        return chain
+
+    # --- Memory budget ---
+
+    def _model(self, name):
+        corpus = self._corpora.get(name)
+        return corpus.embedding_model if corpus is not None else None
+
+    def _loaded(self):
+        # Least recently used first; a snapshot, safe to iterate.
+        with self._chains_lock:
+            return list(self._chains)
+
+    def _loaded_models(self, exclude=None):
+        return {self._model(n) for n in self._loaded() if n != exclude} - {None}
+
+    def memory_used_mb(self):
+        with self._chains_lock:
+            index_mb = sum(self._costs.get(n, 0.0) for n in self._chains)
+        return index_mb + sum(model_memory_mb(m) for m in self._loaded_models())
+
+    def _make_room(self, name):
+        corpus = self._corpora.get(name)
+        if self.memory_budget_mb <= 0 or corpus is None:
+            return
+        with self._budget_lock:
+            needed = corpus.index_mb()
+            if corpus.embedding_model not in self._loaded_models():
+                needed += model_memory_mb(corpus.embedding_model)
+            while self.memory_used_mb() + needed > self.memory_budget_mb:
+                victim = next((n for n in self._loaded() if n != name), None)
+                if victim is None:
+                    logger.warning("Corpus '%s' (%.0f MB) exceeds the %.0f MB budget on its own; loading anyway",
+                                   name, needed, self.memory_budget_mb)
+                    return
+                # Evicting the last other user of our model releases it too,
+                # so this load has to pay for it again.
+                if self._model(victim) == corpus.embedding_model and self._model(victim) not in self._loaded_models(exclude=victim):
+                    needed += model_memory_mb(corpus.embedding_model)
+                self._evict(victim)
+
+    def _evict(self, name):
+        # Caller holds _budget_lock. Requests already holding the chain finish
+        # normally; the next get() rebuilds it.
+        with self._chains_lock:
+            self._chains.pop(name, None)
+            self._costs.pop(name, None)
+        unload = self._unloaders.get(name)
+        if unload is not None:
+            try:
+                unload()
+            except Exception as e:
+                logger.warning("Failed to unload chain '%s': %r", name, e)
+        model = self._model(name)
+        if model is not None and model not in self._loaded_models():
+            from embedding_service import release_embeddings
+            release_embeddings(model)
+        self.evictions += 1
+        gc.collect()
+        logger.info("Evicted corpus '%s' to stay within %.0f MB", name, self.memory_budget_mb)
+
+    def evict(self, name):
+        with self._locks[name], self._budget_lock:
+            if name in self._chains:
+                self._evict(name)
+
+    # --- Warm-up and status ---
+
+    def warm(self, names=None):
+        for name in names or self._preload:
+            try:
+                self.get(name)
+            except Exception as e:
+                logger.warning("Failed to warm chain '%s': %r", name, e)
+
+    def warm_in_background(self, names=None):
+        thread = threading.Thread(target=self.warm, args=(names,), name="chain-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def is_ready(self, name=None):
+        # Evicted corpora stay ready: they reload on the next request.
+        if name is not None:
+            return name in self._loaded_once
+        return all(n in self._loaded_once for n in self._preload)
+
+    def status(self):
+        loaded = set(self._loaded())
+        return {
+            name: {
+                "ready": name in self._loaded_once,
+                "loaded": name in loaded,
+                "preload": name in self._preload,
+                "load_seconds": self._load_times.get(name),
+                "error": self._errors.get(name),
+            }
+            for name in self._builders
+        }
+
+    def memory_stats(self):
+        return {
+            "budget_mb": self.memory_budget_mb or None,
+            "used_mb": round(self.memory_used_mb(), 1),
+            "loaded": self._loaded(),
+            "embedding_models": sorted(self._loaded_models()),
+            "evictions": self.evictions,
+        }
+
+
+# --- Chain types (imported lazily so the registry itself stays cheap to import) ---
+# Each maps to (build(corpus) -> chain, unload(corpus)).
+
+def _build_owasp(corpus):
+    from owasp_chain import build_owasp_chain
+    return build_owasp_chain()
+
+def _unload_owasp(corpus):
+    from owasp_store import unload
+    unload()
+
+def _build_mitre(corpus):
+    from mitre_chain import router
+    return router.warm()
+
+def _unload_mitre(corpus):
+    from mitre_chain import unload
+    unload()
+
+def _build_rag(corpus):
+    from corpus_chain import get_corpus_chain
+    return get_corpus_chain(corpus.name).build()
+
+def _unload_rag(corpus):
+    from corpus_chain import get_corpus_chain
+    get_corpus_chain(corpus.name).unload()
+
+CHAIN_TYPES = {
+    "owasp": (_build_owasp, _unload_owasp),
+    "mitre": (_build_mitre, _unload_mitre),
+    "rag": (_build_rag, _unload_rag),
+}
+
+def register_corpora(registry, corpora):
+    for corpus in corpora.values():
+        build, unload = CHAIN_TYPES[corpus.chain]
+        registry.register(
+            corpus.name,
+            lambda c=corpus, b=build: b(c),
+            unload=lambda c=corpus, u=unload: u(c),
+            corpus=corpus,
+            preload=corpus.preload,
+        )
+
+
+registry = ChainRegistry()
+register_corpora(registry, corpora())
@@ -0,0 +1,220 @@
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from telemetry import COALESCED, QUEUE_WAIT_SECONDS, set_attribute
+
+# Bounded pool for CPU-bound work (embeddings, Chroma search, intent routing).
+# Installed as the loop's default executor so LangChain's own
+# run_in_executor calls land here too instead of an unbounded pool.
+EXECUTOR_WORKERS = int(os.getenv("EXECUTOR_WORKERS", str(min(8, (os.cpu_count() or 1) + 2))))
+_executor = None
+
+
+class Overloaded(Exception):
+    def __init__(self, name, retry_after=1):
+        super().__init__(f"'{name}' is overloaded, retry later")
+        self.name = name
+        self.retry_after = retry_after
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS, thread_name_prefix="rag-cpu")
+    return _executor
+
+def install_default_executor():
+    asyncio.get_running_loop().set_default_executor(get_executor())
+
+async def run_blocking(fn, *args, **kwargs):
+    # Carry the caller's context so the request trace follows work onto the pool.
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(get_executor(), functools.partial(ctx.run, fn, *args, **kwargs))
+
+
+# Priority classes, most urgent first. Interactive UI traffic is served
+# ahead of bulk/automation traffic; a bulk waiter older than
+# PRIORITY_AGING_SECONDS is served next regardless, so it cannot starve.
+PRIORITIES = ("interactive", "bulk")
+PRIORITY_AGING = float(os.getenv("PRIORITY_AGING_SECONDS", "2.0"))
+
+
+class EndpointLimiter:
+    def __init__(self, name, max_concurrency, max_queue, queue_timeout=None, aging=PRIORITY_AGING):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.aging = aging
+        self.active = 0
+        self.rejected = 0
+        self._waiters = {p: deque() for p in PRIORITIES}   # (enqueued_at, future)
+
+    @classmethod
+    def from_env(cls, name, max_concurrency=8, max_queue=32, queue_timeout=10.0):
+        prefix = name.upper()
+        timeout = float(os.getenv(f"{prefix}_QUEUE_TIMEOUT", str(queue_timeout)))
+        return cls(
+            name,
+            max_concurrency=int(os.getenv(f"{prefix}_MAX_CONCURRENCY", str(max_concurrency))),
+            max_queue=int(os.getenv(f"{prefix}_MAX_QUEUE", str(max_queue))),
+            queue_timeout=timeout if timeout > 0 else None,
+        )
+
+    @property
+    def waiting(self):
+        return sum(len(q) for q in self._waiters.values())
+
+    async def acquire(self, priority="interactive"):
+        if priority not in self._waiters:
+            priority = PRIORITIES[0]
+        if self.active < self.max_concurrency and not self.waiting:
+            self.active += 1
+            QUEUE_WAIT_SECONDS.labels(self.name, priority).observe(0.0)
+            return
+
+        # Backpressure: shed load as soon as the queue is full rather than
+        # letting every caller wait behind it.
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise Overloaded(self.name)
+
+        enqueued = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        entry = (enqueued, future)
+        self._waiters[priority].append(entry)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done():
+                # Granted just as we gave up: hand the slot on.
+                self.release()
+            else:
+                future.cancel()
+                self._waiters[priority].remove(entry)
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected += 1
+                raise Overloaded(self.name)
+            raise
+        finally:
+            QUEUE_WAIT_SECONDS.labels(self.name, priority).observe(time.monotonic() - enqueued)
+
+    def _next_waiter(self):
+        bulk = self._waiters["bulk"]
+        if bulk and time.monotonic() - bulk[0][0] >= self.aging:
+            return bulk.popleft()
+        for priority in PRIORITIES:
+            if self._waiters[priority]:
+                return self._waiters[priority].popleft()
+        return None
+
+    def release(self):
+        # The slot passes straight to the next waiter, if any.
+        entry = self._next_waiter()
+        if entry is None:
+            self.active -= 1
+        else:
+            entry[1].set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, priority="interactive"):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "waiting_by_priority": {p: len(q) for p, q in self._waiters.items()},
+            "rejected": self.rejected,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+        }
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share one in-flight computation;
+    # every caller gets its result (or exception). Async callers join any
+    # leader. Sync callers only join sync leaders: a thread blocked on an
+    # async leader may hold the executor slot that leader's run_blocking
+    # needs, so it computes on its own instead.
+    def __init__(self, name, key=lambda k: k):
+        self.name = name
+        self._key = key
+        self._inflight = {}   # key -> (concurrent.futures.Future, leader is async)
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def _join(self, key, is_async):
+        # Returns (future, is_leader); future is None when a sync caller
+        # found an async leader and must compute without coalescing.
+        with self._lock:
+            entry = self._inflight.get(key)
+            if entry is not None:
+                future, leader_is_async = entry
+                if leader_is_async and not is_async:
+                    return None, True
+                self.coalesced += 1
+                COALESCED.labels(self.name).inc()
+                set_attribute("coalesced", self.name)
+                return future, False
+            future = Future()
+            self._inflight[key] = (future, is_async)
+            self.leaders += 1
+            return future, True
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            if self._inflight.get(key, (None,))[0] is future:
+                del self._inflight[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, fn):
+        key = self._key(key)
+        future, leader = self._join(key, is_async=False)
+        if future is None:
+            return fn()
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    async def ado(self, key, acompute):
+        key = self._key(key)
+        future, leader = self._join(key, is_async=True)
+        if leader:
+            # Run as its own task so a disconnecting leader does not cancel
+            # the work the followers are waiting on.
+            task = asyncio.ensure_future(acompute())
+
+            def done(t):
+                if t.cancelled():
+                    self._finish(key, future, error=asyncio.CancelledError())
+                else:
+                    self._finish(key, future, t.result() if t.exception() is None else None, t.exception())
+
+            task.add_done_callback(done)
+        return await asyncio.shield(asyncio.wrap_future(future))
+
+    def stats(self):
+        return {"inflight": len(self._inflight), "leaders": self.leaders, "coalesced": self.coalesced}
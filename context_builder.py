@@ -0,0 +1,116 @@
+import os
+import re
+import threading
+
+from hybrid_retriever import tokenize
+
+TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "600"))
+# Keep only sentences that share terms with the question.
+EXTRACT_SENTENCES = os.getenv("CONTEXT_EXTRACT_SENTENCES", "false").lower() == "true"
+MIN_OVERLAP = 20
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n{2,}")
+_STOPWORDS = {"the", "a", "an", "of", "to", "in", "and", "or", "is", "are", "what", "how", "for", "on", "with", "does", "do"}
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def count_tokens(text):
+    # Uses the generation model's own tokenizer so the budget matches what
+    # the endpoint actually processes; falls back to ~4 chars per token.
+    global _tokenizer
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                try:
+                    from transformers import AutoTokenizer
+                    from rag_components import model_name
+                    _tokenizer = AutoTokenizer.from_pretrained(model_name)
+                except Exception:
+                    _tokenizer = False
+    if _tokenizer is False:
+        return max(1, len(text) // 4)
+    return len(_tokenizer.encode(text, add_special_tokens=False))
+
+
+def _overlap(a, b):
+    # Longest suffix of a that is a prefix of b (the splitter's chunk_overlap).
+    for size in range(min(len(a), len(b), 400), MIN_OVERLAP - 1, -1):
+        if a.endswith(b[:size]):
+            return size
+    return 0
+
+def dedupe(chunks):
+    # chunks: [(text, source)] in rank order. Drops chunks contained in
+    # another and strips the overlap an earlier chunk already covers.
+    kept = []
+    for text, source in chunks:
+        text = text.strip()
+        if not text or any(text in other for other, _ in kept):
+            continue
+        for other, _ in kept:
+            cut = _overlap(other, text)
+            if cut:
+                text = text[cut:].strip()
+        kept = [(k, s) for k, s in kept if k not in text]
+        if text:
+            kept.append((text, source))
+    return kept
+
+def extract_sentences(text, query_terms):
+    sentences = [s for s in _SENTENCE_END.split(text) if s.strip()]
+    relevant = [s for s in sentences if query_terms & set(tokenize(s))]
+    return " ".join(relevant) if relevant else text
+
+def _trim_to_budget(text, budget):
+    # Cut at the last sentence boundary that fits.
+    sentences = [s for s in _SENTENCE_END.split(text) if s.strip()]
+    out = []
+    for sentence in sentences:
+        if count_tokens(" ".join(out + [sentence])) > budget:
+            break
+        out.append(sentence)
+    return " ".join(out)
+
+
+def format_block(text, source):
+    return f"[SOURCE: {source}]\n{text}"
+
+def format_block_list(chunks):
+    return "\n\n".join(format_block(t, s) for t, s in chunks)
+
+
+def build_context(docs, question, budget=TOKEN_BUDGET, extract=EXTRACT_SENTENCES):
+    # Returns (context, stats). Docs arrive ranked; the budget is filled in order.
+    raw = format_block_list([(d.page_content.strip(), d.metadata.get("source")) for d in docs])
+    tokens_before = count_tokens(raw) if raw else 0
+
+    chunks = dedupe([(d.page_content, d.metadata.get("source")) for d in docs])
+    query_terms = set(tokenize(question)) - _STOPWORDS
+    if extract and query_terms:
+        chunks = [(extract_sentences(t, query_terms), s) for t, s in chunks]
+
+    blocks, used = [], 0
+    for text, source in chunks:
+        block = format_block(text, source)
+        cost = count_tokens(block)
+        if used + cost > budget:
+            remaining = budget - used
+            trimmed = _trim_to_budget(text, remaining - 10) if remaining > 40 else ""
+            if trimmed:
+                blocks.append(format_block(trimmed, source))
+                used += count_tokens(blocks[-1])
+            break
+        blocks.append(block)
+        used += cost
+
+    context = "\n\n".join(blocks)
+    stats = {
+        "chunks_in": len(docs),
+        "chunks_out": len(blocks),
+        "tokens_before": tokens_before,
+        "tokens_after": used,
+        "tokens_saved": max(0, tokens_before - used),
+    }
+    return context, stats
@@ -0,0 +1,86 @@
+import json
+import os
+import threading
+
+# Every framework the service answers questions about is declared in
+# CORPORA_CONFIG: where its collection lives, which embedding model indexed it
+# and which chain type answers from it ("owasp", "mitre" or the generic "rag").
+# chain_registry loads them on first use and evicts the least recently used
+# ones when CORPUS_MEMORY_BUDGET_MB is exceeded. Cheap to import: no models,
+# no Chroma.
+CORPORA_CONFIG = os.getenv("CORPORA_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpora.json"))
+# Used for models missing from the config's "embedding_models" table.
+DEFAULT_MODEL_MB = float(os.getenv("DEFAULT_EMBEDDING_MODEL_MB", "500"))
+
+
+def _dir_mb(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total / 2**20
+
+
+class Corpus:
+    def __init__(self, name, chain, path, collection, embedding_model, title=None,
+                 mmap_path=None, preload=False, memory_mb=None, options=None):
+        self.name = name
+        self.chain = chain
+        self.path = path
+        self.collection = collection
+        self.embedding_model = embedding_model
+        self.title = title or name
+        # Read-only export served when VECTOR_BACKEND=mmap (python fast_store.py <name>).
+        self.mmap_path = mmap_path or path.rstrip("/") + "_mmap"
+        # Loaded by registry.warm() at startup (and in the gunicorn master);
+        # the rest load on first request.
+        self.preload = preload
+        self.memory_mb = memory_mb
+        self.options = options or {}
+
+    @classmethod
+    def from_dict(cls, name, data):
+        return cls(name, **data)
+
+    def index_mb(self):
+        # Resident cost of the index alone; the embedding model is charged
+        # separately because corpora share it. Without a declared size, the
+        # on-disk size is a close enough estimate for Chroma and mmap alike.
+        if self.memory_mb is not None:
+            return float(self.memory_mb)
+        return _dir_mb(self.path)
+
+    def __repr__(self):
+        return f"Corpus({self.name!r}, chain={self.chain!r}, model={self.embedding_model!r})"
+
+
+_config = None
+_config_lock = threading.Lock()
+
+def load_config(path=CORPORA_CONFIG):
+    global _config
+    if _config is None:
+        with _config_lock:
+            if _config is None:
+                with open(path, "r", encoding="utf-8") as f:
+                    raw = json.load(f)
+                _config = {
+                    "models": {name: float(m.get("memory_mb", DEFAULT_MODEL_MB)) for name, m in raw.get("embedding_models", {}).items()},
+                    "corpora": {name: Corpus.from_dict(name, c) for name, c in raw["corpora"].items()},
+                }
+    return _config
+
+def corpora():
+    return load_config()["corpora"]
+
+def get_corpus(name):
+    try:
+        return corpora()[name]
+    except KeyError:
+        raise KeyError(f"Unknown corpus '{name}' (not declared in {CORPORA_CONFIG})") from None
+
+def model_memory_mb(model_name):
+    return load_config()["models"].get(model_name, DEFAULT_MODEL_MB)
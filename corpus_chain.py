@@ -0,0 +1,142 @@
+import logging
+import threading
+from contextlib import nullcontext
+from langchain_community.vectorstores import Chroma
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
+from answer_cache import AnswerCache, normalize_query
+from chain_registry import registry
+from concurrency import SingleFlight, run_blocking
+from corpora import get_corpus
+from embedding_service import get_embeddings
+from fast_store import MmapVectorStore, open_store
+from owasp_chain import TracedStrOutputParser, assemble_context
+from prefork import after_fork
+from rag_components import get_llm
+from telemetry import span
+
+logger = logging.getLogger(__name__)
+
+# The generic "rag" chain type: vector search over one corpus, context
+# assembly, LLM. Any corpus declared with "chain": "rag" in corpora.json
+# gets one (NIST today; CWE/CAPEC need only a config entry and an ingest).
+template = """You are a helpful cybersecurity assistant answering questions about {title}.
+Use the following pieces of retrieved context to answer the question.
+If the answer is not in the context, just say "I don't know".
+Keep the answer concise and professional.
+
+Context:
+{context}
+"""
+
+prompt = ChatPromptTemplate.from_messages([
+    ("system", template),
+    ("human", "{question}"),
+])
+
+
+class CorpusChain:
+    def __init__(self, corpus):
+        self.corpus = corpus
+        self.top_k = int(corpus.options.get("top_k", 5))
+        self._store = None
+        self._lock = threading.Lock()
+        self.cache = AnswerCache.from_env(corpus.name, corpus.path, embeddings=lambda: self.store().embeddings)
+        # Concurrent identical questions share one retrieval + generation.
+        self.flight = SingleFlight(corpus.name, key=normalize_query)
+
+    def store(self):
+        # After an eviction the chain registry reopens the index, so the load
+        # counts against its memory budget.
+        if self._store is None:
+            registry.get(self.corpus.name)
+        return self._open()
+
+    def _open(self):
+        # Opened on first use; reopened after eviction or fork.
+        if self._store is None:
+            with self._lock:
+                if self._store is None:
+                    embeddings = get_embeddings(self.corpus.embedding_model)
+                    self._store = open_store(
+                        lambda: Chroma(
+                            collection_name=self.corpus.collection,
+                            persist_directory=self.corpus.path,
+                            embedding_function=embeddings,
+                        ),
+                        self.corpus.mmap_path,
+                        embeddings,
+                    )
+        return self._store
+
+    def search(self, query):
+        store = self.store()
+        vector = store.embeddings.embed_query(query)
+        with span("vector_search", corpus=self.corpus.name):
+            return store.similarity_search_by_vector(vector, k=self.top_k)
+
+    async def _asearch(self, query):
+        return await run_blocking(self.search, query)
+
+    def build(self):
+        self._open()
+        retriever = RunnableLambda(self.search, afunc=self._asearch, name=f"{self.corpus.name}_retriever")
+        return (
+            {
+                "docs": retriever,
+                "question": RunnablePassthrough()
+            }
+            | RunnableLambda(lambda x: assemble_context(x["docs"], x["question"])[0], name="assemble_context")
+            | prompt.partial(title=self.corpus.title)
+            | get_llm()
+            | TracedStrOutputParser()
+        )
+
+    def unload(self):
+        with self._lock:
+            self._store = None
+
+    def _after_fork(self):
+        # Chroma's client is not fork-safe; an mmap store stays shared.
+        self._lock = threading.Lock()
+        if not isinstance(self._store, MmapVectorStore):
+            self._store = None
+
+
+_chains = {}
+_chains_lock = threading.Lock()
+
+def get_corpus_chain(name):
+    chain = _chains.get(name)
+    if chain is None:
+        with _chains_lock:
+            chain = _chains.get(name)
+            if chain is None:
+                chain = _chains[name] = CorpusChain(get_corpus(name))
+    return chain
+
+@after_fork
+def _reopen_stores():
+    for chain in _chains.values():
+        chain._after_fork()
+
+def corpus_print(name, query):
+    logger.debug("Asking %s chain: %s", name, query)
+    c = get_corpus_chain(name)
+    chain = registry.get(name)
+    return c.flight.do(query, lambda: c.cache.get_or_compute(query, lambda: chain.invoke(query)))
+
+async def acorpus_print(name, query, slot=None):
+    # slot: optional async context manager factory, entered only by the
+    # caller that actually computes the answer (see aowasp_print).
+    c = get_corpus_chain(name)
+    chain = await run_blocking(registry.get, name)
+
+    async def compute():
+        async with slot() if slot else nullcontext():
+            return await c.cache.aget_or_compute(query, lambda: chain.ainvoke(query))
+
+    return await c.flight.ado(query, compute)
+
+def cache_stats():
+    return {name: {**c.cache.stats(), "coalescing": c.flight.stats()} for name, c in _chains.items()}
@@ -0,0 +1,270 @@
+import logging
+import os
+import platform
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from telemetry import record_cache, span
+
+logger = logging.getLogger(__name__)
+
+# EMBEDDING_BACKEND selects how sentence-transformers runs the model on CPU:
+#   torch     - default PyTorch weights
+#   onnx      - ONNX Runtime export of the same weights
+#   onnx-int8 - ONNX Runtime with a dynamically quantized int8 export, using
+#               the quantization preset that matches this CPU (see _int8_model)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").lower()
+# Overrides the int8 file to load; empty picks onnx/model_qint8_<preset>.onnx.
+ONNX_INT8_FILE = os.getenv("EMBEDDING_ONNX_INT8_FILE", "")
+# Where int8 exports are written for models that do not publish one.
+ONNX_EXPORT_DIR = os.getenv("EMBEDDING_ONNX_EXPORT_DIR", "./onnx_models")
+CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "4096"))
+BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+BATCH_WAIT_MS = float(os.getenv("EMBED_BATCH_WAIT_MS", "2"))
+
+
+def _quantization_preset():
+    # optimum's dynamic-quantization presets; avx512_vnni files run poorly
+    # (or not at all) on CPUs without those instructions.
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return "arm64"
+    flags = set()
+    try:
+        with open("/proc/cpuinfo", "r", encoding="utf-8") as f:
+            flags = set(next((line for line in f if line.startswith("flags")), "").split())
+    except OSError:
+        pass
+    if "avx512_vnni" in flags:
+        return "avx512_vnni"
+    if "avx512f" in flags:
+        return "avx512"
+    return "avx2"
+
+def _published(model_name, file_name):
+    if os.path.isdir(model_name):
+        return os.path.exists(os.path.join(model_name, file_name))
+    try:
+        from huggingface_hub import file_exists, try_to_load_from_cache
+        if isinstance(try_to_load_from_cache(model_name, file_name), str):
+            return True
+        return file_exists(model_name, file_name)
+    except Exception:
+        return False
+
+def _int8_model(model_name):
+    # Returns (model_name_or_path, file_name) of an int8 ONNX export matched
+    # to this CPU, or None. Uses a published export when the model has one,
+    # otherwise quantizes once into ONNX_EXPORT_DIR.
+    preset = _quantization_preset()
+    file_name = ONNX_INT8_FILE or f"onnx/model_qint8_{preset}.onnx"
+    if _published(model_name, file_name):
+        return model_name, file_name
+
+    export_dir = os.path.join(ONNX_EXPORT_DIR, model_name.replace("/", "__"))
+    exported = f"onnx/model_qint8_{preset}.onnx"
+    if not os.path.exists(os.path.join(export_dir, exported)):
+        try:
+            from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+            model = SentenceTransformer(model_name, backend="onnx", device="cpu")
+            model.save(export_dir)
+            export_dynamic_quantized_onnx_model(model, preset, export_dir)
+        except Exception as e:
+            logger.warning("Could not quantize %s to int8 (%r)", model_name, e)
+            return None
+        logger.info("Quantized %s to %s with the %s preset", model_name, export_dir, preset)
+    return export_dir, exported
+
+def _model_args(model_name, backend):
+    # -> (model_name_or_path, HuggingFaceEmbeddings model_kwargs, backend actually used)
+    if backend == "onnx-int8":
+        found = _int8_model(model_name)
+        if found is not None:
+            path, file_name = found
+            return path, {"backend": "onnx", "model_kwargs": {"file_name": file_name}}, backend
+        logger.warning("No int8 ONNX model for %s; falling back to fp32 ONNX", model_name)
+        backend = "onnx"
+    if backend == "onnx":
+        return model_name, {"backend": "onnx"}, backend
+    return model_name, {}, backend
+
+
+class MicroBatcher:
+    # Collects embed_query calls from concurrent requests for a few
+    # milliseconds and runs them through one embed_documents call.
+    def __init__(self, embed_many, max_batch=BATCH_SIZE, max_wait_ms=BATCH_WAIT_MS):
+        self._embed_many = embed_many
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._closed = False
+        self.batches = 0
+
+    def submit(self, text):
+        future = Future()
+        # Enqueued under the lock the worker exits under, so an item is either
+        # seen by the running worker or starts a new one; never stranded.
+        # Started lazily (and restarted after fork, where threads do not survive).
+        with self._lock:
+            self._queue.put((text, future))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="embed-batcher", daemon=True)
+                self._thread.start()
+        return future.result()
+
+    def close(self):
+        # Lets the worker exit once the queue is empty, so the model it
+        # references can be freed. Late submits from holders of the old
+        # instance are still served.
+        self._closed = True
+        self._queue.put(None)
+
+    def _run(self):
+        while True:
+            try:
+                # Once closed, linger only while submits keep arriving.
+                first = self._queue.get(timeout=self.max_wait if self._closed else None)
+            except queue.Empty:
+                first = None
+            if first is None:
+                with self._lock:
+                    if self._closed and self._queue.empty():
+                        self._thread = None
+                        return
+                continue
+            batch = [first]
+            try:
+                while len(batch) < self.max_batch:
+                    item = self._queue.get(timeout=self.max_wait)
+                    if item is None:
+                        break
+                    batch.append(item)
+            except queue.Empty:
+                pass
+
+            texts = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                vectors = dict(zip(texts, self._embed_many(texts)))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            for text, future in batch:
+                future.set_result(vectors[text])
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, model_name, backend=EMBEDDING_BACKEND, cache_size=CACHE_SIZE):
+        from langchain_community.embeddings import HuggingFaceEmbeddings
+
+        self.model_name = model_name
+        path, model_kwargs, self.backend = _model_args(model_name, backend)
+        self._model = HuggingFaceEmbeddings(model_name=path, model_kwargs=model_kwargs)
+        self._cache = OrderedDict()     # text -> read-only float32 vector
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+        self._batcher = MicroBatcher(self._compute)
+        self.hits = 0
+        self.misses = 0
+
+    def _compute(self, texts):
+        vectors = np.asarray(self._model.embed_documents(texts), dtype=np.float32)
+        for vec in vectors:
+            vec.flags.writeable = False
+        return list(vectors)
+
+    def _get_cached(self, text):
+        with self._lock:
+            vec = self._cache.get(text)
+            if vec is not None:
+                self._cache.move_to_end(text)
+                self.hits += 1
+            else:
+                self.misses += 1
+        record_cache("embeddings", vec is not None)
+        return vec
+
+    def _put_cached(self, text, vec):
+        if self._cache_size <= 0:
+            return
+        with self._lock:
+            self._cache[text] = vec
+            self._cache.move_to_end(text)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+    def embed_query_array(self, text):
+        vec = self._get_cached(text)
+        if vec is None:
+            with span("embed", texts=1):
+                vec = self._batcher.submit(text)
+            self._put_cached(text, vec)
+        return vec
+
+    def embed_documents_array(self, texts):
+        vectors = [self._get_cached(t) for t in texts]
+        missing = list(dict.fromkeys(t for t, v in zip(texts, vectors) if v is None))
+        if missing:
+            with span("embed", texts=len(missing)):
+                computed = dict(zip(missing, self._compute(missing)))
+            for text, vec in computed.items():
+                self._put_cached(text, vec)
+            vectors = [v if v is not None else computed[t] for t, v in zip(texts, vectors)]
+        return vectors
+
+    # --- LangChain Embeddings interface (plain lists, as Chroma expects) ---
+
+    def embed_query(self, text):
+        return self.embed_query_array(text).tolist()
+
+    def embed_documents(self, texts):
+        return [v.tolist() for v in self.embed_documents_array(texts)]
+
+    def close(self):
+        self._batcher.close()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "model": self.model_name,
+            "backend": self.backend,
+            "entries": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "micro_batches": self._batcher.batches,
+        }
+
+
+# --- Process-wide model registry: one instance per (model, backend) ---
+
+_models = {}
+_models_lock = threading.Lock()
+
+def get_embeddings(model_name, backend=None):
+    key = (model_name, (backend or EMBEDDING_BACKEND).lower())
+    model = _models.get(key)
+    if model is None:
+        with _models_lock:
+            model = _models.get(key)
+            if model is None:
+                model = CachedEmbeddings(model_name, backend=key[1])
+                _models[key] = model
+    return model
+
+def release_embeddings(model_name):
+    # Drops every backend of this model; corpus eviction (chain_registry) calls
+    # it once no loaded corpus uses the model. Holders of the old instance keep
+    # working; the next get_embeddings loads it again.
+    with _models_lock:
+        for key in [k for k in _models if k[0] == model_name]:
+            _models.pop(key).close()
+
+def embedding_stats():
+    return [m.stats() for m in _models.values()]
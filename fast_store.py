@@ -0,0 +1,269 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import threading
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+logger = logging.getLogger(__name__)
+
+# VECTOR_BACKEND=mmap serves read-mostly collections from an exported,
+# memory-mapped matrix instead of Chroma's HNSW + SQLite layer. The OS page
+# cache backs the mapping, so every gunicorn worker shares one copy.
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma").lower()
+IVF_NPROBE = int(os.getenv("VECTOR_IVF_NPROBE", "8"))
+# Equality masks are cached only for columns with at most this many distinct
+# values (type, domain, ...) and only for values that occur, so filters on
+# ids or free text cannot grow the cache.
+MASK_CACHE_MAX_VALUES = 64
+
+
+# --- Export (Chroma -> mmap directory) ---
+
+def _kmeans(vectors, n_lists, iterations=10, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmin(_sq_l2(vectors, centroids), axis=1)
+        for c in range(n_lists):
+            members = vectors[assign == c]
+            if len(members):
+                centroids[c] = members.mean(axis=0)
+    return centroids, np.argmin(_sq_l2(vectors, centroids), axis=1).astype(np.int32)
+
+def _sq_l2(x, y):
+    return (x * x).sum(1)[:, None] - 2 * x @ y.T + (y * y).sum(1)[None, :]
+
+def export_collection(persist_dir, collection_name, out_dir, dtype="float32", ivf_lists=0):
+    import chromadb
+
+    collection = chromadb.PersistentClient(path=persist_dir).get_collection(collection_name)
+    data = collection.get(include=["embeddings", "documents", "metadatas"])
+    return write_index(out_dir, data["ids"], data["embeddings"], data["documents"], data["metadatas"],
+                       dtype=dtype, ivf_lists=ivf_lists)
+
+def write_index(out_dir, ids, embeddings, documents, metadatas, dtype="float32", ivf_lists=0):
+    vectors = np.asarray(embeddings, dtype=np.float32)
+
+    # Build next to the target and rename, so readers never see a partial export.
+    tmp = out_dir + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    np.save(os.path.join(tmp, "norms.npy"), (vectors * vectors).sum(1).astype(np.float32))
+    if dtype == "int8":
+        # Symmetric per-row quantization; scales restore magnitudes at query time.
+        scales = np.abs(vectors).max(1) / 127.0
+        scales[scales == 0] = 1.0
+        np.save(os.path.join(tmp, "vectors.npy"), np.round(vectors / scales[:, None]).astype(np.int8))
+        np.save(os.path.join(tmp, "scales.npy"), scales.astype(np.float32))
+    else:
+        np.save(os.path.join(tmp, "vectors.npy"), vectors.astype(dtype))
+
+    if ivf_lists and len(vectors) > ivf_lists:
+        centroids, assign = _kmeans(vectors, ivf_lists)
+        np.save(os.path.join(tmp, "centroids.npy"), centroids)
+        np.save(os.path.join(tmp, "assignments.npy"), assign)
+
+    # Columnar metadata sidecar: one list per key, aligned with the rows.
+    metadatas = [m or {} for m in metadatas]
+    columns = sorted({key for m in metadatas for key in m})
+    with open(os.path.join(tmp, "metadata.json"), "w", encoding="utf-8") as f:
+        json.dump({key: [m.get(key) for m in metadatas] for key in columns}, f, ensure_ascii=False)
+    with open(os.path.join(tmp, "documents.json"), "w", encoding="utf-8") as f:
+        json.dump({"ids": list(ids), "documents": list(documents)}, f, ensure_ascii=False)
+
+    if os.path.exists(out_dir):
+        old = out_dir + ".old"
+        shutil.rmtree(old, ignore_errors=True)
+        os.replace(out_dir, old)
+        os.replace(tmp, out_dir)
+        shutil.rmtree(old, ignore_errors=True)
+    else:
+        os.replace(tmp, out_dir)
+    return len(vectors)
+
+
+# --- Serving ---
+
+class MmapVectorStore(VectorStore):
+    def __init__(self, path, embedding_function, nprobe=IVF_NPROBE):
+        self.path = path
+        self._embedding = embedding_function
+        self.nprobe = nprobe
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.norms = np.load(os.path.join(path, "norms.npy"), mmap_mode="r")
+        scales = os.path.join(path, "scales.npy")
+        self.scales = np.load(scales, mmap_mode="r") if os.path.exists(scales) else None
+        centroids = os.path.join(path, "centroids.npy")
+        self.centroids = np.load(centroids) if os.path.exists(centroids) else None
+        self.assignments = np.load(os.path.join(path, "assignments.npy"), mmap_mode="r") if self.centroids is not None else None
+
+        with open(os.path.join(path, "metadata.json"), "r", encoding="utf-8") as f:
+            self.columns = json.load(f)
+        with open(os.path.join(path, "documents.json"), "r", encoding="utf-8") as f:
+            docs = json.load(f)
+        self.ids = docs["ids"]
+        self.documents = docs["documents"]
+        self._masks = {}
+        self._distinct = {}     # key -> set of values, or None if high-cardinality
+        self._mask_lock = threading.Lock()
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, "vectors.npy"))
+
+    @property
+    def embeddings(self):
+        return self._embedding
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, path=None, dtype="float32", ivf_lists=0, **kwargs):
+        # Writes a fresh index at path and serves it; the store itself is
+        # read-only, so adding texts later means writing a new index.
+        if path is None:
+            raise ValueError("MmapVectorStore.from_texts needs the path to write the index to")
+        texts = list(texts)
+        ids = list(ids) if ids is not None else [str(i) for i in range(len(texts))]
+        write_index(path, ids, embedding.embed_documents(texts), texts, metadatas or [{}] * len(texts),
+                    dtype=dtype, ivf_lists=ivf_lists)
+        return cls(path, embedding)
+
+    # --- Metadata bitmasks ---
+
+    def _column(self, key):
+        return self.columns.get(key, [None] * len(self.ids))
+
+    def _cacheable(self, key, value):
+        if key not in self._distinct:
+            try:
+                distinct = set(self._column(key))
+            except TypeError:
+                distinct = None
+            self._distinct[key] = distinct if distinct is not None and len(distinct) <= MASK_CACHE_MAX_VALUES else None
+        distinct = self._distinct[key]
+        try:
+            return distinct is not None and value in distinct
+        except TypeError:
+            return False
+
+    def _eq_mask(self, key, value):
+        cache_key = (key, json.dumps(value))
+        mask = self._masks.get(cache_key)
+        if mask is None:
+            mask = np.fromiter((v == value for v in self._column(key)), dtype=bool, count=len(self.ids))
+            if self._cacheable(key, value):
+                with self._mask_lock:
+                    self._masks[cache_key] = mask
+        return mask
+
+    def _in_mask(self, key, values):
+        # Never cached: $in lists are typically ids (see mitre lookup_ids).
+        # A set rather than np.isin, which cannot order mixed None/str columns.
+        wanted = set(values)
+        return np.fromiter((v in wanted for v in self._column(key)), dtype=bool, count=len(self.ids))
+
+    def _mask(self, where):
+        # Supports Chroma's subset used here: {k: v}, {k: {"$eq"|"$in": ...}}, {"$and"|"$or": [...]}.
+        if not where:
+            return None
+        mask = np.ones(len(self.ids), dtype=bool)
+        for key, cond in where.items():
+            if key == "$and":
+                for sub in cond:
+                    mask &= self._mask(sub)
+            elif key == "$or":
+                mask &= np.logical_or.reduce([self._mask(sub) for sub in cond])
+            elif isinstance(cond, dict) and "$in" in cond:
+                mask &= self._in_mask(key, cond["$in"])
+            elif isinstance(cond, dict) and "$eq" in cond:
+                mask &= self._eq_mask(key, cond["$eq"])
+            else:
+                mask &= self._eq_mask(key, cond)
+        return mask
+
+    # --- Search ---
+
+    def _candidates(self, query, mask):
+        rows = np.arange(len(self.ids)) if mask is None else np.flatnonzero(mask)
+        if self.centroids is not None and len(rows) > 1000:
+            probe = np.argsort(((self.centroids - query) ** 2).sum(1))[: self.nprobe]
+            rows = rows[np.isin(self.assignments[rows], probe)]
+        return rows
+
+    def _distances(self, query, rows):
+        block = np.asarray(self.vectors[rows], dtype=np.float32)
+        if self.scales is not None:
+            block *= self.scales[rows][:, None]
+        # Squared L2, the same score Chroma's default space reports.
+        return self.norms[rows] - 2.0 * (block @ query) + float(query @ query)
+
+    def _doc(self, row):
+        metadata = {key: values[row] for key, values in self.columns.items() if values[row] is not None}
+        return Document(id=self.ids[row], page_content=self.documents[row], metadata=metadata)
+
+    def similarity_search_by_vector_with_relevance_scores(self, embedding, k=4, filter=None, **kwargs):
+        query = np.asarray(embedding, dtype=np.float32)
+        rows = self._candidates(query, self._mask(filter))
+        if len(rows) == 0:
+            return []
+        dist = self._distances(query, rows)
+        top = np.argpartition(dist, min(k, len(dist) - 1))[:k]
+        top = top[np.argsort(dist[top])]
+        return [(self._doc(rows[i]), float(dist[i])) for i in top]
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_by_vector_with_relevance_scores(embedding, k, filter)]
+
+    def similarity_search_with_score(self, query, k=4, filter=None, **kwargs):
+        return self.similarity_search_by_vector_with_relevance_scores(self._embedding.embed_query(query), k, filter)
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def get(self, ids=None, where=None, include=None, **kwargs):
+        mask = self._mask(where)
+        rows = np.arange(len(self.ids)) if mask is None else np.flatnonzero(mask)
+        if ids is not None:
+            wanted = set(ids)
+            rows = [r for r in rows if self.ids[r] in wanted]
+        return {
+            "ids": [self.ids[r] for r in rows],
+            "documents": [self.documents[r] for r in rows],
+            "metadatas": [{k: v[r] for k, v in self.columns.items() if v[r] is not None} for r in rows],
+        }
+
+
+def open_store(chroma_factory, mmap_path, embedding_function):
+    # Shared selection logic for mitre_store / owasp_store / corpus_chain.
+    if VECTOR_BACKEND == "mmap":
+        if MmapVectorStore.exists(mmap_path):
+            return MmapVectorStore(mmap_path, embedding_function)
+        logger.warning("No mmap export at %s; falling back to Chroma", mmap_path)
+    return chroma_factory()
+
+
+if __name__ == "__main__":
+    from corpora import corpora
+
+    parser = argparse.ArgumentParser(description="Export a Chroma collection to a memory-mapped NumPy index.")
+    parser.add_argument("collection", choices=sorted(corpora()), help="Corpus name from corpora.json.")
+    parser.add_argument("--dtype", choices=["float32", "float16", "int8"], default="float32")
+    parser.add_argument("--ivf-lists", type=int, default=0, help="Build an IVF index with this many lists (0 = exact search).")
+    args = parser.parse_args()
+
+    corpus = corpora()[args.collection]
+    if corpus.chain == "owasp":
+        # Exported into the live build, so it swaps with it.
+        from owasp_store import current_owasp_path, mmap_path as owasp_mmap_path
+        source = current_owasp_path()
+        out = owasp_mmap_path(source)
+    else:
+        source, out = corpus.path, corpus.mmap_path
+    name = corpus.collection
+    count = export_collection(source, name, out, dtype=args.dtype, ivf_lists=args.ivf_lists)
+    print(f"🚀 Exported {count} vectors from {name} to {out}")
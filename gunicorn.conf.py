@@ -0,0 +1,40 @@
+# Production launch: gunicorn -c gunicorn.conf.py backend:app
+#
+# The master imports the app and loads the embedding models, indexes and
+# (optionally) the local LLM once; workers share them copy-on-write and
+# reopen only fork-unsafe handles (see prefork.py).
+import os
+import shutil
+import tempfile
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", "4"))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
+
+# Prometheus samples from every worker are aggregated through this
+# directory; it must be set before prometheus_client is imported.
+if not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="rag-metrics-")
+else:
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+
+def when_ready(server):
+    # Runs in the master after the app is imported and before any fork.
+    from prefork import preload
+    preload()
+    server.log.info("Models and indexes preloaded in the master")
+
+def post_fork(server, worker):
+    from prefork import configure_worker
+    threads = configure_worker(workers)
+    server.log.info(f"Worker {worker.pid}: {threads} torch thread(s)")
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
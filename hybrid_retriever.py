@@ -0,0 +1,114 @@
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter, defaultdict
+
+from langchain_core.documents import Document
+
+BM25_FILE = "bm25.json"
+# Keep hyphens/dots inside tokens so "CWE-918", "X-Frame-Options" and
+# "T1190" stay single exact terms.
+_TOKEN = re.compile(r"[a-z0-9]+(?:[-.][a-z0-9]+)*")
+
+
+def tokenize(text):
+    return _TOKEN.findall(text.lower())
+
+
+class BM25Index:
+    def __init__(self, docs, k1=1.5, b=0.75):
+        # docs: list of {"text": ..., "metadata": {...}}
+        self.docs = docs
+        self.k1 = k1
+        self.b = b
+        self._postings = defaultdict(list)   # term -> [(doc_idx, tf)]
+        self._lengths = []
+        for i, doc in enumerate(docs):
+            counts = Counter(tokenize(doc["text"]))
+            self._lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                self._postings[term].append((i, tf))
+        n = len(docs)
+        self._avgdl = (sum(self._lengths) / n) if n else 0.0
+        self._idf = {
+            term: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5))
+            for term, p in self._postings.items()
+        }
+
+    @classmethod
+    def from_documents(cls, documents):
+        return cls([{"text": d.page_content, "metadata": d.metadata} for d in documents])
+
+    def save(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"k1": self.k1, "b": self.b, "docs": self.docs}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["docs"], k1=data["k1"], b=data["b"])
+
+    def search(self, query, k=20):
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            idf = self._idf.get(term)
+            if idf is None:
+                continue
+            for i, tf in self._postings[term]:
+                norm = self.k1 * (1 - self.b + self.b * self._lengths[i] / self._avgdl)
+                scores[i] += idf * tf * (self.k1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda x: -x[1])[:k]
+        return [
+            (Document(page_content=self.docs[i]["text"], metadata=self.docs[i]["metadata"]), score)
+            for i, score in ranked
+        ]
+
+
+def reciprocal_rank_fusion(result_lists, k=60):
+    # Documents are keyed by content: the same chunk coming back from BM25
+    # and from Chroma fuses into one entry.
+    fused = {}
+    scores = defaultdict(float)
+    for results in result_lists:
+        for rank, doc in enumerate(results):
+            key = doc.page_content
+            fused.setdefault(key, doc)
+            scores[key] += 1.0 / (k + rank + 1)
+    return [fused[key] for key in sorted(scores, key=lambda key: -scores[key])]
+
+
+_rerankers = {}
+_reranker_lock = threading.Lock()
+
+def get_reranker(model_name):
+    if not model_name:
+        return None
+    if model_name not in _rerankers:
+        with _reranker_lock:
+            if model_name not in _rerankers:
+                from sentence_transformers import CrossEncoder
+                _rerankers[model_name] = CrossEncoder(model_name, device="cpu")
+    return _rerankers[model_name]
+
+def rerank(reranker, query, docs):
+    scores = reranker.predict([(query, d.page_content) for d in docs])
+    order = sorted(range(len(docs)), key=lambda i: -scores[i])
+    return [docs[i] for i in order]
+
+
+def hybrid_search(query, vectorstore, bm25, k=3, fetch_k=20, vector=None, reranker=None, rerank_n=10):
+    if vector is None:
+        dense = vectorstore.similarity_search(query, k=fetch_k)
+    else:
+        dense = vectorstore.similarity_search_by_vector(vector, k=fetch_k)
+    sparse = [doc for doc, _ in bm25.search(query, k=fetch_k)]
+
+    fused = reciprocal_rank_fusion([dense, sparse])
+    if reranker is not None:
+        fused = rerank(reranker, query, fused[:rerank_n])
+    return fused[:k]
@@ -1,13 +1,27 @@
+import argparse
+import hashlib
 import json
+import os
+import tempfile
 from collections import defaultdict
 from langchain_core.documents import Document
-from langchain_community.embeddings import HuggingFaceEmbeddings
+from embedding_service import get_embeddings
 from langchain_community.vectorstores import Chroma
+from answer_cache import stamp_collection
+from fast_store import VECTOR_BACKEND, MmapVectorStore, export_collection
+from mitre_graph import build_graph, merge_graph, read_graph, write_graph
+from mitre_store import CHROMA_PATH, COLLECTION_NAME, EMBEDDING_MODEL, GRAPH_PATH, MMAP_PATH
 
 # Configuration
 JSON_PATH = "enterprise-attack.json"
-CHROMA_PATH = "./chroma_db/mitre_attack_v5"
-COLLECTION_NAME = "mitre_enterprise_attack_v5"
+WRITE_BATCH = 500
+INDEXED_TYPES = ["attack-pattern", "course-of-action"]
+# The original non-incremental ingest read only this bundle and wrote
+# random-UUID ids with neither a bundle nor a domain recorded.
+LEGACY_DOMAIN = "enterprise-attack"
+STIX_ID_PREFIXES = tuple(f"{t}--" for t in INDEXED_TYPES)
+METADATA_PAGE = 1000
+_warned_no_ijson = False
 
 def get_external_id(obj):
     for ref in obj.get("external_references", []):
@@ -15,94 +29,319 @@ def get_external_id(obj):
             return ref.get("external_id")
     return None
 
-def main():
+def content_hash(content, meta):
+    payload = json.dumps({"content": content, "meta": meta}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def bundle_name(path):
+    return os.path.basename(path)
+
+def bundle_domain(path, obj=None):
+    # Prefer the object's own domain tag; fall back to the bundle file name
+    # ("mobile-attack.json" -> "mobile-attack").
+    domains = (obj or {}).get("x_mitre_domains") or []
+    return domains[0] if domains else os.path.splitext(os.path.basename(path))[0]
+
+
+# --- Stage 1: Streaming parser ---
+
+def iter_objects(path):
+    # ijson parses incrementally, so peak memory does not grow with bundle
+    # size. Without it we fall back to json.load (fine for small bundles).
+    global _warned_no_ijson
     try:
-        with open(JSON_PATH, "r", encoding="utf-8") as f:
-            bundle = json.load(f)
-        objects = bundle.get("objects", [])
-    except FileNotFoundError:
-        print(f"❌ Error: '{JSON_PATH}' not found.")
+        import ijson
+    except ImportError:
+        if not _warned_no_ijson:
+            print("⚠️ ijson not installed; loading whole bundles into memory.")
+            _warned_no_ijson = True
+        with open(path, "r", encoding="utf-8") as f:
+            yield from json.load(f).get("objects", [])
         return
 
-    # --- 1. Registry with Detection Data ---
-    registry = {} 
-    
-    for obj in objects:
-        if obj.get("x_mitre_deprecated") or obj.get("revoked"): continue
-        stix_id = obj.get("id")
+    with open(path, "rb") as f:
+        # use_float keeps numbers as float instead of Decimal (not JSON-serializable).
+        yield from ijson.items(f, "objects.item", use_float=True)
+
+def iter_bundles(paths):
+    for path in paths:
+        for obj in iter_objects(path):
+            yield path, obj
+
+
+# --- Stage 2: Filtering ---
+
+def is_active(obj):
+    return not (obj.get("x_mitre_deprecated") or obj.get("revoked"))
+
+def object_tactics(obj):
+    return [
+        phase.get("phase_name").replace("-", " ").lower()
+        for phase in obj.get("kill_chain_phases", [])
+        if phase.get("kill_chain_name") == "mitre-attack"
+    ]
+
+
+# --- Stage 3: Relationship resolution (first pass, compact refs only) ---
+
+def index_bundles(paths):
+    refs = {}          # stix_id -> (mitre_id, name)
+    revoked = set()
+    mitigates = []     # (mitigation stix_id, technique stix_id)
+    subtechnique_of = {}
+
+    for _, obj in iter_bundles(paths):
+        obj_type = obj.get("type")
+        if obj_type == "relationship":
+            if not is_active(obj):
+                continue
+            kind = obj.get("relationship_type")
+            if kind == "mitigates":
+                mitigates.append((obj.get("source_ref"), obj.get("target_ref")))
+            elif kind == "subtechnique-of":
+                subtechnique_of[obj.get("source_ref")] = obj.get("target_ref")
+            continue
+
+        if not is_active(obj):
+            revoked.add(obj.get("id"))
+            continue
         mitre_id = get_external_id(obj)
-        
-        if stix_id and mitre_id:
-            registry[stix_id] = {
-                "mitre_id": mitre_id,
-                "name": obj.get("name"),
-                "type": obj.get("type"),
-                "description": obj.get("description", ""),
-                # Capture Detection logic (usually a paragraph of text)
-                "detection": obj.get("x_mitre_detection", "No specific detection logic provided in STIX."),
-                "tactics": []
-            }
-
-            for phase in obj.get("kill_chain_phases", []):
-                if phase.get("kill_chain_name") == "mitre-attack":
-                    tactic = phase.get("phase_name").replace("-", " ").lower()
-                    registry[stix_id]["tactics"].append(tactic)
-
-    # --- 2. Build Hard Links ---
+        if obj.get("id") and mitre_id:
+            refs[obj["id"]] = (mitre_id, obj.get("name"))
+
+    # Relationships may precede the objects they reference, so resolve last.
     tech_mitigated_by = defaultdict(list)
     mitigation_targets = defaultdict(list)
+    for src, tgt in mitigates:
+        if src in refs and tgt in refs:
+            mitigation_targets[src].append(f"{refs[tgt][0]} {refs[tgt][1]}")
+            tech_mitigated_by[tgt].append(f"{refs[src][0]} {refs[src][1]}")
+    subtechnique_of = {s: t for s, t in subtechnique_of.items() if s in refs and t in refs}
+
+    return {
+        "refs": refs,
+        "revoked": revoked,
+        "tech_mitigated_by": tech_mitigated_by,
+        "mitigation_targets": mitigation_targets,
+        "subtechnique_of": subtechnique_of,
+    }
 
-    print("🔗 Building Relationship Graph...")
-    for obj in objects:
-        if obj.get("type") == "relationship" and obj.get("relationship_type") == "mitigates":
-            src = obj.get("source_ref")
-            tgt = obj.get("target_ref")
-            
-            if src in registry and tgt in registry:
-                src_meta = registry[src]
-                tgt_meta = registry[tgt]
-                mitigation_targets[src].append(f"{tgt_meta['mitre_id']} {tgt_meta['name']}")
-                tech_mitigated_by[tgt].append(f"{src_meta['mitre_id']} {src_meta['name']}")
-
-    # --- 3. Indexing ---
-    documents = []
-    print("📝 Indexing Objects...")
 
-    for stix_id, data in registry.items():
-        obj_type = data["type"]
-        if obj_type not in ["attack-pattern", "course-of-action"]:
+# --- Stage 4: Document building (second pass) ---
+
+class TextSpool:
+    # Description and detection text parked in a temp file until the graph is
+    # written, so memory holds one offset per object instead of its text.
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+        self._offsets = {}
+
+    def put(self, key, **fields):
+        self._file.seek(0, os.SEEK_END)
+        self._offsets[key] = self._file.tell()
+        self._file.write(json.dumps(fields, ensure_ascii=False).encode("utf-8") + b"\n")
+
+    def get(self, key):
+        self._file.seek(self._offsets[key])
+        return json.loads(self._file.readline())
+
+    def close(self):
+        self._file.close()
+
+def iter_documents(paths, index, graph_nodes, texts):
+    # Yields (stix_id, Document); also records the compact fields the graph
+    # artifact needs in graph_nodes and its text in the texts spool.
+    for path, obj in iter_bundles(paths):
+        obj_type = obj.get("type")
+        stix_id = obj.get("id")
+        if obj_type not in INDEXED_TYPES or stix_id not in index["refs"]:
             continue
 
+        mitre_id = get_external_id(obj)
+        tactics = object_tactics(obj)
+        # Capture Detection logic (usually a paragraph of text)
+        detection = obj.get("x_mitre_detection", "No specific detection logic provided in STIX.")
+        description = obj.get("description", "")
+
+        graph_nodes[stix_id] = {
+            "mitre_id": mitre_id,
+            "name": obj.get("name"),
+            "type": obj_type,
+            "tactics": tactics,
+            "aliases": obj.get("x_mitre_aliases", []),
+            "bundle": bundle_name(path),
+        }
+        texts.put(stix_id, description=description, detection=detection)
+
         meta = {
-            "mitre_id": data["mitre_id"],
-            "name": data["name"],
+            "mitre_id": mitre_id,
+            "name": obj.get("name"),
             "type": obj_type,
-            "tactics": "|||".join(data["tactics"]),
-            "linked_mitigations": "|||".join(tech_mitigated_by.get(stix_id, [])), 
-            "linked_techniques": "|||".join(mitigation_targets.get(stix_id, [])),
+            "domain": bundle_domain(path, obj),
+            "tactics": "|||".join(tactics),
+            "linked_mitigations": "|||".join(index["tech_mitigated_by"].get(stix_id, [])), 
+            "linked_techniques": "|||".join(index["mitigation_targets"].get(stix_id, [])),
             # Store full detection text in metadata for easy retrieval
-            "detection_blob": data["detection"] 
+            "detection_blob": detection 
         }
 
         content = f"""
-        ID: {data['mitre_id']}
-        Name: {data['name']}
+        ID: {mitre_id}
+        Name: {obj.get('name')}
         Type: {obj_type}
-        Description: {data['description']}
+        Description: {description}
         Tactics: {meta['tactics']}
         """
 
-        documents.append(Document(page_content=content, metadata=meta))
+        meta["content_hash"] = content_hash(content, meta)
+        # Outside the hash, so older documents without it are not re-embedded.
+        meta["bundle"] = bundle_name(path)
+        yield stix_id, Document(page_content=content, metadata=meta)
+
+
+# --- Stage 5: Incremental, batched writes ---
+
+def existing_metadata(vectorstore, page=METADATA_PAGE):
+    # id -> (content_hash, bundle, domain), read a page at a time so the
+    # full metadata (detection_blob, ...) is never held all at once.
+    existing = {}
+    offset = 0
+    while True:
+        found = vectorstore.get(include=["metadatas"], limit=page, offset=offset)
+        for doc_id, meta in zip(found["ids"], found["metadatas"]):
+            meta = meta or {}
+            existing[doc_id] = (meta.get("content_hash"), meta.get("bundle"), meta.get("domain"))
+        if len(found["ids"]) < page:
+            return existing
+        offset += page
+
+def in_scope(doc_id, bundle, domain, bundles, domains):
+    # Only documents from the bundles being ingested may be deleted. Documents
+    # written before the bundle was recorded fall back to their domain, and
+    # those from the original ingest (random-UUID ids, neither recorded)
+    # belong to the enterprise bundle.
+    if not doc_id.startswith(STIX_ID_PREFIXES) or not (bundle or domain):
+        return LEGACY_DOMAIN in domains
+    if bundle:
+        return bundle in bundles
+    return domain in domains
+
+def iter_upserts(documents, hashes, diff):
+    # Stable IDs (the STIX id) + content hashes decide what actually changed.
+    for doc_id, doc in documents:
+        if doc_id in diff["seen"]:
+            continue
+        diff["seen"].add(doc_id)
+        if doc_id not in hashes:
+            diff["added"].append(doc_id)
+        elif hashes[doc_id] != doc.metadata["content_hash"]:
+            diff["changed"].append(doc_id)
+        else:
+            diff["unchanged"] += 1
+            continue
+        yield doc_id, doc
+
+def iter_batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def print_diff(diff, revoked):
+    print("📊 Ingest diff:")
+    print(f"   ➕ added:     {len(diff['added'])}")
+    print(f"   ✏️ changed:   {len(diff['changed'])}")
+    print(f"   ⏸️ unchanged: {diff['unchanged']}")
+    print(f"   🗑️ deleted:   {len(diff['deleted'])} ({len(revoked & set(diff['deleted']))} revoked/deprecated)")
+    for label in ("added", "changed", "deleted"):
+        if diff[label]:
+            sample = ", ".join(diff[label][:5])
+            print(f"      {label}: {sample}{' ...' if len(diff[label]) > 5 else ''}")
 
-    embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+def main(paths=None, dry_run=False, batch_size=WRITE_BATCH):
+    paths = paths or [JSON_PATH]
+    missing = [p for p in paths if not os.path.exists(p)]
+    if missing:
+        print(f"❌ Error: '{missing[0]}' not found.")
+        return
+
+    # --- 1. Relationship Graph (streamed, compact) ---
+    print(f"🔗 Building Relationship Graph from {len(paths)} bundle(s)...")
+    index = index_bundles(paths)
+
+    embeddings = get_embeddings(EMBEDDING_MODEL)
     vectorstore = Chroma(
         persist_directory=CHROMA_PATH,
         embedding_function=embeddings,
         collection_name=COLLECTION_NAME
     )
-    # vectorstore.delete_collection() 
-    vectorstore.add_documents(documents)
-    print(f"🚀 Indexed {len(documents)} objects in {COLLECTION_NAME}")
+    existing = existing_metadata(vectorstore)
+    hashes = {doc_id: content for doc_id, (content, _, _) in existing.items()}
+
+    # --- 2. Streamed Indexing: build -> diff -> embed + upsert per batch ---
+    print("📝 Indexing Objects...")
+    graph_nodes = {}
+    texts = TextSpool()
+    diff = {"added": [], "changed": [], "unchanged": 0, "deleted": [], "seen": set()}
+    upserts = iter_upserts(iter_documents(paths, index, graph_nodes, texts), hashes, diff)
+    for batch in iter_batches(upserts, batch_size):
+        if not dry_run:
+            # Chroma's add_documents embeds the batch and upserts by id.
+            vectorstore.add_documents([doc for _, doc in batch], ids=[doc_id for doc_id, _ in batch])
+
+    # Anything from these bundles that is no longer in them goes: revoked or
+    # deprecated objects and random-UUID duplicates left behind by older
+    # non-incremental runs. Other bundles' documents are left alone, so one
+    # domain can be re-ingested on its own.
+    bundles = {bundle_name(p) for p in paths}
+    domains = {bundle_domain(p) for p in paths} | {
+        existing[doc_id][2] for doc_id in diff["seen"] if doc_id in existing and existing[doc_id][2]
+    }
+    diff["deleted"] = [
+        doc_id for doc_id, (_, bundle, domain) in existing.items()
+        if doc_id not in diff["seen"] and in_scope(doc_id, bundle, domain, bundles, domains)
+    ]
+    print_diff(diff, index["revoked"])
+    if dry_run:
+        texts.close()
+        print("🧪 Dry run: no changes written.")
+        return
+
+    for batch in iter_batches(diff["deleted"], batch_size):
+        vectorstore.delete(ids=batch)
+
+    # --- 3. Graph Artifact ---
+    # Precomputed adjacency so IntentRouter answers structural questions
+    # (tactic listings, mitigations, sub-techniques) without vector search.
+    graph = build_graph(graph_nodes, index["tech_mitigated_by"], index["mitigation_targets"], index["subtechnique_of"])
+    graph = merge_graph(read_graph(GRAPH_PATH), graph, bundles)
+    write_graph(graph, GRAPH_PATH, texts)
+    texts.close()
+    print(f"🕸️ Wrote graph with {len(graph['nodes'])} nodes to {GRAPH_PATH}")
+
+    changed = bool(diff["added"] or diff["changed"] or diff["deleted"])
+    if VECTOR_BACKEND == "mmap" and (changed or not MmapVectorStore.exists(MMAP_PATH)):
+        # Refresh the read-only serving copy from the updated collection.
+        count = export_collection(CHROMA_PATH, COLLECTION_NAME, MMAP_PATH)
+        print(f"🗺️ Exported {count} vectors to {MMAP_PATH}")
+
+    if not changed:
+        print(f"✅ {COLLECTION_NAME} is already up to date.")
+        return
+
+    # Invalidate cached answers built from the previous collection.
+    stamp_collection(CHROMA_PATH)
+    print(f"🚀 Upserted {len(diff['added']) + len(diff['changed'])} and deleted {len(diff['deleted'])} objects in {COLLECTION_NAME}")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Incrementally index MITRE ATT&CK STIX bundles into Chroma.")
+    parser.add_argument("bundles", nargs="*", default=[JSON_PATH],
+                        help="STIX bundle paths (enterprise, mobile, ICS, internal feeds).")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would change.")
+    parser.add_argument("--batch-size", type=int, default=WRITE_BATCH, help="Documents embedded and written per batch.")
+    args = parser.parse_args()
+    main(args.bundles, dry_run=args.dry_run, batch_size=args.batch_size)
@@ -0,0 +1,158 @@
+import argparse
+import json
+import os
+import re
+import sys
+import requests
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from answer_cache import stamp_collection
+from corpora import get_corpus
+from embedding_service import get_embeddings
+from fast_store import VECTOR_BACKEND, export_collection
+
+# NIST SP 800-53 Rev. 5 from the OSCAL catalog: one document per control and
+# control enhancement (statement + discussion), chunked and upserted into the
+# "nist" corpus declared in corpora.json.
+CORPUS = get_corpus("nist")
+SNAPSHOT_PATH = "./nist_snapshot/catalog.json"
+WRITE_BATCH = 256
+
+_PARAM = re.compile(r"\{\{\s*insert:\s*param,\s*([\w.-]+)\s*\}\}")
+
+
+# =========================
+# STAGE 1: FETCH (network -> snapshot)
+# =========================
+
+def fetch(url=CORPUS.options.get("source")):
+    print(f"📥 Fetching {url} ...")
+    resp = requests.get(url, timeout=60)
+    resp.raise_for_status()
+    os.makedirs(os.path.dirname(SNAPSHOT_PATH), exist_ok=True)
+    tmp = SNAPSHOT_PATH + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(resp.content)
+    os.replace(tmp, SNAPSHOT_PATH)
+    print(f"✅ Saved {len(resp.content) // 1024} KiB to {SNAPSHOT_PATH}")
+
+
+# =========================
+# STAGE 2: PARSE (snapshot only, works offline)
+# =========================
+
+def _prop(item, name):
+    return next((p.get("value") for p in item.get("props", []) if p.get("name") == name), None)
+
+def _param_text(param):
+    if param.get("label"):
+        return f"[Assignment: {param['label']}]"
+    choices = param.get("select", {}).get("choice")
+    if choices:
+        return "[Selection: " + "; ".join(choices) + "]"
+    return "[Assignment: organization-defined value]"
+
+def _prose(parts, name, params, depth=0):
+    # Flattens the named part and its nested items, filling parameter slots.
+    lines = []
+    for part in parts or []:
+        if depth == 0 and part.get("name") != name:
+            continue
+        label = _prop(part, "label")
+        prose = _PARAM.sub(lambda m: params.get(m.group(1), "[Assignment: organization-defined value]"), part.get("prose", ""))
+        if prose or label:
+            lines.append("  " * max(depth - 1, 0) + " ".join(x for x in (label, prose) if x))
+        lines.extend(_prose(part.get("parts"), name, params, depth + 1))
+    return lines
+
+def iter_controls(controls, family):
+    for control in controls or []:
+        if _prop(control, "status") != "withdrawn":
+            yield control, family
+        # Enhancements, e.g. AC-2(1).
+        yield from iter_controls(control.get("controls"), family)
+
+def load_snapshot(path=SNAPSHOT_PATH):
+    with open(path, "r", encoding="utf-8") as f:
+        catalog = json.load(f)["catalog"]
+
+    docs = []
+    for group in catalog.get("groups", []):
+        for control, family in iter_controls(group.get("controls"), group.get("title")):
+            control_id = _prop(control, "label") or control["id"].upper()
+            params = {p["id"]: _param_text(p) for p in control.get("params", [])}
+            statement = "\n".join(_prose(control.get("parts"), "statement", params))
+            guidance = "\n".join(_prose(control.get("parts"), "guidance", params))
+            text = f"{control_id} {control.get('title', '')}\nFamily: {family}\n\nControl:\n{statement}"
+            if guidance:
+                text += f"\n\nDiscussion:\n{guidance}"
+            docs.append(Document(page_content=text, metadata={
+                "source": f"NIST SP 800-53 {control_id}",
+                "control_id": control_id,
+                "family": family,
+                "title": control.get("title", ""),
+            }))
+    return docs
+
+def split(docs):
+    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
+    chunks = []
+    for doc in docs:
+        # Stable ids per control so re-ingests upsert in place.
+        for i, chunk in enumerate(splitter.split_documents([doc])):
+            chunks.append((f"{chunk.metadata['control_id']}#{i}", chunk))
+    return chunks
+
+
+# =========================
+# STAGE 3: EMBED + UPSERT
+# =========================
+
+def index(batch_size=64):
+    if not os.path.exists(SNAPSHOT_PATH):
+        print(f"❌ No snapshot at {SNAPSHOT_PATH}; run the fetch stage first.")
+        sys.exit(1)
+    docs = load_snapshot()
+    chunks = split(docs)
+    print(f"✅ Parsed {len(docs)} controls into {len(chunks)} chunks.")
+
+    import chromadb
+    model = get_embeddings(CORPUS.embedding_model)
+    client = chromadb.PersistentClient(path=CORPUS.path)
+    collection = client.get_or_create_collection(CORPUS.collection)
+    stale = set(collection.get(include=[])["ids"]) - {chunk_id for chunk_id, _ in chunks}
+
+    print(f"⏳ Embedding with {CORPUS.embedding_model}...")
+    step = min(batch_size, WRITE_BATCH)
+    for i in range(0, len(chunks), step):
+        batch = chunks[i:i + step]
+        collection.upsert(
+            ids=[chunk_id for chunk_id, _ in batch],
+            embeddings=model.embed_documents([d.page_content for _, d in batch]),
+            documents=[d.page_content for _, d in batch],
+            metadatas=[d.metadata for _, d in batch],
+        )
+    if stale:
+        collection.delete(ids=sorted(stale))
+        print(f"🗑️ Deleted {len(stale)} chunks no longer in the catalog")
+
+    if VECTOR_BACKEND == "mmap":
+        count = export_collection(CORPUS.path, CORPUS.collection, CORPUS.mmap_path)
+        print(f"🗺️ Exported {count} vectors to {CORPUS.mmap_path}")
+
+    # Invalidate cached answers built from the previous collection.
+    stamp_collection(CORPUS.path)
+    print(f"🎉 SUCCESS: {CORPUS.title} indexed into {CORPUS.path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch and index NIST SP 800-53 controls into Chroma.")
+    parser.add_argument("stage", nargs="?", choices=["fetch", "index", "all"], default="all",
+                        help="fetch: refresh the OSCAL catalog snapshot; index: rebuild from the snapshot offline.")
+    parser.add_argument("--batch-size", type=int, default=64, help="Texts per embedding batch.")
+    args = parser.parse_args()
+
+    if args.stage in ("fetch", "all"):
+        fetch()
+    if args.stage in ("index", "all"):
+        index(batch_size=args.batch_size)
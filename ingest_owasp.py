@@ -1,11 +1,20 @@
-import bs4
-import shutil
+import argparse
+import hashlib
+import json
 import os
+import shutil
 import sys
-from langchain_community.document_loaders import WebBaseLoader
+import time
+from concurrent.futures import ThreadPoolExecutor
+import bs4
+import requests
+from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.vectorstores import Chroma 
+from answer_cache import stamp_collection
+from embedding_service import get_embeddings
+from fast_store import VECTOR_BACKEND, export_collection
+from hybrid_retriever import BM25_FILE, BM25Index
+from owasp_store import BUILDS_DIR, COLLECTION_NAME, CURRENT_POINTER, EMBEDDING_MODEL, current_owasp_path, mmap_path
 
 # 1. CORRECT URLs
 urls = [
@@ -22,63 +31,190 @@ urls = [
     "https://owasp.org/Top10/A10_2021-Server-Side_Request_Forgery_%28SSRF%29/",
 ]
 
-print("📥 Downloading pages...")
-
-# 2. NO FILTER (Safest Approach)
-# We removed bs_kwargs to ensure we get ALL text.
-loader = WebBaseLoader(
-    web_path=urls,
-    header_template={
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-    }
-)
-docs = loader.load()
-
-# DEBUG: Check if we actually have text now
-print(f"✅ Found {len(docs)} documents.")
-if len(docs) > 0:
-    print(f"🔎 Sample content from Doc 1: {docs[1].page_content[:200]}...") 
-
-# 3. Add Metadata
-for d in docs:
-    d.metadata["source"] = "OWASP"
-
-# 4. Split Text
-splitter = RecursiveCharacterTextSplitter(
-    chunk_size=1000, 
-    chunk_overlap=100
-)
-splits = splitter.split_documents(docs)
-
-if len(splits) == 0:
-    print("❌ ERROR: Documents are still empty! The website might require JavaScript.")
-    sys.exit()
-
-print(f"✅ Created {len(splits)} text chunks.")
-
-# 5. Embeddings
-print("⏳ Loading Embedding Model...")
-embeddings = HuggingFaceEmbeddings(
-    model_name="ibm-granite/granite-embedding-107m-multilingual"
-)
-
-# 6. SAVE TO DISK
-db_path = "./chroma_db/owasp"
-
-# CLEANUP: Remove old DB to prevent corruption
-if os.path.exists(db_path):
+SNAPSHOT_DIR = "./owasp_snapshot"
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+WRITE_BATCH = 256
+KEEP_BUILDS = 2
+
+
+# =========================
+# STAGE 1: FETCH (network -> snapshot)
+# =========================
+
+def snapshot_paths(url):
+    key = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(SNAPSHOT_DIR, key + ".html"), os.path.join(SNAPSHOT_DIR, key + ".json")
+
+def _write_atomic(path, data, mode="w"):
+    tmp = path + ".tmp"
+    with open(tmp, mode, **({} if "b" in mode else {"encoding": "utf-8"})) as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def fetch_one(session, url):
+    html_path, meta_path = snapshot_paths(url)
+    meta = {}
+    if os.path.exists(meta_path) and os.path.exists(html_path):
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+
+    # Revalidate instead of re-downloading unchanged pages.
+    headers = {}
+    if meta.get("etag"): headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"): headers["If-Modified-Since"] = meta["last_modified"]
+
+    resp = session.get(url, headers=headers, timeout=30)
+    if resp.status_code == 304:
+        return url, "unchanged"
+    resp.raise_for_status()
+
+    _write_atomic(html_path, resp.content, mode="wb")
+    _write_atomic(meta_path, json.dumps({
+        "url": url,
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+        "fetched_at": int(time.time()),
+    }))
+    return url, "updated"
+
+def fetch(workers=8):
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    print(f"📥 Fetching {len(urls)} pages with {workers} workers...")
+    session = requests.Session()
+    session.headers["User-Agent"] = USER_AGENT
+
+    def safe_fetch(url):
+        try:
+            return fetch_one(session, url)
+        except requests.RequestException as e:
+            return url, f"failed ({e})"
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(safe_fetch, urls))
+    for url, status in results:
+        print(f"   {'✅' if status in ('updated', 'unchanged') else '⚠️ '} {status}: {url}")
+    return results
+
+
+# =========================
+# STAGE 2: LOAD + SPLIT (snapshot only, works offline)
+# =========================
+
+def load_snapshot():
+    docs = []
+    for url in urls:
+        html_path, _ = snapshot_paths(url)
+        if not os.path.exists(html_path):
+            print(f"⚠️  No snapshot for {url}; run the fetch stage first.")
+            continue
+        with open(html_path, "rb") as f:
+            soup = bs4.BeautifulSoup(f.read(), "html.parser")
+        title = soup.title.get_text().strip() if soup.title else url
+        # 3. Add Metadata
+        docs.append(Document(page_content=soup.get_text(), metadata={"source": "OWASP", "url": url, "title": title}))
+    return docs
+
+def split(docs):
+    # 4. Split Text
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=1000, 
+        chunk_overlap=100
+    )
+    return splitter.split_documents(docs)
+
+
+# =========================
+# STAGE 3: EMBED (optionally multi-process)
+# =========================
+
+def embed(texts, workers=1, batch_size=64):
+    if workers <= 1:
+        model = get_embeddings(EMBEDDING_MODEL)
+        vectors = []
+        for i in range(0, len(texts), batch_size):
+            vectors.extend(model.embed_documents(texts[i:i + batch_size]))
+        return vectors
+
+    # One model replica per process; sentence-transformers shards the texts.
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(EMBEDDING_MODEL, device="cpu")
+    pool = model.start_multi_process_pool(["cpu"] * workers)
     try:
-        shutil.rmtree(db_path)
-        print(f"🧹 Removed old database at {db_path}")
-    except PermissionError:
-        print("⚠️  Warning: Could not delete old DB folder. Please close any running terminals using it.")
-
-print("💾 Saving to ChromaDB...")
-vectorstore = Chroma.from_documents(
-    documents=splits,
-    embedding=embeddings,
-    collection_name="owasp",
-    persist_directory=db_path
-)
-
-print(f"🎉 SUCCESS: Database created at {db_path}")
\ No newline at end of file
+        return model.encode_multi_process(texts, pool, batch_size=batch_size).tolist()
+    finally:
+        model.stop_multi_process_pool(pool)
+
+
+# =========================
+# STAGE 4: BUILD NEW COLLECTION + ATOMIC SWAP
+# =========================
+
+def build_collection(splits, vectors):
+    import chromadb
+
+    build_path = os.path.join(BUILDS_DIR, time.strftime("%Y%m%d-%H%M%S"))
+    client = chromadb.PersistentClient(path=build_path)
+    collection = client.get_or_create_collection(COLLECTION_NAME)
+    for i in range(0, len(splits), WRITE_BATCH):
+        chunk = splits[i:i + WRITE_BATCH]
+        collection.add(
+            ids=[f"owasp-{j}" for j in range(i, i + len(chunk))],
+            embeddings=vectors[i:i + WRITE_BATCH],
+            documents=[d.page_content for d in chunk],
+            metadatas=[d.metadata for d in chunk],
+        )
+    return build_path
+
+def swap_current(build_path):
+    # The live API only ever follows the pointer, so it sees either the old
+    # index or the complete new one - never a missing or half-built one.
+    _write_atomic(CURRENT_POINTER, os.path.basename(build_path))
+
+def prune_builds(keep=KEEP_BUILDS):
+    # Keep the previous build too: processes that opened it before the swap
+    # can finish their in-flight requests.
+    builds = sorted(d for d in os.listdir(BUILDS_DIR) if os.path.isdir(os.path.join(BUILDS_DIR, d)))
+    for old in builds[:-keep]:
+        shutil.rmtree(os.path.join(BUILDS_DIR, old), ignore_errors=True)
+        print(f"🧹 Removed old build {old}")
+
+def index(workers=1, batch_size=64):
+    docs = load_snapshot()
+    print(f"✅ Loaded {len(docs)} documents from {SNAPSHOT_DIR}.")
+    splits = split(docs)
+    if len(splits) == 0:
+        print("❌ ERROR: Documents are still empty! The website might require JavaScript.")
+        sys.exit(1)
+    print(f"✅ Created {len(splits)} text chunks.")
+
+    print(f"⏳ Embedding with {workers} process(es)...")
+    vectors = embed([d.page_content for d in splits], workers=workers, batch_size=batch_size)
+
+    print("💾 Building new ChromaDB collection...")
+    os.makedirs(BUILDS_DIR, exist_ok=True)
+    build_path = build_collection(splits, vectors)
+    # Sparse index for exact terms (CWE ids, header names), swapped with the collection.
+    BM25Index.from_documents(splits).save(os.path.join(build_path, BM25_FILE))
+    if VECTOR_BACKEND == "mmap":
+        export_collection(build_path, COLLECTION_NAME, mmap_path(build_path))
+    swap_current(build_path)
+    prune_builds()
+
+    # Invalidate cached answers built from the previous collection.
+    stamp_collection(BUILDS_DIR)
+    print(f"🎉 SUCCESS: {current_owasp_path()} is now live")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch and index the OWASP Top 10 into Chroma.")
+    parser.add_argument("stage", nargs="?", choices=["fetch", "index", "all"], default="all",
+                        help="fetch: refresh the HTML snapshot; index: rebuild from the snapshot offline.")
+    parser.add_argument("--fetch-workers", type=int, default=8)
+    parser.add_argument("--embed-workers", type=int, default=1, help="Processes used for embedding.")
+    parser.add_argument("--batch-size", type=int, default=64, help="Texts per embedding batch.")
+    args = parser.parse_args()
+
+    if args.stage in ("fetch", "all"):
+        fetch(workers=args.fetch_workers)
+    if args.stage in ("index", "all"):
+        index(workers=args.embed_workers, batch_size=args.batch_size)
@@ -0,0 +1,134 @@
+import difflib
+import functools
+import re
+import threading
+
+ID_PATTERN = re.compile(r"\b([TM]\d{4}(?:\.\d{3})?)\b")
+
+# Trigger phrases per intent. Every phrase is matched on word boundaries in
+# one pass of a single compiled alternation, so "prevented by" can no longer
+# be swallowed by "prevent". Intents are listed from most to least specific.
+TRIGGERS = {
+    "mitigated_by": [r"mitigated by", r"prevented by"],
+    "defense": [
+        r"defen[cs]es? (?:for|against)", r"mitigations? for", r"how (?:to|do i|can i) (?:stop|prevent)",
+        r"protect(?:ion)? against", r"prevent(?:s|ing)?",
+    ],
+    "subtechnique": [r"sub-?techniques?"],
+    "list": [r"list"],
+}
+TACTICS = [
+    "reconnaissance", "resource development", "initial access", "execution", "persistence",
+    "privilege escalation", "defense evasion", "credential access", "discovery", "lateral movement",
+    "collection", "command and control", "exfiltration", "impact",
+]
+
+def _compile():
+    groups = [f"(?P<{kind}>{'|'.join(phrases)})" for kind, phrases in TRIGGERS.items()]
+    tactics = sorted(TACTICS, key=len, reverse=True)
+    groups.append(f"(?P<tactic>{'|'.join(re.escape(t) for t in tactics)})")
+    return re.compile(r"\b(?:" + "|".join(groups) + r")\b")
+
+MATCHER = _compile()
+_DEFENSE_PHRASES = re.compile(r"\b(?:" + "|".join(TRIGGERS["defense"]) + r")\b")
+
+
+class Classification:
+    # Result of one classifier pass over a query.
+    def __init__(self, query, ids, matches):
+        self.query = query
+        self.ids = ids
+        self.matches = matches  # {kind: first re.Match}
+
+    def has(self, kind):
+        return kind in self.matches
+
+    @property
+    def intent(self):
+        if self.has("mitigated_by"): return "mitigated_by"
+        if self.has("defense"): return "defense"
+        if self.has("subtechnique"): return "subtechnique"
+        if self.has("tactic") and self.has("list"): return "tactic_list"
+        if self.ids: return "ids"
+        return "semantic"
+
+    @property
+    def tactic(self):
+        m = self.matches.get("tactic")
+        return m.group("tactic") if m else None
+
+    @property
+    def target(self):
+        # The entity the intent is about, with the trigger phrases removed.
+        q = self.query.lower()
+        if self.intent == "mitigated_by":
+            return q[self.matches["mitigated_by"].end():].strip(" ?.")
+        if self.intent == "defense":
+            return " ".join(_DEFENSE_PHRASES.sub(" ", q).split()).strip(" ?.")
+        return None
+
+
+def classify(query):
+    matches = {}
+    for m in MATCHER.finditer(query.lower()):
+        matches.setdefault(m.lastgroup, m)
+    return Classification(query, ID_PATTERN.findall(query.upper()), matches)
+
+
+# --- Fuzzy name / alias index (no embedding) ---
+
+_PARENS = re.compile(r"\([^)]*\)")
+_NON_WORD = re.compile(r"[^a-z0-9/&+.\- ]+")
+_LEADING = re.compile(r"^(?:the|a|an)\s+")
+FUZZY_CUTOFF = 0.88
+
+def normalize_name(text):
+    text = _PARENS.sub(" ", text.lower())
+    text = _NON_WORD.sub(" ", text)
+    return _LEADING.sub("", " ".join(text.split()).strip(" ."))
+
+
+class NameIndex:
+    def __init__(self, graph):
+        self._names = {}  # type -> {normalized name or alias: mitre_id}
+        for mid, node in graph.nodes.items():
+            names = self._names.setdefault(node["type"], {})
+            keys = [node["name"], *node.get("aliases", [])]
+            if node.get("parent") and graph.get(node["parent"]):
+                # ATT&CK's own display form: "Input Capture: Keylogging".
+                keys.append(f"{graph.get(node['parent'])['name']}: {node['name']}")
+            for key in keys:
+                key = normalize_name(key)
+                # Prefer the parent technique when a name is shared.
+                if key and (key not in names or "." in names[key]):
+                    names[key] = mid
+        self._choices = {t: list(names) for t, names in self._names.items()}
+        # Routing and cache bypass both resolve the same target per request.
+        self.resolve = functools.lru_cache(maxsize=1024)(self._resolve)
+
+    def _resolve(self, text, type_filter):
+        names = self._names.get(type_filter, {})
+        key = normalize_name(text)
+        if not key:
+            return None
+        if key in names:
+            return names[key]
+        close = difflib.get_close_matches(key, self._choices.get(type_filter, []), n=1, cutoff=FUZZY_CUTOFF)
+        return names[close[0]] if close else None
+
+
+_index = None
+_index_graph = None
+_index_lock = threading.Lock()
+
+def get_name_index(graph):
+    # Rebuilt when get_graph hands back a reloaded graph.
+    global _index, _index_graph
+    if graph is None:
+        return None
+    if _index_graph is not graph:
+        with _index_lock:
+            if _index_graph is not graph:
+                _index = NameIndex(graph)
+                _index_graph = graph
+    return _index
@@ -0,0 +1,395 @@
+import abc
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+from telemetry import span
+
+# Hedged duplicates run here so a slow attempt never blocks its caller past the deadline.
+_hedge_pool = ThreadPoolExecutor(max_workers=int(os.getenv("LLM_HEDGE_WORKERS", "16")), thread_name_prefix="llm-hedge")
+# Async callers (ainvoke, astream, abatch) wait on blocking HTTP calls,
+# backoff sleeps and hedge timers here rather than in the loop's default
+# executor, which is the bounded CPU pool (concurrency.get_executor).
+_io_pool = ThreadPoolExecutor(max_workers=int(os.getenv("LLM_IO_WORKERS", "32")), thread_name_prefix="llm-io")
+
+
+class BackendError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, threshold=5, cooldown=30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            # Half-open: let one trial request through after the cooldown.
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.failures >= self.threshold:
+                    self.opened_at = time.monotonic()
+
+    @property
+    def state(self):
+        return "closed" if self.opened_at is None else "open"
+
+
+class Backend(abc.ABC):
+    name = "backend"
+    supports_stream = False
+    # Duplicate requests only help when the slow part is someone else's queue.
+    hedgeable = True
+
+    def __init__(self):
+        self.breaker = CircuitBreaker(
+            threshold=int(os.getenv("LLM_BREAKER_THRESHOLD", "5")),
+            cooldown=float(os.getenv("LLM_BREAKER_COOLDOWN", "30")),
+        )
+        self._latencies = deque(maxlen=200)
+
+    def record_latency(self, seconds):
+        self._latencies.append(seconds)
+
+    def p95(self):
+        if len(self._latencies) < 20:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    @abc.abstractmethod
+    def generate(self, prompt, timeout):
+        ...
+
+    def stream(self, prompt, timeout):
+        yield self.generate(prompt, timeout)
+
+    def stats(self):
+        p95 = self.p95()
+        return {"circuit": self.breaker.state, "failures": self.breaker.failures,
+                "p95_ms": round(p95 * 1000, 1) if p95 else None}
+
+
+def _truncate_at_stop(text, stop):
+    # Backends don't all accept stop sequences, so cut at the earliest one here.
+    cut = min((i for i in (text.find(s) for s in stop or ()) if i >= 0), default=-1)
+    return text if cut < 0 else text[:cut]
+
+
+def _session(pool_size):
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    # Keep-alive connection pool shared by every request to this backend.
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class HFEndpointBackend(Backend):
+    name = "remote"
+    supports_stream = True
+
+    def __init__(self, model_name, token=None, max_new_tokens=120):
+        super().__init__()
+        base = os.getenv("HF_ENDPOINT_URL", "https://api-inference.huggingface.co/models/{model}")
+        self.url = base.format(model=model_name)
+        self.session = _session(int(os.getenv("LLM_HTTP_POOL", "16")))
+        if token:
+            self.session.headers["Authorization"] = f"Bearer {token}"
+        self.parameters = {
+            "max_new_tokens": max_new_tokens,
+            "temperature": 0.2,
+            "top_p": 0.9,
+            "repetition_penalty": 1.1,
+            "return_full_text": False,
+        }
+
+    def generate(self, prompt, timeout):
+        resp = self.session.post(self.url, json={"inputs": prompt, "parameters": self.parameters}, timeout=timeout)
+        if resp.status_code >= 400:
+            raise BackendError(f"{self.name} HTTP {resp.status_code}: {resp.text[:200]}")
+        data = resp.json()
+        if isinstance(data, list):
+            data = data[0]
+        return data.get("generated_text", "")
+
+    def stream(self, prompt, timeout):
+        payload = {"inputs": prompt, "parameters": self.parameters, "stream": True}
+        with self.session.post(self.url, json=payload, timeout=timeout, stream=True) as resp:
+            if resp.status_code >= 400:
+                raise BackendError(f"{self.name} HTTP {resp.status_code}")
+            for line in resp.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                event = json.loads(line[5:])
+                token = event.get("token") or {}
+                if not token.get("special"):
+                    yield token.get("text", "")
+
+
+class OpenAICompatibleBackend(Backend):
+    # Local vLLM / llama.cpp / Ollama servers exposing /v1/completions.
+    name = "openai"
+    supports_stream = True
+
+    def __init__(self, base_url, model_name, api_key=None, max_new_tokens=120):
+        super().__init__()
+        self.url = base_url.rstrip("/") + "/v1/completions"
+        self.session = _session(int(os.getenv("LLM_HTTP_POOL", "16")))
+        if api_key:
+            self.session.headers["Authorization"] = f"Bearer {api_key}"
+        self.body = {"model": model_name, "max_tokens": max_new_tokens, "temperature": 0.2, "top_p": 0.9}
+
+    def generate(self, prompt, timeout):
+        resp = self.session.post(self.url, json={**self.body, "prompt": prompt}, timeout=timeout)
+        if resp.status_code >= 400:
+            raise BackendError(f"{self.name} HTTP {resp.status_code}: {resp.text[:200]}")
+        return resp.json()["choices"][0]["text"]
+
+    def stream(self, prompt, timeout):
+        payload = {**self.body, "prompt": prompt, "stream": True}
+        with self.session.post(self.url, json=payload, timeout=timeout, stream=True) as resp:
+            if resp.status_code >= 400:
+                raise BackendError(f"{self.name} HTTP {resp.status_code}")
+            for line in resp.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:") or line.strip() == "data: [DONE]":
+                    continue
+                yield json.loads(line[5:])["choices"][0].get("text", "")
+
+
+class LocalTransformersBackend(Backend):
+    name = "local"
+    # A duplicate would compete for the same CPU cores and slow both down.
+    hedgeable = False
+
+    def __init__(self, model_name):
+        super().__init__()
+        self.model_name = model_name
+
+    def generate(self, prompt, timeout):
+        # Quantized, thread-tuned, batching CPU engine (see local_engine).
+        from local_engine import get_local_engine
+        return get_local_engine(self.model_name).generate(prompt, timeout=timeout)
+
+
+class StubBackend(Backend):
+    # Deterministic, offline backend for tests and benchmarks.
+    name = "stub"
+
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+
+    def generate(self, prompt, timeout):
+        if self.latency:
+            time.sleep(self.latency)
+        question = prompt.strip().splitlines()[-1] if prompt.strip() else ""
+        return f"Stub answer for: {question[-200:]}"
+
+
+class LLMPool(LLM):
+    backends: List[Any]
+    deadline: float = 20.0
+    retries: int = 2
+    hedge: bool = True
+    hedge_floor: float = 1.5
+    backoff: float = 0.2
+    # Share of the deadline kept back for the last backend, so a primary that
+    # times out still leaves the fallback time to answer.
+    fallback_reserve: float = 0.3
+
+    @property
+    def _llm_type(self):
+        return "rag-llm-pool"
+
+    def _available(self):
+        # Asked lazily, one backend at a time: allow() hands out the single
+        # half-open trial, which must not be spent on a backend we never call.
+        tried = False
+        for backend in self.backends:
+            if backend.breaker.allow():
+                tried = True
+                yield backend
+        if not tried:
+            raise BackendError("All LLM backends are unavailable (circuits open)")
+
+    def _attempt(self, backend, prompt, remaining):
+        started = time.monotonic()
+        text = backend.generate(prompt, timeout=remaining)
+        backend.record_latency(time.monotonic() - started)
+        return text
+
+    def _hedged(self, backend, prompt, deadline_at):
+        # Fire a duplicate request once the first one runs past the backend's
+        # observed p95; whichever answers first wins.
+        remaining = deadline_at - time.monotonic()
+        futures = [_hedge_pool.submit(self._attempt, backend, prompt, remaining)]
+        hedge_after = max(self.hedge_floor, backend.p95() or self.hedge_floor)
+
+        if self.hedge and backend.hedgeable and remaining > hedge_after:
+            done, _ = wait(futures, timeout=hedge_after)
+            if not done:
+                futures.append(_hedge_pool.submit(self._attempt, backend, prompt, deadline_at - time.monotonic()))
+
+        errors = []
+        pending = set(futures)
+        while pending:
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                errors.append(future.exception())
+        if errors and not pending:
+            raise errors[-1]
+        raise TimeoutError(f"{backend.name} exceeded its share of the {self.deadline}s deadline")
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> str:
+        with span("llm") as attrs:
+            return _truncate_at_stop(self._call_backends(prompt, attrs), stop)
+
+    def _call_backends(self, prompt, attrs):
+        deadline_at = time.monotonic() + self.deadline
+        reserve = self.deadline * self.fallback_reserve
+        last_error = None
+
+        # Backends in priority order; an open circuit fails over to the next one.
+        for backend in self._available():
+            # Every backend but the last stops short of the reserved slice.
+            backend_deadline = deadline_at if backend is self.backends[-1] else deadline_at - reserve
+            for attempt in range(self.retries + 1):
+                if time.monotonic() >= backend_deadline:
+                    break
+                try:
+                    text = self._hedged(backend, prompt, backend_deadline)
+                    backend.breaker.record(True)
+                    attrs.update(backend=backend.name, attempts=attempt + 1)
+                    return text
+                except Exception as e:
+                    backend.breaker.record(False)
+                    last_error = e
+                    if attempt < self.retries:
+                        # Exponential backoff with full jitter.
+                        time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+        raise BackendError(f"LLM call failed on every backend: {last_error!r}")
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> Iterator[GenerationChunk]:
+        for backend in self.backends:
+            if not backend.supports_stream or not backend.breaker.allow():
+                continue
+            emitted = False
+            text, sent = "", 0
+            # Hold back a tail that could be the start of a stop sequence
+            # split across tokens.
+            hold = max((len(s) - 1 for s in stop or ()), default=0)
+            try:
+                with span("llm", backend=backend.name, stream=True):
+                    for token in backend.stream(prompt, timeout=self.deadline):
+                        text += token
+                        cut = _truncate_at_stop(text, stop)
+                        stopped = len(cut) < len(text)
+                        ready = cut if stopped else cut[:len(cut) - hold]
+                        if len(ready) > sent:
+                            emitted = True
+                            if run_manager:
+                                run_manager.on_llm_new_token(ready[sent:])
+                            yield GenerationChunk(text=ready[sent:])
+                            sent = len(ready)
+                        if stopped:
+                            break
+                    else:
+                        if len(text) > sent:
+                            if run_manager:
+                                run_manager.on_llm_new_token(text[sent:])
+                            yield GenerationChunk(text=text[sent:])
+                backend.breaker.record(True)
+                return
+            except Exception:
+                backend.breaker.record(False)
+                if emitted:
+                    raise
+        # No streaming backend available: fall back to one full answer.
+        yield GenerationChunk(text=self._call(prompt, stop, run_manager, **kwargs))
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> str:
+        # The context copy carries the request trace onto the I/O thread.
+        ctx = contextvars.copy_context()
+        call = functools.partial(ctx.run, self._call, prompt, stop, None, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(_io_pool, call)
+
+    async def _astream(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> AsyncIterator[GenerationChunk]:
+        # Each next() of the blocking stream runs on the I/O pool.
+        ctx = contextvars.copy_context()
+        chunks = self._stream(prompt, stop, None, **kwargs)
+        done = object()
+        pending = None
+        try:
+            while True:
+                pending = _io_pool.submit(ctx.run, next, chunks, done)
+                chunk = await asyncio.wrap_future(pending)
+                pending = None
+                if chunk is done:
+                    return
+                if run_manager:
+                    await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+        finally:
+            # Closes the HTTP stream once any in-flight next() has returned.
+            if pending is None:
+                _io_pool.submit(chunks.close)
+            else:
+                pending.add_done_callback(lambda _: _io_pool.submit(chunks.close))
+
+    def stats(self):
+        return {b.name: b.stats() for b in self.backends}
+
+
+def build_backends(names, model_name):
+    backends = []
+    for name in names:
+        name = name.strip().lower()
+        if name == "remote":
+            backends.append(HFEndpointBackend(model_name, token=os.getenv("HF_TOKEN")))
+        elif name == "openai":
+            backends.append(OpenAICompatibleBackend(
+                os.getenv("LLM_OPENAI_BASE_URL", "http://127.0.0.1:8080"),
+                os.getenv("LLM_OPENAI_MODEL", model_name),
+                api_key=os.getenv("LLM_OPENAI_API_KEY"),
+            ))
+        elif name == "local":
+            backends.append(LocalTransformersBackend(model_name))
+        elif name == "stub":
+            backends.append(StubBackend(latency=float(os.getenv("LLM_STUB_LATENCY", "0"))))
+        elif name:
+            raise ValueError(f"Unknown LLM backend '{name}'")
+    return backends
@@ -0,0 +1,262 @@
+import copy
+import logging
+import os
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+logger = logging.getLogger(__name__)
+
+# LOCAL_LLM_BACKEND:
+#   int8 - PyTorch weights with dynamic int8 quantization of Linear layers (default)
+#   fp32 - unquantized PyTorch weights
+#   onnx - ONNX Runtime export via optimum
+BACKEND = os.getenv("LOCAL_LLM_BACKEND", "int8").lower()
+MAX_NEW_TOKENS = int(os.getenv("LOCAL_LLM_MAX_NEW_TOKENS", "80"))
+MAX_BATCH = int(os.getenv("LOCAL_LLM_MAX_BATCH", "4"))
+BATCH_WAIT_MS = float(os.getenv("LOCAL_LLM_BATCH_WAIT_MS", "10"))
+# Fixed leading text of every prompt (the system instructions). Its KV cache
+# is computed once and reused. When unset, each prompt template's own prefix
+# is used: everything rendered before the context body (CONTEXT_MARKER), so
+# retrieved text never becomes part of it.
+PREFIX_TEXT = os.getenv("LOCAL_LLM_PREFIX", "")
+CONTEXT_MARKER = "Context:\n"
+MIN_PREFIX_CHARS = 100
+# One cached prefix per prompt template (OWASP, each generic corpus title).
+MAX_PREFIXES = 4
+
+
+def default_threads():
+    # Intra-op threads: one per physical core is the sweet spot for GEMM on
+    # CPU; hyper-threads mostly add contention. Inter-op: matmuls dominate,
+    # so a single inter-op thread avoids oversubscription.
+    logical = os.cpu_count() or 1
+    physical = max(1, logical // 2) if logical >= 4 else logical
+    intra = int(os.getenv("LOCAL_LLM_THREADS", str(physical)))
+    inter = int(os.getenv("LOCAL_LLM_INTEROP_THREADS", "1"))
+    return intra, inter
+
+def configure_torch_threads(intra=None, inter=None):
+    import torch
+
+    d_intra, d_inter = default_threads()
+    torch.set_num_threads(intra or d_intra)
+    try:
+        # Only allowed before any inter-op parallel work has started.
+        torch.set_num_interop_threads(inter or d_inter)
+    except RuntimeError:
+        pass
+
+
+class LocalEngine:
+    def __init__(self, model_name, backend=BACKEND, max_new_tokens=MAX_NEW_TOKENS,
+                 max_batch=MAX_BATCH, batch_wait_ms=BATCH_WAIT_MS, prefix=PREFIX_TEXT, prepare=True):
+        self.model_name = model_name
+        self.backend = backend
+        self.max_new_tokens = max_new_tokens
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait_ms / 1000.0
+        self.prefix = prefix
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+        self._prepared = False
+        self._load()
+        if prepare:
+            self.prepare()
+
+    # --- Loading ---
+
+    def _load(self):
+        import torch
+        from transformers import AutoTokenizer
+
+        configure_torch_threads()
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        self.tokenizer.pad_token = self.tokenizer.eos_token
+        # Left padding so every row of a batch ends at the generation point.
+        self.tokenizer.padding_side = "left"
+
+        self.model = None
+        if self.backend != "onnx":
+            from transformers import AutoModelForCausalLM
+
+            # Plain weights only: safe to load in a preforking master and
+            # share copy-on-write (see prefork.preload).
+            model = AutoModelForCausalLM.from_pretrained(self.model_name, torch_dtype=torch.float32)
+            model.eval()
+            self.model = model
+
+        # prefix text -> (input ids, KV cache), or None where building failed.
+        # Touched only by the generation thread.
+        self._prefixes = OrderedDict()
+
+    def prepare(self):
+        # Everything that may start torch's OpenMP or ONNX Runtime's thread
+        # pools, which do not survive fork: dynamic quantization and the ORT
+        # session. Runs in each worker after fork (prefork.configure_worker)
+        # or, failing that, on the generation thread before the first batch.
+        with self._lock:
+            if self._prepared:
+                return
+            if self.backend == "onnx":
+                import onnxruntime
+                from optimum.onnxruntime import ORTModelForCausalLM
+
+                options = onnxruntime.SessionOptions()
+                options.intra_op_num_threads, options.inter_op_num_threads = default_threads()
+                self.model = ORTModelForCausalLM.from_pretrained(
+                    self.model_name, export=True, provider="CPUExecutionProvider", session_options=options
+                )
+            elif self.backend == "int8":
+                import torch
+                self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+            self._prepared = True
+
+    def _prompt_prefix(self, prompt):
+        if self.backend == "onnx":
+            return None
+        if self.prefix:
+            return self.prefix if prompt.startswith(self.prefix) else None
+        end = prompt.find(CONTEXT_MARKER)
+        if end < 0 or end + len(CONTEXT_MARKER) < MIN_PREFIX_CHARS:
+            return None
+        # Ends at a line break, so the prefix tokenizes the same on its own.
+        return prompt[:end + len(CONTEXT_MARKER)]
+
+    def _prefix_cache(self, prefix):
+        # Built on first use by the generation thread: a forward pass starts
+        # torch's OpenMP pool, which must not happen in a preforking master.
+        if prefix in self._prefixes:
+            self._prefixes.move_to_end(prefix)
+            return self._prefixes[prefix]
+        try:
+            entry = self._build_prefix_cache(prefix)
+        except Exception as e:
+            # Prefix reuse is an optimization; plain generation still works.
+            logger.warning("Prefix KV cache disabled for this prompt template: %r", e)
+            entry = None
+        self._prefixes[prefix] = entry
+        while len(self._prefixes) > MAX_PREFIXES:
+            self._prefixes.popitem(last=False)
+        return entry
+
+    def _build_prefix_cache(self, prefix):
+        import torch
+        from transformers import DynamicCache
+
+        ids = self.tokenizer(prefix, return_tensors="pt").input_ids
+        cache = DynamicCache()
+        with torch.inference_mode():
+            self.model(input_ids=ids, past_key_values=cache, use_cache=True)
+        return ids, cache
+
+    # --- Generation ---
+
+    def _sampling_kwargs(self):
+        return dict(
+            max_new_tokens=self.max_new_tokens,
+            do_sample=True,
+            temperature=0.2,
+            top_p=0.9,
+            repetition_penalty=1.1,
+            no_repeat_ngram_size=3,
+            pad_token_id=self.tokenizer.eos_token_id,
+        )
+
+    def _generate_with_prefix(self, prompt, prefix, entry):
+        import torch
+
+        # Only the suffix after the shared prefix is new work; the prefix KV
+        # cache is copied so concurrent requests never share mutable state.
+        prefix_ids, prefix_cache = entry
+        rest = self.tokenizer(prompt[len(prefix):], return_tensors="pt", add_special_tokens=False).input_ids
+        input_ids = torch.cat([prefix_ids, rest], dim=-1)
+        with torch.inference_mode():
+            out = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=copy.deepcopy(prefix_cache),
+                **self._sampling_kwargs(),
+            )
+        return self.tokenizer.decode(out[0, input_ids.shape[-1]:], skip_special_tokens=True)
+
+    def _generate_batch(self, prompts):
+        import torch
+
+        enc = self.tokenizer(prompts, return_tensors="pt", padding=True)
+        with torch.inference_mode():
+            out = self.model.generate(**enc, **self._sampling_kwargs())
+        new_tokens = out[:, enc.input_ids.shape[-1]:]
+        return self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+
+    def _run_batch(self, prompts):
+        if len(prompts) == 1:
+            prefix = self._prompt_prefix(prompts[0])
+            entry = self._prefix_cache(prefix) if prefix else None
+            if entry is not None:
+                return [self._generate_with_prefix(prompts[0], prefix, entry)]
+        return self._generate_batch(prompts)
+
+    # --- Dynamic batching ---
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            with self._lock:
+                if self._worker is None or not self._worker.is_alive():
+                    self._worker = threading.Thread(target=self._loop, name="local-llm", daemon=True)
+                    self._worker.start()
+
+    def _loop(self):
+        # Prompts that arrive while a batch is forming (or while the previous
+        # one is generating) are decoded together in the next batch.
+        self.prepare()
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < self.max_batch:
+                    batch.append(self._queue.get(timeout=self.batch_wait))
+            except queue.Empty:
+                pass
+            # Callers that timed out cancelled their future; skip their prompts.
+            batch = [(prompt, future) for prompt, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                results = self._run_batch([prompt for prompt, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), text in zip(batch, results):
+                future.set_result(text)
+
+    def generate(self, prompt, timeout=None):
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((prompt, future))
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            # Still queued: drop it so abandoned prompts never pile up on the
+            # single generation thread. Already generating: it finishes unread.
+            future.cancel()
+            raise
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+def get_local_engine(model_name, prepare=True):
+    # prepare=False loads the weights only (prefork.preload in the master).
+    if model_name not in _engines:
+        with _engines_lock:
+            if model_name not in _engines:
+                _engines[model_name] = LocalEngine(model_name, prepare=prepare)
+    return _engines[model_name]
+
+
+def prepare_engines():
+    for engine in list(_engines.values()):
+        engine.prepare()
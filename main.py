@@ -1,36 +1,370 @@
-from asyncio.windows_events import NULL
+import argparse
+import json
 import os
-import torch
-from owasp_chain import owasp_print
-from nist_chain import nist_print
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import time
 
-# =========================
-# BASIC SETUP
-# =========================
+# Only cheap standard-library modules are imported up front: `python main.py
+# ask ...` answered by a warm daemon never loads asyncio, torch, Chroma or
+# any model. Everything heavier is imported inside the function that needs it.
+#
+#   python main.py                                   interactive menu
+#   python main.py ask "How do I prevent SQL injection?" -f owasp
+#   python main.py batch queries.txt -f mitre        JSONL on stdout
+#   python main.py daemon start|stop|status|run
+#
+# With RAG_DAEMON=auto (default) the first ask/batch starts a background
+# daemon on a Unix socket; it loads everything once and later invocations
+# only pay for the answer. RAG_DAEMON=off (or --no-daemon) answers in-process.
+RAG_DAEMON = os.getenv("RAG_DAEMON", "auto").lower()
+SOCKET_PATH = os.getenv("RAG_SOCKET") or os.path.join(
+    os.getenv("XDG_RUNTIME_DIR") or tempfile.gettempdir(), f"rag-{getattr(os, 'getuid', lambda: 0)()}.sock"
+)
+DAEMON_LOG = os.getenv("RAG_DAEMON_LOG", SOCKET_PATH + ".log")
+DAEMON_START_TIMEOUT = float(os.getenv("RAG_DAEMON_START_TIMEOUT", "300"))
+# The daemon exits after this long without requests, releasing its memory.
+DAEMON_IDLE_TIMEOUT = float(os.getenv("RAG_DAEMON_IDLE_TIMEOUT", "1800"))
+BATCH_PARALLEL = int(os.getenv("RAG_BATCH_PARALLEL", "4"))
+DEFAULT_FRAMEWORK = os.getenv("RAG_FRAMEWORK", "owasp")
+DAEMON_SUPPORTED = hasattr(socket, "AF_UNIX") and os.name != "nt"
 
-torch.set_num_threads(4)
 
+# --- Answering in this process ---
 
-def get_choice():
-    while True:
-        choice_str = input('Select one from this 1) owasp  2) nist  (anything else to quit): ').strip()
-        if not choice_str:
-            # empty input -> quit
-            return None
+def answer_sync(framework, query):
+    if framework == "owasp":
+        from owasp_chain import owasp_print
+        return owasp_print(query)
+    if framework == "mitre":
+        from chain_registry import registry
+        return registry.get("mitre").solve(query)
+    from corpora import get_corpus
+    from corpus_chain import corpus_print
+    get_corpus(framework)
+    return corpus_print(framework, query)
+
+async def answer(framework, query):
+    if framework == "owasp":
+        from owasp_chain import aowasp_print
+        return await aowasp_print(query)
+    if framework == "mitre":
+        from chain_registry import registry
+        from concurrency import run_blocking
+        router = await run_blocking(registry.get, "mitre")
+        return await router.asolve(query)
+    from corpora import get_corpus
+    from corpus_chain import acorpus_print
+    get_corpus(framework)
+    return await acorpus_print(framework, query)
+
+async def stream_batch(framework, queries, parallel=BATCH_PARALLEL):
+    # Yields one result per query as soon as it is answered (not in input
+    # order; "index" gives the line). At most `parallel` run at once.
+    import asyncio
+    from concurrency import install_default_executor
+    install_default_executor()
+    sem = asyncio.Semaphore(max(1, parallel))
+
+    async def one(index, query):
+        async with sem:
+            try:
+                return {"index": index, "query": query, "answer": await answer(framework, query)}
+            except Exception as e:
+                return {"index": index, "query": query, "error": repr(e)}
+
+    for result in asyncio.as_completed([one(i, q) for i, q in enumerate(queries)]):
+        yield await result
+
+
+# --- Daemon ---
+
+class Daemon:
+    def __init__(self, path=SOCKET_PATH, idle_timeout=DAEMON_IDLE_TIMEOUT):
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self.active = 0
+        self.served = 0
+        self.started = time.time()
+        self.last_used = time.monotonic()
+        self._stop = None
+
+    async def _send(self, writer, obj):
+        writer.write((json.dumps(obj) + "\n").encode("utf-8"))
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        # One newline-delimited JSON request per connection; one or more
+        # JSON lines back, then the connection closes.
+        self.active += 1
         try:
-            choice = int(choice_str)
-            return choice
-        except ValueError:
-            print('Please enter 1, 2, or press Enter/other key to exit.')
-
-
-a = get_choice()
-while a in (1, 2):
-    question = input('Enter the question related to selected part: ')
-    if a == 1:
-        print(owasp_print(question))
-    elif a == 2:
-        print(nist_print(question))
+            request = json.loads(await reader.readline() or b"{}")
+            op = request.get("op")
+            if op == "ping":
+                await self._send(writer, {"pid": os.getpid(), "uptime": round(time.time() - self.started), "served": self.served})
+            elif op == "stop":
+                await self._send(writer, {"stopping": True})
+                self._stop.set()
+            elif op == "ask":
+                try:
+                    await self._send(writer, {"answer": await answer(request["framework"], request["query"])})
+                except Exception as e:
+                    await self._send(writer, {"error": repr(e)})
+                self.served += 1
+            elif op == "batch":
+                async for result in stream_batch(request["framework"], request["queries"], request.get("parallel", BATCH_PARALLEL)):
+                    await self._send(writer, result)
+                    self.served += 1
+            else:
+                await self._send(writer, {"error": f"unknown op {op!r}"})
+        except (ConnectionError, json.JSONDecodeError):
+            pass
+        finally:
+            self.active -= 1
+            self.last_used = time.monotonic()
+            writer.close()
+
+    async def serve(self):
+        import asyncio
+        from concurrency import install_default_executor
+        from telemetry import configure_logging
+        configure_logging()
+        install_default_executor()
+        self._stop = asyncio.Event()
+
+        # Warm before binding: a client that can connect gets a warm answer.
+        from chain_registry import registry
+        registry.warm()
+
+        # Owner-only socket; the umask closes the window before a chmod.
+        old_umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self.handle, path=self.path)
+        finally:
+            os.umask(old_umask)
+        print(f"🟢 rag daemon {os.getpid()} listening on {self.path}", flush=True)
+
+        async with server:
+            while not self._stop.is_set():
+                try:
+                    await asyncio.wait_for(self._stop.wait(), timeout=min(30, self.idle_timeout))
+                except asyncio.TimeoutError:
+                    if not self.active and time.monotonic() - self.last_used > self.idle_timeout:
+                        print("💤 Idle timeout reached, exiting", flush=True)
+                        break
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+def run_daemon():
+    import asyncio
+    import fcntl
+    # One daemon per socket: a second one started concurrently exits here
+    # and its clients connect to the first.
+    lock = open(SOCKET_PATH + ".lock", "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print("A rag daemon is already running or starting", file=sys.stderr)
+        return
+    asyncio.run(Daemon().serve())
+
+
+# --- Daemon client ---
+
+def check_socket_owner(path=SOCKET_PATH):
+    # The /tmp fallback path is predictable: another local user could bind it
+    # first and read our questions or answer in the daemon's place.
+    st = os.stat(path)
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        raise PermissionError(f"{path} is not a socket owned by this user; refusing to use it")
+
+def daemon_request(request):
+    # Yields the daemon's response lines; OSError when none is listening or
+    # the socket belongs to someone else.
+    check_socket_owner()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(SOCKET_PATH)
+        sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        with sock.makefile("r", encoding="utf-8") as lines:
+            for line in lines:
+                yield json.loads(line)
+
+def daemon_status():
+    if not DAEMON_SUPPORTED:
+        return None
+    try:
+        return next(daemon_request({"op": "ping"}), None)
+    except OSError:
+        return None
+
+def start_daemon():
+    if daemon_status() is not None:
+        return True
+    print("⏳ Starting the rag daemon (the first run loads the models)...", file=sys.stderr)
+    with open(DAEMON_LOG, "ab") as log:
+        proc = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "daemon", "run"],
+            stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+            start_new_session=True,
+        )
+    deadline = time.monotonic() + DAEMON_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if daemon_status() is not None:
+            return True
+        if proc.poll() is not None and proc.returncode != 0:
+            print(f"⚠️ The daemon exited early; see {DAEMON_LOG}", file=sys.stderr)
+            return False
+        time.sleep(0.2)
+    print(f"⚠️ The daemon did not come up within {DAEMON_START_TIMEOUT:.0f}s; see {DAEMON_LOG}", file=sys.stderr)
+    return False
+
+def use_daemon(no_daemon=False, autostart=True):
+    if no_daemon or RAG_DAEMON == "off" or not DAEMON_SUPPORTED:
+        return False
+    if daemon_status() is not None:
+        return True
+    return autostart and start_daemon()
+
+
+# --- Commands ---
+
+def read_queries(path):
+    f = sys.stdin if path == "-" else open(path, "r", encoding="utf-8")
+    with f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+def cmd_ask(args):
+    query = " ".join(args.query)
+    if use_daemon(args.no_daemon):
+        try:
+            reply = next(daemon_request({"op": "ask", "framework": args.framework, "query": query}))
+        except (OSError, StopIteration) as e:
+            print(f"⚠️ Daemon request failed ({e!r}); answering in-process", file=sys.stderr)
+            reply = None
+        if reply is not None:
+            if "error" in reply:
+                print(reply["error"], file=sys.stderr)
+                return 1
+            print(reply["answer"])
+            return 0
+    try:
+        print(answer_sync(args.framework, query))
+    except KeyError as e:
+        print(e.args[0], file=sys.stderr)
+        return 1
+    return 0
+
+def cmd_batch(args):
+    queries = read_queries(args.file)
+    failed = 0
+
+    def emit(result):
+        nonlocal failed
+        failed += "error" in result
+        sys.stdout.write(json.dumps(result, ensure_ascii=False) + "\n")
+        sys.stdout.flush()
+
+    if use_daemon(args.no_daemon):
+        request = {"op": "batch", "framework": args.framework, "queries": queries, "parallel": args.parallel}
+        for result in daemon_request(request):
+            emit(result)
+    else:
+        import asyncio
+
+        async def run():
+            async for result in stream_batch(args.framework, queries, args.parallel):
+                emit(result)
+        asyncio.run(run())
+    return 1 if failed else 0
+
+def cmd_daemon(args):
+    if args.action == "run":
+        run_daemon()
+    elif args.action == "start":
+        return 0 if start_daemon() else 1
+    elif args.action == "stop":
+        try:
+            next(daemon_request({"op": "stop"}), None)
+            print("🛑 Stopped")
+        except OSError:
+            print("No daemon running")
+    else:
+        status = daemon_status()
+        print(json.dumps({"socket": SOCKET_PATH, "running": status is not None, **(status or {})}))
+        return 0 if status is not None else 1
+    return 0
+
+def interactive():
+    # The original menu; answers come from a running daemon when there is one.
+    frameworks = {1: "owasp", 2: "nist", 3: "mitre"}
+    daemon = use_daemon(autostart=False)
+
+    def get_choice():
+        while True:
+            choice_str = input('Select one from this 1) owasp  2) nist  3) mitre  (anything else to quit): ').strip()
+            if not choice_str:
+                # empty input -> quit
+                return None
+            try:
+                choice = int(choice_str)
+                return choice
+            except ValueError:
+                print('Please enter 1, 2, 3, or press Enter/other key to exit.')
+
     a = get_choice()
+    while a in frameworks:
+        question = input('Enter the question related to selected part: ')
+        reply = None
+        if daemon:
+            try:
+                reply = next(daemon_request({"op": "ask", "framework": frameworks[a], "query": question}))
+            except (OSError, StopIteration) as e:
+                # e.g. the daemon hit its idle timeout or was stopped meanwhile.
+                print(f"⚠️ Daemon request failed ({e!r}); answering in-process from now on")
+                daemon = False
+        if reply is not None:
+            print(reply.get("answer", reply.get("error")))
+        else:
+            print(answer_sync(frameworks[a], question))
+        a = get_choice()
+
+    print('Thank you for using the application')
+
+def main(argv=None):
+    from corpora import corpora
+    names = sorted(corpora())
+
+    parser = argparse.ArgumentParser(description="Ask the OWASP / MITRE / NIST assistants from the command line.")
+    sub = parser.add_subparsers(dest="command")
+
+    ask = sub.add_parser("ask", help="Answer one question.")
+    ask.add_argument("query", nargs="+")
+    ask.add_argument("-f", "--framework", choices=names, default=DEFAULT_FRAMEWORK)
+    ask.add_argument("--no-daemon", action="store_true", help="Answer in this process.")
+    ask.set_defaults(func=cmd_ask)
+
+    batch = sub.add_parser("batch", help="Answer one question per line; streams JSONL as answers complete.")
+    batch.add_argument("file", help="Queries file ('-' for stdin); blank and '#' lines are skipped.")
+    batch.add_argument("-f", "--framework", choices=names, default=DEFAULT_FRAMEWORK)
+    batch.add_argument("-p", "--parallel", type=int, default=BATCH_PARALLEL, help="Questions answered concurrently.")
+    batch.add_argument("--no-daemon", action="store_true", help="Answer in this process.")
+    batch.set_defaults(func=cmd_batch)
+
+    daemon = sub.add_parser("daemon", help="Manage the warm background daemon.")
+    daemon.add_argument("action", choices=["start", "stop", "status", "run"])
+    daemon.set_defaults(func=cmd_daemon)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        interactive()
+        return 0
+    return args.func(args)
+
 
-print('Thank you for using the application')
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,39 +1,263 @@
-import re
-from mitre_store import get_vectorstore 
+import asyncio
+import json
+import threading
+from contextlib import nullcontext
+from mitre_store import get_vectorstore, CHROMA_PATH, GRAPH_PATH
+from mitre_graph import get_graph
+from chain_registry import registry
+from concurrency import SingleFlight, run_blocking
+from fast_store import MmapVectorStore
+from answer_cache import AnswerCache, normalize_query
+from intent_classifier import classify, get_name_index
+from telemetry import INTENT_SECONDS, set_attribute, span
+from prefork import after_fork
 
-vectorstore = get_vectorstore()
+_vectorstore = None
+_vectorstore_lock = threading.Lock()
+
+def get_mitre_vectorstore():
+    # After an eviction the chain registry reopens the index, so the load
+    # counts against its memory budget.
+    if _vectorstore is None:
+        registry.get("mitre")
+    return _open_vectorstore()
+
+def _open_vectorstore():
+    # Opened on first use rather than at import, so importing this module is
+    # cheap and a forked worker opens its own Chroma client.
+    global _vectorstore
+    if _vectorstore is None:
+        with _vectorstore_lock:
+            if _vectorstore is None:
+                _vectorstore = get_vectorstore()
+    return _vectorstore
+
+def unload():
+    # Corpus eviction (chain_registry): the next search reopens the index.
+    global _vectorstore
+    with _vectorstore_lock:
+        _vectorstore = None
+
+@after_fork
+def _reopen_vectorstore():
+    # Chroma's client is not fork-safe; an mmap store and the embedding
+    # model it wraps stay shared (see embedding_service).
+    global _vectorstore, _vectorstore_lock
+    if not isinstance(_vectorstore, MmapVectorStore):
+        _vectorstore = None
+    _vectorstore_lock = threading.Lock()
+
+mitre_cache = AnswerCache.from_env("mitre", CHROMA_PATH, embeddings=lambda: get_mitre_vectorstore().embeddings)
+# Concurrent identical questions share one routing pass.
+mitre_flight = SingleFlight("mitre", key=normalize_query)
 
 class IntentRouter:
     def __init__(self):
         # Strict Cutoff: 1.2 (Lower is better in Chroma/L2)
         # Any semantic match worse than this is ignored unless explicitly requested.
         self.CONFIDENCE_THRESHOLD = 1.2 
+        # Candidates fetched per anchor search; the runners-up are offered as
+        # suggestions when the best one is below the cutoff.
+        self.ANCHOR_K = 3
+
+    def warm(self):
+        # Load the embedding model, vector index and graph ahead of traffic.
+        _open_vectorstore()
+        graph = get_graph(GRAPH_PATH)
+        get_name_index(graph)
+        return self
+
+    def _search(self, text, k, filter, vectors=None):
+        # Batch callers pass pre-computed embeddings so each text is embedded once.
+        vec = vectors.get(text) if vectors else None
+        if vec is None:
+            vec = get_mitre_vectorstore().embeddings.embed_query(text)
+        with span("vector_search", k=k):
+            return get_mitre_vectorstore().similarity_search_by_vector_with_relevance_scores(vec, k=k, filter=filter)
+
+    def search(self, query, k, filter=None):
+        # Scored (doc, distance) pairs, best first; also what benchmark.py grades.
+        return self._search(query, k, filter)
 
-    def search_anchor(self, query, type_filter):
-        results = vectorstore.similarity_search_with_score(query, k=1, filter={"type": type_filter})
-        if not results: return None
-        doc, score = results[0]
+    def search_anchors(self, query, type_filter, vectors=None):
+        # Top-k candidates with scores from a single search.
+        return self._search(query, self.ANCHOR_K, {"type": type_filter}, vectors)
+
+    def search_anchor(self, query, type_filter, vectors=None):
+        return self._confident(self.search_anchors(query, type_filter, vectors))
+
+    def _confident(self, candidates):
+        if not candidates: return None
+        doc, score = candidates[0]
         # Only use anchor if it's a "Good Match"
         if score > self.CONFIDENCE_THRESHOLD: return None
         return doc
 
+    def _no_anchor(self, message, candidates):
+        # Offer the nearest candidates so the next question can name one directly.
+        if not candidates: return message
+        return message + "\n   Closest matches: " + ", ".join(
+            f"[{doc.metadata.get('mitre_id')}] {doc.metadata.get('name')}" for doc, _ in candidates
+        )
+
+    def _resolve_name(self, graph, text, type_filter):
+        index = get_name_index(graph)
+        return index.resolve(text, type_filter) if index and text else None
+
+    def _graph_answerable(self, c, graph):
+        # True when the answer comes from exact keys or the name index alone.
+        if c.ids: return True
+        if c.has("mitigated_by"): return self._resolve_name(graph, c.target, "course-of-action") is not None
+        if c.has("defense"): return self._resolve_name(graph, c.target, "attack-pattern") is not None
+        return c.has("tactic") and c.has("list") and not c.has("subtechnique")
+
+    def _bypass_cache(self, query):
+        # With the graph loaded, ID and known-name questions resolve in
+        # microseconds; the cache would only add a query embedding in front.
+        graph = get_graph(GRAPH_PATH)
+        return graph is not None and self._graph_answerable(classify(query), graph)
+
+    def _cached_solve(self, query, vectors=None):
+        if self._bypass_cache(query):
+            return self._solve(query, vectors)
+        vector = vectors.get(query) if vectors else None
+        return mitre_cache.get_or_compute(query, lambda: self._solve(query, vectors), vector=vector)
+
     def solve(self, query):
+        return mitre_flight.do(query, lambda: self._cached_solve(query))
+
+    # ---------------------------------------------------------
+    # Exact-key record lookup (no embedding)
+    # ---------------------------------------------------------
+    def lookup_ids(self, ids):
+        ids = list(dict.fromkeys(i.upper() for i in ids))
+        graph = get_graph(GRAPH_PATH)
+        records = {}
+        if graph:
+            for mid in ids:
+                node = graph.get(mid)
+                if node:
+                    records[mid] = {
+                        "mitre_id": mid,
+                        "name": node["name"],
+                        "type": node["type"],
+                        "tactics": node["tactics"],
+                        "description": node["description"],
+                        "detection": node["detection"],
+                        "mitigations": [graph.label(m) for m in node["mitigations"]],
+                        "techniques": [graph.label(t) for t in node["techniques"]],
+                        "parent": graph.label(node["parent"]) if node["parent"] else None,
+                        "subtechniques": [graph.label(s) for s in node["subtechniques"]],
+                    }
+
+        # Fallback: metadata-only Chroma get by key, still without embedding.
+        missing = [mid for mid in ids if mid not in records]
+        if missing:
+            found = get_mitre_vectorstore().get(where={"mitre_id": {"$in": missing}}, include=["metadatas", "documents"])
+            for meta, content in zip(found["metadatas"], found["documents"]):
+                mid = meta.get("mitre_id")
+                records.setdefault(mid, {
+                    "mitre_id": mid,
+                    "name": meta.get("name"),
+                    "type": meta.get("type"),
+                    "tactics": [t for t in meta.get("tactics", "").split("|||") if t],
+                    "description": content.strip(),
+                    "detection": meta.get("detection_blob"),
+                    "mitigations": [l for l in meta.get("linked_mitigations", "").split("|||") if l],
+                    "techniques": [l for l in meta.get("linked_techniques", "").split("|||") if l],
+                    "parent": None,
+                    "subtechniques": [],
+                })
+
+        return [records[mid] for mid in ids if mid in records]
+
+    def _format_record(self, r):
+        lines = [f"📄 {r['mitre_id']} - {r['name']} ({r['type']})"]
+        if r["tactics"]: lines.append(f"   Tactics: {', '.join(r['tactics'])}")
+        if r["parent"]: lines.append(f"   Parent: {r['parent']}")
+        if r["subtechniques"]: lines.append(f"   Sub-techniques: {', '.join(r['subtechniques'])}")
+        description = r["description"] or ""
+        if len(description) > 300: description = description[:300] + "..."
+        if description: lines.append(f"   {description}")
+        if r["mitigations"]:
+            lines.append("🛡️ Mitigations:\n" + "\n".join([f"   🔒 {m}" for m in r["mitigations"]]))
+        if r["techniques"]:
+            lines.append("⚔️ Mitigates:\n" + "\n".join([f"   🔻 {t}" for t in r["techniques"]]))
+        if r["type"] == "attack-pattern" and r["detection"]:
+            lines.append(f"👁️ Detection:\n   {r['detection']}")
+        return "\n".join(lines)
+
+    def _solve(self, query, vectors=None):
+        # One compiled pass finds every trigger phrase, tactic and ID.
+        c = classify(query)
+        set_attribute("intent", c.intent)
+        with span("route", intent=c.intent), INTENT_SECONDS.labels(c.intent).time():
+            return self._route(query, c, vectors)
+
+    def _route(self, query, c, vectors=None):
         q = query.lower()
+        graph = get_graph(GRAPH_PATH)
+        ids = c.ids
 
         # ---------------------------------------------------------
-        # INTENT 1: "Defenses for [Technique]" (Separation Update)
+        # INTENT 2: "Techniques mitigated by [Mitigation]"
+        # (checked first: "prevented by" also contains "prevent")
         # ---------------------------------------------------------
-        if any(x in q for x in ["defenses for", "mitigation for", "how to stop", "prevent"]):
-            target = q.replace("defenses for", "").replace("mitigation for", "").replace("how to stop", "").replace("prevent", "").strip()
-            
-            doc = self.search_anchor(target, "attack-pattern")
-            if not doc: return f"❓ Could not identify a technique for '{target}' (Low Confidence)."
-            
-            mid = doc.metadata.get("mitre_id")
-            name = doc.metadata.get("name")
+        if c.has("mitigated_by"):
+            target = c.target
+
+            # Graph first: explicit M-ID, then mitigation name or alias.
+            mit_id = next((i for i in ids if i.startswith("M")), None)
+            if graph and not (mit_id and graph.get(mit_id)):
+                mit_id = self._resolve_name(graph, target, "course-of-action")
+
+            if graph and mit_id and graph.get(mit_id):
+                name = graph.get(mit_id)["name"]
+                links = [graph.label(t) for t in graph.techniques_mitigated_by(mit_id)]
+            else:
+                candidates = self.search_anchors(target, "course-of-action", vectors)
+                doc = self._confident(candidates)
+                if not doc: return self._no_anchor(f"❓ Could not identify mitigation '{target}'.", candidates)
+                name = doc.metadata.get("name")
+                mid = doc.metadata.get("mitre_id")
+                if graph and graph.get(mid):
+                    links = [graph.label(t) for t in graph.techniques_mitigated_by(mid)]
+                else:
+                    links = doc.metadata.get("linked_techniques", "").split("|||")
+
+            if not links or not links[0]: return f"ℹ️ {name} has no mapped techniques."
             
+            return f"⚔️ Techniques mitigated by {name}:\n" + "\n".join([f"   🔻 {l}" for l in links])
+
+        # ---------------------------------------------------------
+        # INTENT 1: "Defenses for [Technique]" (Separation Update)
+        # ---------------------------------------------------------
+        if c.has("defense"):
+            target = c.target
+            # An explicit technique ID, then a known name, resolves straight from the graph.
+            tech_id = next((i for i in ids if i.startswith("T")), None)
+            if graph and not (tech_id and graph.get(tech_id)):
+                tech_id = self._resolve_name(graph, target, "attack-pattern")
+            node = graph.get(tech_id) if graph and tech_id else None
+            if node:
+                mid, name = tech_id, node["name"]
+                links = [graph.label(m) for m in node["mitigations"]]
+                detection_text = node["detection"]
+            else:
+                candidates = self.search_anchors(target, "attack-pattern", vectors)
+                doc = self._confident(candidates)
+                if not doc:
+                    return self._no_anchor(f"❓ Could not identify a technique for '{target}' (Low Confidence).", candidates)
+
+                mid = doc.metadata.get("mitre_id")
+                name = doc.metadata.get("name")
+                if graph and graph.get(mid):
+                    links = [graph.label(m) for m in graph.mitigations_for(mid)]
+                else:
+                    links = doc.metadata.get("linked_mitigations", "").split("|||")
+                detection_text = doc.metadata.get("detection_blob", "No detection logic available.")
+
             # Section A: Prevention / Hardening (M-IDs)
-            links = doc.metadata.get("linked_mitigations", "").split("|||")
             mitigation_section = []
             if links and links[0]:
                 for link in links:
@@ -44,7 +268,6 @@ class IntentRouter:
                 mitigation_section.append("   ⚠️ No specific M-IDs listed.")
 
             # Section B: Detection (The Detection Blob)
-            detection_text = doc.metadata.get("detection_blob", "No detection logic available.")
             # Truncate if massive
             if len(detection_text) > 300: detection_text = detection_text[:300] + "..."
 
@@ -55,34 +278,32 @@ class IntentRouter:
             )
 
         # ---------------------------------------------------------
-        # INTENT 2: "Techniques mitigated by [Mitigation]"
+        # INTENT 2b: Parent / Sub-technique questions (graph only)
         # ---------------------------------------------------------
-        if "mitigated by" in q or "prevented by" in q:
-            target = q.split("by")[-1].strip()
-            doc = self.search_anchor(target, "course-of-action")
-            if not doc: return f"❓ Could not identify mitigation '{target}'."
-            
-            links = doc.metadata.get("linked_techniques", "").split("|||")
-            if not links or not links[0]: return f"ℹ️ {doc.metadata.get('name')} has no mapped techniques."
-            
-            return f"⚔️ Techniques mitigated by {doc.metadata.get('name')}:\n" + "\n".join([f"   🔻 {l}" for l in links])
+        if graph and c.has("subtechnique"):
+            answer = self._subtechnique_answer(graph, q, ids, vectors)
+            if answer: return answer
 
         # ---------------------------------------------------------
         # INTENT 3: "List techniques under [Tactic]" (Dominance Update)
         # ---------------------------------------------------------
-        tactic_map = [
-            "credential access", "execution", "persistence", "privilege escalation", 
-            "defense evasion", "discovery", "lateral movement", "collection", 
-            "command and control", "exfiltration", "impact", "initial access"
-        ]
-        found_tactic = next((t for t in tactic_map if t in q), None)
+        found_tactic = c.tactic
         
-        if found_tactic and "list" in q:
+        if found_tactic and c.has("list") and graph:
+            # Complete listing straight from the tactic index.
+            mids = graph.techniques_for_tactic(found_tactic)
+            if not mids: return f"⚠️ No techniques found explicitly tagged with '{found_tactic}'."
+            return (
+                f"📂 Techniques under '{found_tactic.title()}' ({len(mids)}):\n"
+                + "\n".join([f"   🔸 [{m}] {graph.get(m)['name']}" for m in mids])
+            )
+
+        if found_tactic and c.has("list"):
             # We fetch many, but strictly filter
-            results = vectorstore.similarity_search(found_tactic, k=100, filter={"type": "attack-pattern"})
+            results = self._search(found_tactic, 100, {"type": "attack-pattern"}, vectors)
             valid_hits = []
             
-            for doc in results:
+            for doc, _ in results:
                 # STRICT DOMINANCE CHECK: The tactic MUST be in the metadata list
                 doc_tactics = doc.metadata.get("tactics", "").split("|||")
                 if found_tactic in doc_tactics:
@@ -94,16 +315,15 @@ class IntentRouter:
         # ---------------------------------------------------------
         # INTENT 4: ID Lookup
         # ---------------------------------------------------------
-        id_match = re.search(r"\b([TM]\d{4}(?:\.\d{3})?)\b", query.upper())
-        if id_match:
-            results = vectorstore.similarity_search(query, k=1, filter={"mitre_id": id_match.group(1)})
-            if results:
-                return f"📄 {results[0].metadata.get('mitre_id')} - {results[0].metadata.get('name')}\n   {results[0].page_content[:200]}..."
+        if ids:
+            records = self.lookup_ids(ids)
+            if records:
+                return "\n\n".join(self._format_record(r) for r in records)
 
         # ---------------------------------------------------------
         # DEFAULT: Semantic Search (Capping Update)
         # ---------------------------------------------------------
-        results = vectorstore.similarity_search_with_score(query, k=3, filter={"type": "attack-pattern"})
+        results = self._search(query, 3, {"type": "attack-pattern"}, vectors)
         
         # Filter out bad scores
         good_matches = [
@@ -117,53 +337,99 @@ class IntentRouter:
             
         return "🔎 Semantic Matches:\n" + "\n".join(good_matches)
 
+    def _subtechnique_answer(self, graph, q, ids, vectors):
+        techs = [i for i in ids if i.startswith("T") and graph.get(i)]
+
+        # "Is T1003.001 a sub-technique of OS Credential Dumping (T1003)?"
+        subs = [i for i in techs if "." in i]
+        if q.startswith("is") and subs:
+            child = subs[0]
+            parent = graph.parent(child)
+            claimed = next((i for i in techs if "." not in i), None)
+            claimed_name = q.split(" of ", 1)[1].strip(" ?.") if " of " in q else ""
+            if claimed is None and claimed_name:
+                claimed = self._resolve_name(graph, claimed_name, "attack-pattern")
+            if parent is None:
+                return f"ℹ️ {graph.label(child)} has no parent technique."
+            if claimed is None:
+                # No verdict on a parent we could not identify; state the real one.
+                prefix = f"ℹ️ '{claimed_name}' is not a recognized technique. " if claimed_name else "ℹ️ "
+                return f"{prefix}{graph.label(child)} is a sub-technique of {graph.label(parent)}."
+            verdict = "✅ Yes" if claimed == parent else "❌ No"
+            return f"{verdict}: {graph.label(child)} is a sub-technique of {graph.label(parent)}."
+
+        # "List sub-techniques of OS Credential Dumping (T1003)"
+        if techs:
+            parent = techs[0].split(".")[0]
+        else:
+            name = q.split(" of ", 1)[-1].split("(")[0].strip(" ?.")
+            parent = self._resolve_name(graph, name, "attack-pattern")
+            if parent is None:
+                doc = self.search_anchor(name, "attack-pattern", vectors)
+                if not doc: return None
+                parent = doc.metadata.get("mitre_id").split(".")[0]
+
+        children = graph.subtechniques(parent)
+        if not children: return f"ℹ️ {graph.label(parent)} has no sub-techniques."
+        return f"🌿 Sub-techniques of {graph.label(parent)}:\n" + "\n".join([f"   🔹 {graph.label(c)}" for c in children])
+
+    async def asolve(self, query, slot=None):
+        # slot: optional async context manager factory, entered only by the
+        # caller that computes; coalesced callers just wait for its answer.
+        async def compute():
+            async with slot() if slot else nullcontext():
+                # Routing is embedding + Chroma bound, so run it on the bounded pool.
+                return await run_blocking(self._cached_solve, query)
+
+        return await mitre_flight.ado(query, compute)
+
+    def _embed_batch(self, queries):
+        # One embed_documents call for every text the batch will search with.
+        texts = list(dict.fromkeys(q for q in queries if not self._bypass_cache(q)))
+        graph = get_graph(GRAPH_PATH)
+        for query in queries:
+            c = classify(query)
+            type_filter = "course-of-action" if c.has("mitigated_by") else "attack-pattern"
+            target = c.target
+            # Targets the name index resolves never reach vector search.
+            if target and target not in texts and not self._resolve_name(graph, target, type_filter):
+                texts.append(target)
+        return dict(zip(texts, get_mitre_vectorstore().embeddings.embed_documents(texts)))
+
+    def _solve_one(self, query, vectors):
+        try:
+            answer = mitre_flight.do(query, lambda: self._cached_solve(query, vectors))
+            return {"query": query, "answer": answer}
+        except Exception as e:
+            return {"query": query, "error": repr(e)}
+
+    def solve_batch(self, queries):
+        vectors = self._embed_batch(queries)
+        return [self._solve_one(q, vectors) for q in queries]
+
+    async def _asolve_one(self, query, vectors):
+        # Coalesces on the loop, never in an executor thread, so a batch
+        # sharing a question with /mitre traffic cannot tie up the pool.
+        async def compute():
+            return await run_blocking(self._cached_solve, query, vectors)
+
+        try:
+            return {"query": query, "answer": await mitre_flight.ado(query, compute)}
+        except Exception as e:
+            return {"query": query, "error": repr(e)}
+
+    async def asolve_batch(self, queries):
+        vectors = await run_blocking(self._embed_batch, queries)
+        # Searches fan out over the bounded executor; gather keeps input order.
+        return await asyncio.gather(*(self._asolve_one(q, vectors) for q in queries))
+
 router = IntentRouter()
 
 if __name__ == "__main__":
-    queries = [
-    "Defenses for Keylogging",
-    "What mitigations apply to T1056.001 (Keylogging)?",
-    "Defenses for GUI Input Capture (T1056.002)",
-    "Mitigations for Web Portal Capture (T1056.003)",
-    "Does Credential Access Protection (M1043) mitigate Keylogging?",
-    "Is Keylogging (T1056.001) primarily Credential Access or Collection?",
-
-    "Techniques mitigated by Privileged Process Integrity",
-    "Which techniques are mitigated by Credential Access Protection (M1043)?",
-    "Which techniques are mitigated by Privileged Account Management (M1026)?",
-    "Which techniques are mitigated by Audit (M1047)?",
-
-    "List techniques under Credential Access",
-    "List sub-techniques of OS Credential Dumping (T1003)",
-    "Is T1003.001 a sub-technique of OS Credential Dumping?",
-    "Should parent techniques be listed when sub-techniques are present?",
-
-    "How do adversaries avoid detection?",
-    "Is OS Credential Dumping (T1003) ever considered Collection?",
-    "Is Modify Authentication Process (T1556) Credential Access or Defense Evasion?",
-    "Is Input Capture (T1056) ever considered Collection?",
-    "Which techniques belong to both Credential Access and Defense Evasion?",
-
-    "An attacker installs a malicious SSP DLL. Which ATT&CK techniques apply?",
-    "An attacker dumps LSASS using a signed driver. Which ATT&CK techniques apply?",
-    "An attacker captures credentials via a fake login page. Which ATT&CK techniques apply?",
-    "An attacker modifies authentication packages to bypass MFA. Which ATT&CK techniques apply?",
-    "An attacker uses stolen credentials without dumping them. Which ATT&CK techniques apply?",
-
-    "Which mitigation directly prevents Credential Stuffing (T1110.004)?",
-    "Which mitigations detect Credential Stuffing but do not prevent it?",
-    "Is Audit (M1047) a prevention or detection control?",
-    "Which mitigations reduce blast radius rather than stop attacks?",
-
-    "Is SSL/TLS Inspection (M1020) a mitigation for Credential Access?",
-    "Which Credential Access techniques lack explicit mitigations in ATT&CK?",
-    "Does Input Capture always imply Credential Access?",
-    "Is Credential Stuffing possible without prior Credential Access?",
-    "Can OS Credential Dumping occur without LSASS?"
-]
+    # The query set lives in benchmark_queries.json (see benchmark.py for timing and scoring).
+    with open("benchmark_queries.json", "r", encoding="utf-8") as f:
+        queries = [case["query"] for case in json.load(f)["mitre"]]
 
     for q in queries:
         print(f"\n❓ QUERY: {q}")
         print(router.solve(q))
-
-
@@ -0,0 +1,176 @@
+import json
+import os
+import threading
+from collections import defaultdict
+
+GRAPH_TYPES = ("attack-pattern", "course-of-action")
+
+
+# --- Build (ingest side) ---
+
+def _ids(entries):
+    # Link lists hold "M1043 Credential Access Protection"; keep the ID only.
+    return sorted({e.split(" ", 1)[0] for e in entries})
+
+def build_graph(registry, tech_mitigated_by, mitigation_targets, subtechnique_of):
+    # registry holds compact per-object fields only; description and detection
+    # text stay in the ingest's spool and are resolved by write_graph via
+    # "text_ref" one node at a time.
+    nodes = {}
+    for stix_id, data in registry.items():
+        if data["type"] not in GRAPH_TYPES:
+            continue
+        parent = subtechnique_of.get(stix_id)
+        node = {
+            "name": data["name"],
+            "type": data["type"],
+            "tactics": data["tactics"],
+            "aliases": [a for a in data.get("aliases", []) if a != data["name"]],
+            "text_ref": stix_id,
+            # Source bundles, so a partial re-ingest only replaces its own nodes.
+            "bundles": [data["bundle"]],
+            "mitigations": _ids(tech_mitigated_by.get(stix_id, [])),
+            "techniques": _ids(mitigation_targets.get(stix_id, [])),
+            "parent": registry[parent]["mitre_id"] if parent in registry else None,
+        }
+
+        # The same ATT&CK ID can appear in several domain bundles; merge links.
+        existing = nodes.get(data["mitre_id"])
+        if existing:
+            for field in ("tactics", "aliases", "bundles", "mitigations", "techniques"):
+                existing[field] = sorted(set(existing[field]) | set(node[field]))
+            existing["parent"] = existing["parent"] or node["parent"]
+        else:
+            nodes[data["mitre_id"]] = node
+
+    _link_subtechniques(nodes)
+    return {"format": 2, "nodes": nodes}
+
+def _link_subtechniques(nodes):
+    for mid, node in nodes.items():
+        node["subtechniques"] = []
+    for mid, node in nodes.items():
+        if node["parent"] in nodes:
+            nodes[node["parent"]]["subtechniques"].append(mid)
+    for node in nodes.values():
+        node["subtechniques"].sort()
+
+def merge_graph(existing, graph, bundles):
+    # graph was built from `bundles` only: keep the existing nodes that come
+    # from other bundles. A format 1 graph records no bundles and is replaced.
+    if not existing or existing.get("format", 1) < 2:
+        return graph
+    nodes = {}
+    for mid, node in existing["nodes"].items():
+        kept = sorted(set(node.get("bundles", [])) - set(bundles))
+        if kept:
+            nodes[mid] = {**node, "bundles": kept}
+    for mid, node in graph["nodes"].items():
+        old = nodes.get(mid)
+        if old:
+            for field in ("tactics", "aliases", "bundles", "mitigations", "techniques"):
+                node[field] = sorted(set(old[field]) | set(node[field]))
+            node["parent"] = node["parent"] or old["parent"]
+        nodes[mid] = node
+    _link_subtechniques(nodes)
+    return {"format": 2, "nodes": nodes}
+
+def read_graph(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def write_graph(graph, path, texts=None):
+    # Streams one node at a time, pulling description/detection for
+    # "text_ref" nodes from `texts` (key -> dict), so the text of the whole
+    # corpus is never in memory at once. Write then rename so a running API
+    # never reads a half-written file.
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write('{"format":%d,"nodes":{' % graph["format"])
+        for i, (mid, node) in enumerate(graph["nodes"].items()):
+            ref = node.get("text_ref")
+            if ref is not None:
+                node = {k: v for k, v in node.items() if k != "text_ref"}
+                node.update(texts.get(ref))
+            f.write(("," if i else "") + json.dumps(mid) + ":")
+            json.dump(node, f, separators=(",", ":"), ensure_ascii=False)
+        f.write("}}")
+    os.replace(tmp, path)
+
+
+# --- Query (serving side) ---
+
+class AttackGraph:
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self._by_name = {}
+        self._by_tactic = defaultdict(list)
+        for mid, node in nodes.items():
+            self._by_name.setdefault(node["name"].lower(), mid)
+            for tactic in node["tactics"]:
+                self._by_tactic[tactic].append(mid)
+        for mids in self._by_tactic.values():
+            mids.sort()
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f)["nodes"])
+
+    def get(self, mitre_id):
+        return self.nodes.get(mitre_id.upper())
+
+    def label(self, mitre_id):
+        node = self.nodes.get(mitre_id)
+        return f"{mitre_id} {node['name']}" if node else mitre_id
+
+    def find_name(self, name, type_filter=None):
+        mid = self._by_name.get(name.strip().lower())
+        if mid and (type_filter is None or self.nodes[mid]["type"] == type_filter):
+            return mid
+        return None
+
+    def tactics(self):
+        return list(self._by_tactic)
+
+    def techniques_for_tactic(self, tactic):
+        return self._by_tactic.get(tactic, [])
+
+    def mitigations_for(self, mitre_id):
+        node = self.get(mitre_id)
+        return node["mitigations"] if node else []
+
+    def techniques_mitigated_by(self, mitre_id):
+        node = self.get(mitre_id)
+        return node["techniques"] if node else []
+
+    def subtechniques(self, mitre_id):
+        node = self.get(mitre_id)
+        return node["subtechniques"] if node else []
+
+    def parent(self, mitre_id):
+        node = self.get(mitre_id)
+        return node["parent"] if node else None
+
+
+_graph = None
+_graph_mtime = None
+_graph_lock = threading.Lock()
+
+def get_graph(path):
+    # Returns None when the artifact has not been built yet; callers fall back
+    # to vector search. Reloads when a re-ingest replaces the file.
+    global _graph, _graph_mtime
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return _graph
+    if mtime != _graph_mtime:
+        with _graph_lock:
+            if mtime != _graph_mtime:
+                _graph = AttackGraph.load(path)
+                _graph_mtime = mtime
+    return _graph
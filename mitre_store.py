@@ -1,17 +1,27 @@
-from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_community.vectorstores import Chroma
+from embedding_service import get_embeddings
+from corpora import get_corpus
+from fast_store import open_store
 
-CHROMA_PATH = "./chroma_db/mitre_attack_v5" # Bumped to v5 to ensure clean slate
-COLLECTION_NAME = "mitre_enterprise_attack_v5"
+# Declared as the "mitre" corpus in corpora.json (v5 paths for a clean slate).
+CORPUS = get_corpus("mitre")
+CHROMA_PATH = CORPUS.path
+COLLECTION_NAME = CORPUS.collection
+EMBEDDING_MODEL = CORPUS.embedding_model
+GRAPH_PATH = CORPUS.options.get("graph_path", "./chroma_db/mitre_graph_v5.json")
+# Read-only export served when VECTOR_BACKEND=mmap (python fast_store.py mitre).
+MMAP_PATH = CORPUS.mmap_path
 
 def get_vectorstore():
-    embeddings = HuggingFaceEmbeddings(
-        model_name="sentence-transformers/all-MiniLM-L6-v2"
-    )
+    # Shared, cached model instance (see embedding_service).
+    embeddings = get_embeddings(EMBEDDING_MODEL)
     
-    vectorstore = Chroma(
-        persist_directory=CHROMA_PATH,
-        embedding_function=embeddings,
-        collection_name=COLLECTION_NAME
-    )
-    return vectorstore
\ No newline at end of file
+    return open_store(
+        lambda: Chroma(
+            persist_directory=CHROMA_PATH,
+            embedding_function=embeddings,
+            collection_name=COLLECTION_NAME
+        ),
+        MMAP_PATH,
+        embeddings,
+    )
\ No newline at end of file
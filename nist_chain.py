@@ -0,0 +1,11 @@
+from corpus_chain import acorpus_print, corpus_print
+
+# NIST SP 800-53 controls: the "nist" corpus in corpora.json, indexed by
+# ingest_nist.py and answered by the generic corpus chain.
+CORPUS_NAME = "nist"
+
+def nist_print(query):
+    return corpus_print(CORPUS_NAME, query)
+
+async def anist_print(query, slot=None):
+    return await acorpus_print(CORPUS_NAME, query, slot=slot)
@@ -1,8 +1,20 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import nullcontext
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
-from rag_components import format_docs, get_llm
-from owasp_store import get_owasp_retriever
+from rag_components import get_llm
+from context_builder import build_context, count_tokens
+from owasp_store import get_owasp_retriever, get_owasp_store, open_owasp_index, BUILDS_DIR, search
+from chain_registry import registry
+from concurrency import SingleFlight, run_blocking
+from answer_cache import AnswerCache, normalize_query
+from telemetry import record_tokens, span
+
+logger = logging.getLogger(__name__)
 
 # 1. Use ChatPromptTemplate (Better for Chat/Instruct models)
 # This creates a clear boundary between instructions and user input.
@@ -20,22 +32,176 @@ prompt = ChatPromptTemplate.from_messages([
     ("human", "{question}"),
 ])
 
-def owasp_print(query):
-    print(f"DEBUG: Asking Chain: {query}")
-    llm = get_llm()
+BATCH_CONCURRENCY = int(os.getenv("OWASP_BATCH_CONCURRENCY", "4"))
+
+class TracedStrOutputParser(StrOutputParser):
+    # Times the final parse and counts completion tokens; streaming goes
+    # through transform() and is counted by astream_owasp instead.
+    def invoke(self, input, config=None, **kwargs):
+        with span("parse"):
+            text = super().invoke(input, config, **kwargs)
+        record_tokens("completion", count_tokens(text))
+        return text
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        with span("parse"):
+            text = await super().ainvoke(input, config, **kwargs)
+        record_tokens("completion", count_tokens(text))
+        return text
+
+owasp_cache = AnswerCache.from_env("owasp", BUILDS_DIR, embeddings=lambda: get_owasp_store().embeddings)
+# Concurrent identical questions share one retrieval + generation.
+owasp_flight = SingleFlight("owasp", key=normalize_query)
+_answer_chain = None
+
+def get_answer_chain():
+    # prompt -> llm -> text, shared by the full chain and the streaming path.
+    global _answer_chain
+    if _answer_chain is None:
+        _answer_chain = prompt | get_llm() | TracedStrOutputParser()
+    return _answer_chain
+
+def assemble_context(docs, question):
+    # Dedupe overlapping chunks and fit the ranked context to the token budget.
+    with span("context", chunks=len(docs)):
+        context, stats = build_context(docs, question)
+    record_tokens("context_retrieved", stats["tokens_before"])
+    record_tokens("context_sent", stats["tokens_after"])
+    logger.debug("Context tokens %s -> %s (saved %s)", stats["tokens_before"], stats["tokens_after"], stats["tokens_saved"])
+    return {"context": context, "question": question}, stats
+
+def build_owasp_chain():
+    # Opens (or, after an eviction, reopens) the index ahead of traffic.
+    open_owasp_index()
     owasp_retriever = get_owasp_retriever()
-    
-    # 2. Build the Chain
-    chain = (
+
+    # Built once by the chain registry; LCEL runnables are stateless and
+    # safe to invoke from several threads at once.
+    return (
         {
-            "context": owasp_retriever | format_docs,
+            "docs": owasp_retriever,
             "question": RunnablePassthrough()
         }
-        | prompt
-        | llm
-        | StrOutputParser()
+        | RunnableLambda(lambda x: assemble_context(x["docs"], x["question"])[0], name="assemble_context")
+        | get_answer_chain()
     )
-    
-    # 3. Invoke
-    response = chain.invoke(query)
-    return response
+
+def owasp_print(query):
+    logger.debug("Asking chain: %s", query)
+    chain = registry.get("owasp")
+    return owasp_flight.do(query, lambda: owasp_cache.get_or_compute(query, lambda: chain.invoke(query)))
+
+async def aowasp_print(query, slot=None):
+    # slot: optional async context manager factory (e.g. an endpoint limiter
+    # slot), entered only by the caller that actually computes the answer.
+    # The first call may still be building the chain; keep that off the loop.
+    chain = await run_blocking(registry.get, "owasp")
+
+    async def compute():
+        async with slot() if slot else nullcontext():
+            return await owasp_cache.aget_or_compute(query, lambda: chain.ainvoke(query))
+
+    return await owasp_flight.ado(query, compute)
+
+def _source_frame(docs):
+    return [
+        {
+            "title": d.metadata.get("title"),
+            "source": d.metadata.get("source"),
+            "snippet": d.page_content.strip()[:200],
+        }
+        for d in docs
+    ]
+
+async def astream_owasp(query):
+    # Yields frames: one "sources" frame, many "token" frames, one "done" frame.
+    started = time.perf_counter()
+    await run_blocking(registry.get, "owasp")
+
+    cached, vector = await run_blocking(owasp_cache.lookup, query)
+    if cached is not None:
+        yield {"type": "sources", "sources": [], "cached": True}
+        yield {"type": "token", "text": cached}
+        total = round((time.perf_counter() - started) * 1000, 1)
+        yield {"type": "done", "chunks": 1, "cached": True, "timings_ms": {"total": total}}
+        return
+
+    docs = await get_owasp_retriever().ainvoke(query)
+    retrieved = time.perf_counter()
+    yield {"type": "sources", "sources": _source_frame(docs)}
+
+    first_token = None
+    tokens = 0
+    inputs, context_stats = await run_blocking(assemble_context, docs, query)
+    parts = []
+    async for token in get_answer_chain().astream(inputs):
+        if not token:
+            continue
+        if first_token is None:
+            first_token = time.perf_counter()
+        tokens += 1
+        parts.append(token)
+        yield {"type": "token", "text": token}
+
+    answer = "".join(parts)
+    record_tokens("completion", await run_blocking(count_tokens, answer))
+    await run_blocking(owasp_cache.store, query, answer, vector)
+    finished = time.perf_counter()
+    yield {
+        "type": "done",
+        "chunks": tokens,
+        "context": context_stats,
+        "timings_ms": {
+            "retrieval": round((retrieved - started) * 1000, 1),
+            "first_token": round((first_token - started) * 1000, 1) if first_token else None,
+            "total": round((finished - started) * 1000, 1),
+        },
+    }
+
+async def abatch_owasp(queries, max_concurrency=BATCH_CONCURRENCY):
+    # Returns one {"query", "answer"} or {"query", "error"} dict per input, in order.
+    await run_blocking(registry.get, "owasp")
+    store = get_owasp_store()
+    results = [{"query": q} for q in queries]
+
+    # 1. One batched embedding call for every query.
+    vectors = await run_blocking(store.embeddings.embed_documents, list(queries))
+
+    # 2. Answer cache, then vector search for the misses.
+    pending = []
+    for i, (query, vec) in enumerate(zip(queries, vectors)):
+        try:
+            cached, norm_vec, version = await run_blocking(owasp_cache.lookup, query, vec)
+        except Exception as e:
+            results[i]["error"] = repr(e)
+            continue
+        if cached is not None:
+            results[i]["answer"] = cached
+        else:
+            pending.append((i, vec, (norm_vec, version)))
+
+    searches = await asyncio.gather(
+        *(run_blocking(search, queries[i], vec) for i, vec, _ in pending),
+        return_exceptions=True,
+    )
+
+    # 3. LLM generation with bounded concurrency; failures stay per item.
+    inputs, owners = [], []
+    for (i, _, norm_vec), docs in zip(pending, searches):
+        if isinstance(docs, Exception):
+            results[i]["error"] = repr(docs)
+            continue
+        inputs.append((await run_blocking(assemble_context, docs, queries[i]))[0])
+        owners.append((i, norm_vec))
+
+    answers = await get_answer_chain().abatch(
+        inputs, config={"max_concurrency": max_concurrency}, return_exceptions=True
+    )
+    for (i, (norm_vec, version)), answer in zip(owners, answers):
+        if isinstance(answer, Exception):
+            results[i]["error"] = repr(answer)
+        else:
+            results[i]["answer"] = answer
+            await run_blocking(owasp_cache.store, queries[i], answer, norm_vec, version)
+
+    return results
@@ -1,15 +1,132 @@
-from langchain_community.embeddings import HuggingFaceEmbeddings
+import os
+import threading
 from langchain_community.vectorstores import Chroma
+from langchain_core.runnables import RunnableLambda
+from chain_registry import registry
+from concurrency import run_blocking
+from corpora import get_corpus
+from embedding_service import get_embeddings
+from fast_store import MmapVectorStore, open_store
+from hybrid_retriever import BM25_FILE, BM25Index, get_reranker, hybrid_search
+from prefork import after_fork
+from telemetry import span
 
+# Declared as the "owasp" corpus in corpora.json.
+CORPUS = get_corpus("owasp")
+EMBEDDING_MODEL = CORPUS.embedding_model
+# ingest_owasp builds each index under BUILDS_DIR and atomically repoints
+# CURRENT_POINTER at it; the legacy single-directory index is the fallback.
+BUILDS_DIR = CORPUS.path
+CURRENT_POINTER = os.path.join(BUILDS_DIR, "CURRENT")
+LEGACY_PATH = CORPUS.options.get("legacy_path", "./chroma_db/owasp")
+COLLECTION_NAME = CORPUS.collection
+# Each build may carry an mmap export of itself, served when VECTOR_BACKEND=mmap.
+MMAP_DIR = "mmap"
+# Hybrid retrieval is precise enough to send fewer chunks to the LLM; the
+# vector-only fallback (no BM25 index in the build) keeps the old k.
+TOP_K = int(os.getenv("OWASP_TOP_K", "3"))
+VECTOR_ONLY_TOP_K = 5
+FETCH_K = int(os.getenv("OWASP_FETCH_K", "20"))
+# e.g. "cross-encoder/ms-marco-MiniLM-L-6-v2"; empty disables reranking.
+RERANKER_MODEL = os.getenv("OWASP_RERANKER", "")
 
-embeddings = HuggingFaceEmbeddings(
-    model_name="ibm-granite/granite-embedding-107m-multilingual"
-)
+# (build path, store, BM25 index or None), always replaced as a whole so
+# readers never pair one build's store with another's BM25 index.
+_index = None
+_store_lock = threading.Lock()
+_owasp_retriever = None
 
-owasp_store = Chroma(
-    collection_name="owasp",
-    persist_directory="./chroma_db/owasp",
-    embedding_function=embeddings
-)
+def current_owasp_path():
+    try:
+        with open(CURRENT_POINTER, "r", encoding="utf-8") as f:
+            return os.path.join(BUILDS_DIR, f.read().strip())
+    except FileNotFoundError:
+        return LEGACY_PATH
 
-owasp_retriever = owasp_store.as_retriever(search_kwargs={"k": 5})
+def mmap_path(build_path):
+    return os.path.join(build_path, MMAP_DIR)
+
+def get_owasp_index():
+    # Returns (store, bm25) from the same build. After an eviction the chain
+    # registry reopens them, so the load counts against its memory budget.
+    if _index is None:
+        registry.get(CORPUS.name)
+    return open_owasp_index()
+
+def open_owasp_index():
+    # Used by the chain builder itself; everyone else goes through
+    # get_owasp_index. Re-opens both when a re-ingest has swapped the pointer.
+    global _index
+    path = current_owasp_path()
+    index = _index
+    if index is not None and index[0] == path and index[1] is not None:
+        return index[1], index[2]
+
+    with _store_lock:
+        index = _index
+        if index is None or index[0] != path or index[1] is None:
+            embeddings = get_embeddings(EMBEDDING_MODEL)
+            store = open_store(
+                lambda: Chroma(
+                    collection_name=COLLECTION_NAME,
+                    persist_directory=path,
+                    embedding_function=embeddings
+                ),
+                mmap_path(path),
+                embeddings,
+            )
+            # The BM25 index is built alongside each collection, so it swaps with it.
+            if index is not None and index[0] == path:
+                bm25 = index[2]
+            else:
+                bm25_path = os.path.join(path, BM25_FILE)
+                bm25 = BM25Index.load(bm25_path) if os.path.exists(bm25_path) else None
+            index = _index = (path, store, bm25)
+    return index[1], index[2]
+
+def get_owasp_store():
+    return get_owasp_index()[0]
+
+@after_fork
+def _reopen_store():
+    # Chroma's client is not fork-safe; the embeddings, BM25 index and an
+    # mmap store are, and stay shared with the parent.
+    global _index, _store_lock
+    _store_lock = threading.Lock()
+    if _index is not None and not isinstance(_index[1], MmapVectorStore):
+        _index = (_index[0], None, _index[2])
+
+def unload():
+    # Corpus eviction (chain_registry): drop the store and BM25 index; the
+    # next search reopens both.
+    global _index
+    with _store_lock:
+        _index = None
+
+def search(query, vector=None):
+    # BM25 + vector with reciprocal-rank fusion (and optional cross-encoder
+    # rerank); plain vector search when the build has no BM25 index.
+    store, bm25 = get_owasp_index()
+    if vector is None:
+        vector = store.embeddings.embed_query(query)
+    with span("vector_search", hybrid=bm25 is not None):
+        if bm25 is None:
+            return store.similarity_search_by_vector(vector, k=VECTOR_ONLY_TOP_K)
+        return hybrid_search(
+            query, store, bm25, k=TOP_K, fetch_k=FETCH_K, vector=vector,
+            reranker=get_reranker(RERANKER_MODEL),
+        )
+
+def _retrieve(query):
+    return search(query)
+
+async def _aretrieve(query):
+    return await run_blocking(search, query)
+
+def get_owasp_retriever():
+    # Resolves the live store on every call so chains built once keep
+    # following index swaps.
+    global _owasp_retriever
+    if _owasp_retriever is None:
+        _owasp_retriever = RunnableLambda(_retrieve, afunc=_aretrieve, name="owasp_retriever")
+    return _owasp_retriever
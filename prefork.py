@@ -0,0 +1,69 @@
+import gc
+import os
+import sys
+
+# Pre-fork serving (see gunicorn.conf.py): the master imports the app and
+# loads every model and index once; workers inherit them copy-on-write.
+# Only handles that cannot cross a fork (Chroma clients, SQLite
+# connections) are dropped in the child and reopened on first use.
+PRELOAD_LOCAL_LLM = os.getenv("PRELOAD_LOCAL_LLM", "true").lower() == "true"
+
+
+def after_fork(fn):
+    # Decorator: run fn in every child right after fork (gunicorn workers,
+    # multiprocessing's "fork" start method). No-op where fork is unsupported.
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=fn)
+    return fn
+
+@after_fork
+def _drop_chroma_clients():
+    # chromadb caches one client (SQLite + Rust bindings) per path; a new
+    # Chroma() in the child must not pick up the parent's.
+    if "chromadb" in sys.modules:
+        from chromadb.api.client import SharedSystemClient
+        SharedSystemClient.clear_system_cache()
+
+
+def preload(chains=None):
+    # Runs in the master before workers are forked.
+    from chain_registry import registry
+    registry.warm(chains)
+
+    if PRELOAD_LOCAL_LLM:
+        from rag_components import get_llm
+        from llm_backends import LocalTransformersBackend
+        for backend in get_llm().backends:
+            if isinstance(backend, LocalTransformersBackend):
+                # Plain weights only: quantization and the ONNX session may
+                # start thread pools that do not survive fork, so each worker
+                # prepares them in configure_worker. The prefix KV cache is
+                # built on first use, on the worker's generation thread.
+                from local_engine import get_local_engine
+                get_local_engine(backend.model_name, prepare=False)
+
+    # Move everything loaded so far out of the collector's reach, so the
+    # workers' GC passes do not write to (and un-share) those pages.
+    gc.collect()
+    gc.freeze()
+
+def worker_threads(workers):
+    # Split the physical cores between workers instead of every worker
+    # claiming all of them.
+    from local_engine import default_threads
+    physical, _ = default_threads()
+    return int(os.getenv("WORKER_TORCH_THREADS", "0")) or max(1, physical // max(1, workers))
+
+def configure_worker(workers):
+    # Runs in each worker right after fork.
+    threads = worker_threads(workers)
+    # Read by local_engine if it loads the model later in this worker.
+    os.environ["LOCAL_LLM_THREADS"] = str(threads)
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    if "torch" in sys.modules:
+        from local_engine import configure_torch_threads
+        configure_torch_threads(intra=threads)
+    if "local_engine" in sys.modules:
+        from local_engine import prepare_engines
+        prepare_engines()
+    return threads
@@ -1,5 +1,5 @@
 import os
-from langchain_community.llms import HuggingFaceEndpoint, HuggingFacePipeline
+from llm_backends import LLMPool, build_backends
 
 
 model_name = os.getenv("MODEL_NAME", "TinyLlama/TinyLlama-1.1B-Chat-v1.0")
@@ -19,45 +19,27 @@ def get_llm():
     if _llm is not None:
         return _llm
 
-    if use_remote_llm:
-        # Remote inference keeps memory usage low on small Render instances.
-        _llm = HuggingFaceEndpoint(
-            repo_id=model_name,
-            huggingfacehub_api_token=os.getenv("HF_TOKEN"),
-            max_new_tokens=120,
-            temperature=0.2,
-            top_p=0.9,
-            repetition_penalty=1.1,
-            task="text-generation",
-        )
-        return _llm
-
-    # Optional local fallback for larger instances.
-    from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
-
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    tokenizer.pad_token = tokenizer.eos_token
-    model = AutoModelForCausalLM.from_pretrained(model_name)
-    gen_pipeline = pipeline(
-        "text-generation",
-        model=model,
-        tokenizer=tokenizer,
-        max_new_tokens=80,
-        temperature=0.2,
-        top_p=0.9,
-        do_sample=True,
-        repetition_penalty=1.1,
-        no_repeat_ngram_size=3,
-        return_full_text=False,
+    # Backends are tried in order; a failing or slow one trips its circuit
+    # and traffic fails over to the next. Remote inference keeps memory usage
+    # low on small Render instances; "local" is the optional transformers
+    # fallback for larger instances, "openai" any OpenAI-compatible local
+    # server and "stub" an offline backend for tests.
+    default = "remote" if use_remote_llm else "local"
+    names = os.getenv("LLM_BACKENDS", default).split(",")
+    _llm = LLMPool(
+        backends=build_backends(names, model_name),
+        deadline=float(os.getenv("LLM_DEADLINE", "20")),
+        retries=int(os.getenv("LLM_RETRIES", "2")),
+        hedge=os.getenv("LLM_HEDGE", "true").lower() == "true",
+        hedge_floor=float(os.getenv("LLM_HEDGE_AFTER", "1.5")),
     )
-    _llm = HuggingFacePipeline(pipeline=gen_pipeline)
     return _llm
 
 def format_docs(docs):
     formatted = []
     for d in docs:
         formatted.append(
-            f"[SOURCE: {d.metadata.get('source')}\n"
+            f"[SOURCE: {d.metadata.get('source')}]\n"
             f"{d.page_content.strip()}"
         )
     return "\n\n".join(formatted)
@@ -0,0 +1,176 @@
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+
+# TRACE_LOG: "-" for stderr or a file path; one JSON line per request with
+# its spans. Empty disables it. Records go through a QueueHandler so the
+# request path never blocks on I/O.
+TRACE_LOG = os.getenv("TRACE_LOG", "")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+try:
+    from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest
+    PROMETHEUS = True
+except ImportError:
+    PROMETHEUS = False
+
+
+class _Noop:
+    # Stands in for prometheus_client metrics when it is not installed.
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+    @contextmanager
+    def time(self):
+        yield
+
+
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30)
+
+if PROMETHEUS:
+    REQUEST_SECONDS = Histogram("rag_request_seconds", "End-to-end request latency", ["endpoint", "status"], buckets=_LATENCY_BUCKETS)
+    STAGE_SECONDS = Histogram("rag_stage_seconds", "Latency per pipeline stage (spans may nest)", ["stage"], buckets=_LATENCY_BUCKETS)
+    INTENT_SECONDS = Histogram("rag_mitre_intent_seconds", "MITRE routing latency per intent", ["intent"], buckets=_LATENCY_BUCKETS)
+    CACHE_LOOKUPS = Counter("rag_cache_lookups_total", "Cache lookups by result", ["cache", "result"])
+    TOKENS = Counter("rag_tokens_total", "Tokens processed", ["kind"])
+    QUEUE_WAIT_SECONDS = Histogram("rag_queue_wait_seconds", "Time spent queued for an endpoint slot", ["limiter", "priority"], buckets=_LATENCY_BUCKETS)
+    COALESCED = Counter("rag_coalesced_total", "Requests served by another caller's in-flight computation", ["flight"])
+else:
+    REQUEST_SECONDS = STAGE_SECONDS = INTENT_SECONDS = CACHE_LOOKUPS = TOKENS = QUEUE_WAIT_SECONDS = COALESCED = _Noop()
+
+
+# --- Tracing ---
+
+class Trace:
+    def __init__(self, name):
+        self.name = name
+        # Quoted in client-facing errors so a report can be matched to its log line.
+        self.id = uuid.uuid4().hex[:16]
+        self.started = time.perf_counter()
+        self.attrs = {}
+        self.spans = []
+
+    def to_dict(self):
+        return {
+            "trace": self.name,
+            "trace_id": self.id,
+            "ms": round((time.perf_counter() - self.started) * 1000, 2),
+            **self.attrs,
+            "spans": self.spans,
+        }
+
+
+_current = contextvars.ContextVar("rag_trace", default=None)
+
+def current_trace():
+    return _current.get()
+
+def set_attribute(key, value):
+    trace = _current.get()
+    if trace is not None:
+        trace.attrs[key] = value
+
+@contextmanager
+def trace(name, emit=True):
+    # Root of one request; spans opened under it (also in executor threads,
+    # see concurrency.run_blocking) are collected and logged together.
+    # emit=False leaves logging to the caller (see emit_trace), for traces
+    # that outlive this block, e.g. while a response body is still streaming.
+    t = Trace(name)
+    token = _current.set(t)
+    try:
+        yield t
+    finally:
+        _current.reset(token)
+        if emit:
+            emit_trace(t)
+
+def emit_trace(t):
+    if _trace_logger is not None:
+        _trace_logger.info(json.dumps(t.to_dict(), default=str))
+
+@contextmanager
+def span(stage, **attrs):
+    started = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.labels(stage).observe(elapsed)
+        t = _current.get()
+        if t is not None:
+            t.spans.append({"stage": stage, "ms": round(elapsed * 1000, 2), **attrs})
+
+def record_cache(cache, hit):
+    CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+
+def record_tokens(kind, count):
+    if count:
+        TOKENS.labels(kind).inc(count)
+
+
+# --- Logging ---
+
+_trace_logger = None
+_listener = None
+
+def configure_logging():
+    # Application logs and the JSON trace log share one background listener.
+    global _trace_logger, _listener
+    if _listener is not None:
+        return
+    log_queue = queue.SimpleQueue()
+    app_handler = logging.StreamHandler(sys.stderr)
+    app_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    handlers = [app_handler]
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    if TRACE_LOG:
+        trace_handler = logging.StreamHandler(sys.stderr) if TRACE_LOG == "-" else logging.FileHandler(TRACE_LOG, encoding="utf-8")
+        trace_handler.setFormatter(logging.Formatter("%(message)s"))
+        # Route by logger name: traces go only to the JSON sink.
+        trace_handler.addFilter(lambda record: record.name == "rag.trace")
+        app_handler.addFilter(lambda record: record.name != "rag.trace")
+        handlers.append(trace_handler)
+        _trace_logger = logging.getLogger("rag.trace")
+        _trace_logger.setLevel(logging.INFO)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+def shutdown_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+# --- Exposition ---
+
+def render_metrics():
+    # Returns (body, content_type). Under gunicorn, PROMETHEUS_MULTIPROC_DIR
+    # aggregates every worker's samples.
+    if not PROMETHEUS:
+        return None, None
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,139 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from answer_cache import AnswerCache, collection_version, normalize_query, stamp_collection
+
+
+class FakeEmbeddings:
+    # Every query embeds to the same direction, so only the ID guard
+    # separates them in the semantic tier.
+    def __init__(self):
+        self.calls = 0
+
+    def embed_query(self, text):
+        self.calls += 1
+        return [3.0, 4.0]
+
+
+@pytest.fixture
+def persist_dir(tmp_path):
+    return str(tmp_path / "collection")
+
+
+def test_normalize_query():
+    assert normalize_query("  What is   T1056?  ") == "what is t1056"
+
+
+def test_collection_version_defaults_and_changes(persist_dir):
+    assert collection_version(persist_dir) == "0"
+    first = stamp_collection(persist_dir)
+    assert collection_version(persist_dir) == first
+    assert stamp_collection(persist_dir) != first
+
+
+# --- Exact tier ---
+
+def test_exact_hit_after_store(persist_dir):
+    cache = AnswerCache("test", persist_dir)
+    assert cache.lookup("What is XSS?")[0] is None
+    cache.store("What is XSS?", "An injection flaw.")
+    assert cache.lookup("what is xss")[0] == "An injection flaw."
+    assert cache.stats()["hits"] == {"exact": 1, "semantic": 0}
+
+
+def test_entries_expire_after_the_ttl(persist_dir):
+    cache = AnswerCache("test", persist_dir, ttl=-1)
+    cache.store("q", "a")
+    assert cache.lookup("q")[0] is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_oldest_entries_are_evicted(persist_dir):
+    cache = AnswerCache("test", persist_dir, max_entries=2)
+    for q in ("q1", "q2", "q3"):
+        cache.store(q, q.upper())
+    assert [cache.lookup(q)[0] for q in ("q1", "q2", "q3")] == [None, "Q2", "Q3"]
+    assert cache.evictions == 1
+
+
+# --- Versioning ---
+
+def test_reingest_invalidates_every_entry(persist_dir):
+    cache = AnswerCache("test", persist_dir)
+    cache.store("q", "old answer")
+    stamp_collection(persist_dir)
+    assert cache.lookup("q")[0] is None
+    assert cache.invalidations == 1
+
+
+def test_answer_computed_before_a_reingest_is_not_stored(persist_dir):
+    cache = AnswerCache("test", persist_dir)
+    _, vector, version = cache.lookup("q")
+    stamp_collection(persist_dir)       # re-ingest while the answer is computed
+    cache.store("q", "stale answer", vector, version)
+    assert cache.lookup("q")[0] is None
+
+    _, vector, version = cache.lookup("q")
+    cache.store("q", "fresh answer", vector, version)
+    assert cache.lookup("q")[0] == "fresh answer"
+
+
+def test_get_or_compute_computes_once(persist_dir):
+    cache = AnswerCache("test", persist_dir)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return "answer"
+
+    assert [cache.get_or_compute("q", compute) for _ in range(2)] == ["answer", "answer"]
+    assert len(calls) == 1
+
+
+def test_aget_or_compute_drops_a_stale_answer(persist_dir):
+    cache = AnswerCache("test", persist_dir)
+
+    async def compute():
+        stamp_collection(persist_dir)
+        return "stale answer"
+
+    assert asyncio.run(cache.aget_or_compute("q", compute)) == "stale answer"
+    assert cache.lookup("q")[0] is None
+
+
+# --- Semantic tier ---
+
+def test_semantic_hit_needs_matching_ids(persist_dir):
+    embeddings = FakeEmbeddings()
+    cache = AnswerCache("test", persist_dir, embeddings=lambda: embeddings)
+    _, vector, version = cache.lookup("How does T1056 work?")
+    assert np.allclose(vector, [0.6, 0.8])
+    cache.store("How does T1056 work?", "Input capture.", vector, version)
+
+    assert cache.lookup("Explain T1056 please")[0] == "Input capture."
+    assert cache.lookup("How does T1055 work?")[0] is None
+    assert cache.stats()["hits"] == {"exact": 0, "semantic": 1}
+
+
+def test_precomputed_vectors_skip_the_embedding_call(persist_dir):
+    embeddings = FakeEmbeddings()
+    cache = AnswerCache("test", persist_dir, embeddings=lambda: embeddings)
+    cache.lookup("q", vector=[1.0, 0.0])
+    assert embeddings.calls == 0
+
+
+# --- Persistence ---
+
+def test_sqlite_entries_survive_a_restart_but_not_a_reingest(persist_dir, tmp_path):
+    db_path = str(tmp_path / "answers.db")
+    cache = AnswerCache("test", persist_dir, db_path=db_path)
+    _, vector, version = cache.lookup("q")
+    cache.store("q", "persisted", vector, version)
+
+    assert AnswerCache("test", persist_dir, db_path=db_path).lookup("q")[0] == "persisted"
+    assert AnswerCache("other", persist_dir, db_path=db_path).lookup("q")[0] is None
+
+    stamp_collection(persist_dir)
+    assert AnswerCache("test", persist_dir, db_path=db_path).lookup("q")[0] is None
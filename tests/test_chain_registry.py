@@ -0,0 +1,152 @@
+import threading
+
+import pytest
+
+import chain_registry
+import embedding_service
+from chain_registry import ChainRegistry
+
+MODEL_MB = 100.0
+
+
+class FakeCorpus:
+    def __init__(self, name, embedding_model="model-a", index_mb=50.0):
+        self.name = name
+        self.embedding_model = embedding_model
+        self._index_mb = index_mb
+
+    def index_mb(self):
+        return self._index_mb
+
+
+@pytest.fixture(autouse=True)
+def fake_models(monkeypatch):
+    released = []
+    monkeypatch.setattr(chain_registry, "model_memory_mb", lambda model: MODEL_MB)
+    monkeypatch.setattr(embedding_service, "release_embeddings", released.append)
+    return released
+
+
+def make_registry(budget, corpora):
+    registry = ChainRegistry(memory_budget_mb=budget)
+    unloaded = []
+    for corpus in corpora:
+        registry.register(corpus.name, lambda n=corpus.name: f"chain {n}",
+                          unload=lambda n=corpus.name: unloaded.append(n), corpus=corpus)
+    return registry, unloaded
+
+
+def test_builds_once_and_reports_status():
+    builds = []
+    registry = ChainRegistry()
+    registry.register("a", lambda: builds.append(1) or "chain a")
+    assert registry.get("a") == registry.get("a") == "chain a"
+    assert len(builds) == 1
+    assert registry.is_ready("a") and registry.is_ready()
+    assert registry.status()["a"]["loaded"]
+
+
+def test_unknown_chain():
+    with pytest.raises(KeyError):
+        ChainRegistry().get("missing")
+
+
+def test_build_errors_are_recorded_and_retried():
+    attempts = []
+
+    def build():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("index missing")
+        return "chain"
+
+    registry = ChainRegistry()
+    registry.register("a", build)
+    with pytest.raises(RuntimeError):
+        registry.get("a")
+    assert "index missing" in registry.status()["a"]["error"]
+    assert registry.get("a") == "chain"
+    assert registry.status()["a"]["error"] is None
+
+
+# --- Memory budget ---
+
+def test_memory_counts_each_shared_model_once():
+    registry, _ = make_registry(0, [FakeCorpus("a"), FakeCorpus("b"), FakeCorpus("c", "model-b")])
+    for name in "abc":
+        registry.get(name)
+    # Three indexes, two distinct models.
+    assert registry.memory_used_mb() == 3 * 50 + 2 * MODEL_MB
+    assert registry.memory_stats()["embedding_models"] == ["model-a", "model-b"]
+
+
+def test_least_recently_used_corpus_is_evicted(fake_models):
+    registry, unloaded = make_registry(240, [FakeCorpus("a"), FakeCorpus("b"), FakeCorpus("c")])
+    registry.get("a")
+    registry.get("b")
+    registry.get("a")           # b is now the least recently used
+    registry.get("c")           # 100 (model) + 3 * 50 > 240
+
+    assert unloaded == ["b"]
+    assert registry.memory_stats()["loaded"] == ["a", "c"]
+    assert registry.memory_used_mb() <= 240
+    # a and c still use the model.
+    assert fake_models == []
+    # Evicted corpora stay ready and reload on demand.
+    assert registry.is_ready("b")
+    assert registry.get("b") == "chain b"
+    assert registry.evictions == 2
+
+
+def test_evicting_the_last_user_releases_its_model(fake_models):
+    registry, unloaded = make_registry(200, [FakeCorpus("a", "model-a"), FakeCorpus("b", "model-b")])
+    registry.get("a")
+    registry.get("b")
+    assert unloaded == ["a"]
+    assert fake_models == ["model-a"]
+    assert registry.memory_stats()["embedding_models"] == ["model-b"]
+
+
+def test_oversized_corpus_loads_alone():
+    registry, unloaded = make_registry(120, [FakeCorpus("a"), FakeCorpus("big", index_mb=500)])
+    registry.get("a")
+    assert registry.get("big") == "chain big"
+    assert unloaded == ["a"]
+    assert registry.memory_stats()["loaded"] == ["big"]
+
+
+def test_explicit_evict():
+    registry, unloaded = make_registry(0, [FakeCorpus("a")])
+    registry.get("a")
+    registry.evict("a")
+    registry.evict("a")
+    assert unloaded == ["a"]
+    assert registry.memory_used_mb() == 0
+
+
+def test_concurrent_gets_under_eviction_stay_consistent(monkeypatch):
+    # No gc.collect per eviction: only the bookkeeping is under test.
+    monkeypatch.setattr(chain_registry.gc, "collect", lambda: None)
+    names = "abcdef"
+    registry, _ = make_registry(250, [FakeCorpus(n) for n in names])
+    errors = []
+
+    def hammer(offset):
+        try:
+            for i in range(300):
+                name = names[(i + offset) % len(names)]
+                assert registry.get(name) == f"chain {name}"
+                registry.memory_stats()
+                registry.status()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=hammer, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+
+    assert errors == []
+    assert registry.memory_used_mb() <= 250
+    assert len(registry.memory_stats()["loaded"]) == len(set(registry.memory_stats()["loaded"]))
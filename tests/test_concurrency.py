@@ -0,0 +1,301 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from concurrency import EndpointLimiter, Overloaded, SingleFlight
+
+
+# --- SingleFlight ---
+
+def test_sync_callers_share_one_computation():
+    flight = SingleFlight("test")
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "answer"
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("q", compute)))
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=lambda: results.append(flight.do("q", compute)))
+    follower.start()
+    time.sleep(0.05)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert results == ["answer", "answer"]
+    assert len(calls) == 1
+    assert flight.stats() == {"inflight": 0, "leaders": 1, "coalesced": 1}
+
+
+def test_key_function_normalizes_before_coalescing():
+    flight = SingleFlight("test", key=str.lower)
+
+    async def main():
+        gate = asyncio.Event()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await gate.wait()
+            return "answer"
+
+        tasks = [asyncio.ensure_future(flight.ado(q, compute)) for q in ("Q", "q")]
+        await asyncio.sleep(0)
+        gate.set()
+        return await asyncio.gather(*tasks), calls
+
+    results, calls = asyncio.run(main())
+    assert results == ["answer", "answer"]
+    assert len(calls) == 1
+
+
+def test_errors_reach_every_caller_and_clear_the_key():
+    flight = SingleFlight("test")
+
+    async def main():
+        gate = asyncio.Event()
+
+        async def compute():
+            await gate.wait()
+            raise ValueError("boom")
+
+        tasks = [asyncio.ensure_future(flight.ado("q", compute)) for _ in range(3)]
+        await asyncio.sleep(0)
+        gate.set()
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(r, ValueError) for r in results)
+    assert flight.stats()["inflight"] == 0
+
+
+def test_cancelled_leader_does_not_cancel_followers():
+    flight = SingleFlight("test")
+
+    async def main():
+        gate = asyncio.Event()
+
+        async def compute():
+            await gate.wait()
+            return "answer"
+
+        leader = asyncio.ensure_future(flight.ado("q", compute))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.ado("q", compute))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        gate.set()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(main()) == "answer"
+
+
+def test_async_caller_joins_sync_leader():
+    flight = SingleFlight("test")
+    started, release = threading.Event(), threading.Event()
+
+    def compute():
+        started.set()
+        release.wait(5)
+        return "sync answer"
+
+    async def main():
+        leader = asyncio.get_running_loop().run_in_executor(None, flight.do, "q", compute)
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+
+        async def never():
+            raise AssertionError("follower must not compute")
+
+        follower = asyncio.ensure_future(flight.ado("q", never))
+        await asyncio.sleep(0.05)
+        release.set()
+        return await leader, await follower
+
+    assert asyncio.run(main()) == ("sync answer", "sync answer")
+    assert flight.coalesced == 1
+
+
+def test_sync_caller_never_waits_on_async_leader():
+    # A thread blocked on an async leader could hold the executor slot that
+    # leader needs; it must compute on its own instead.
+    flight = SingleFlight("test")
+
+    async def main():
+        gate = asyncio.Event()
+
+        async def compute():
+            await gate.wait()
+            return "async answer"
+
+        leader = asyncio.ensure_future(flight.ado("q", compute))
+        await asyncio.sleep(0)
+        loop = asyncio.get_running_loop()
+        sync = await asyncio.wait_for(loop.run_in_executor(None, flight.do, "q", lambda: "sync answer"), 2)
+        gate.set()
+        return sync, await leader
+
+    assert asyncio.run(main()) == ("sync answer", "async answer")
+    assert flight.coalesced == 0
+    assert flight.stats()["inflight"] == 0
+
+
+# --- EndpointLimiter ---
+
+def _limiter(**kwargs):
+    options = {"max_concurrency": 1, "max_queue": 4, "queue_timeout": 2.0, "aging": 60.0}
+    options.update(kwargs)
+    return EndpointLimiter("test", **options)
+
+
+async def _queue(limiter, priority, order):
+    await limiter.acquire(priority)
+    order.append(priority)
+
+
+def test_interactive_waiters_are_served_before_bulk():
+    async def main():
+        limiter = _limiter()
+        await limiter.acquire()
+        order = []
+        bulk = asyncio.ensure_future(_queue(limiter, "bulk", order))
+        await asyncio.sleep(0)
+        interactive = asyncio.ensure_future(_queue(limiter, "interactive", order))
+        await asyncio.sleep(0)
+
+        limiter.release()
+        await interactive
+        limiter.release()
+        await bulk
+        limiter.release()
+        return order, limiter.active
+
+    assert asyncio.run(main()) == (["interactive", "bulk"], 0)
+
+
+def test_aged_bulk_waiter_goes_first():
+    async def main():
+        limiter = _limiter(aging=0.05)
+        await limiter.acquire()
+        order = []
+        bulk = asyncio.ensure_future(_queue(limiter, "bulk", order))
+        await asyncio.sleep(0.1)
+        interactive = asyncio.ensure_future(_queue(limiter, "interactive", order))
+        await asyncio.sleep(0)
+
+        limiter.release()
+        await bulk
+        limiter.release()
+        await interactive
+        limiter.release()
+        return order
+
+    assert asyncio.run(main()) == ["bulk", "interactive"]
+
+
+def test_release_hands_the_slot_to_the_next_waiter():
+    async def main():
+        limiter = _limiter()
+        await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        assert limiter.waiting == 1
+
+        limiter.release()
+        # Handed over, not freed: a newcomer cannot jump the queue.
+        assert limiter.active == 1
+        await waiter
+        assert limiter.waiting == 0
+        limiter.release()
+        return limiter.active
+
+    assert asyncio.run(main()) == 0
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def main():
+        limiter = _limiter()
+        await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire("bulk"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert limiter.waiting == 0
+        limiter.release()
+        return limiter.active
+
+    assert asyncio.run(main()) == 0
+
+
+def test_waiter_cancelled_after_grant_passes_the_slot_on():
+    async def main():
+        limiter = _limiter()
+        await limiter.acquire()
+        first = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+
+        limiter.release()       # grants the slot to first...
+        first.cancel()          # ...which gives up before it resumes
+        # Depending on the Python version wait_for either swallows the late
+        # cancel (first holds the slot) or raises (the slot moves on); it is
+        # never lost either way.
+        granted = await asyncio.gather(first, return_exceptions=True)
+        if granted == [None]:
+            limiter.release()
+        await second
+        assert limiter.active == 1
+        limiter.release()
+        return limiter.active
+
+    assert asyncio.run(main()) == 0
+
+
+def test_queue_timeout_rejects():
+    async def main():
+        limiter = _limiter(queue_timeout=0.05)
+        await limiter.acquire()
+        with pytest.raises(Overloaded):
+            await limiter.acquire()
+        return limiter.waiting, limiter.rejected, limiter.active
+
+    assert asyncio.run(main()) == (0, 1, 1)
+
+
+def test_full_queue_sheds_load_immediately():
+    async def main():
+        limiter = _limiter(max_queue=1)
+        await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded):
+            await limiter.acquire()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        return limiter.rejected
+
+    assert asyncio.run(main()) == 1
+
+
+def test_slot_releases_on_error():
+    async def main():
+        limiter = _limiter()
+        with pytest.raises(RuntimeError):
+            async with limiter.slot():
+                raise RuntimeError
+        return limiter.active
+
+    assert asyncio.run(main()) == 0
@@ -0,0 +1,83 @@
+import pytest
+from langchain_core.documents import Document
+
+import context_builder
+from context_builder import build_context, dedupe, extract_sentences
+
+
+@pytest.fixture(autouse=True)
+def approximate_tokens(monkeypatch):
+    # The ~4 chars per token fallback, so no tokenizer is downloaded.
+    monkeypatch.setattr(context_builder, "_tokenizer", False)
+
+
+def doc(text, source):
+    return Document(page_content=text, metadata={"source": source})
+
+
+def sentences(prefix, n):
+    return " ".join(f"{prefix} sentence number {i} carries some filler words." for i in range(n))
+
+
+# --- dedupe ---
+
+def test_dedupe_drops_contained_chunks():
+    chunks = [("alpha beta gamma delta", "a"), ("beta gamma", "b"), ("  ", "c")]
+    assert dedupe(chunks) == [("alpha beta gamma delta", "a")]
+
+
+def test_dedupe_strips_the_splitter_overlap():
+    first = "The first chunk ends with a shared overlap window"
+    second = "a shared overlap window and then continues."
+    assert dedupe([(first, "a"), (second, "a")]) == [(first, "a"), ("and then continues.", "a")]
+
+
+def test_dedupe_replaces_a_chunk_contained_in_a_later_one():
+    assert dedupe([("short piece", "a"), ("a short piece of a longer chunk", "b")]) == [
+        ("a short piece of a longer chunk", "b"),
+    ]
+
+
+def test_extract_sentences_keeps_matching_sentences_only():
+    text = "Use parameterized queries. Colors are nice. Escape every query input."
+    assert extract_sentences(text, {"query", "queries"}) == "Use parameterized queries. Escape every query input."
+    assert extract_sentences(text, {"unrelated"}) == text
+
+
+# --- Token budget ---
+
+def test_build_context_stays_within_the_budget():
+    docs = [doc(sentences(f"doc{i}", 8), f"s{i}") for i in range(5)]
+    context, stats = build_context(docs, "what is doc0", budget=250)
+
+    assert stats["tokens_after"] <= 250
+    assert stats["chunks_in"] == 5
+    assert 1 <= stats["chunks_out"] < 5
+    assert stats["tokens_saved"] == stats["tokens_before"] - stats["tokens_after"]
+    # Filled in rank order.
+    assert context.startswith("[SOURCE: s0]\n")
+
+
+def test_build_context_trims_the_last_block_at_a_sentence():
+    docs = [doc(sentences("first", 4), "a"), doc(sentences("second", 10), "b")]
+    context, stats = build_context(docs, "question", budget=150)
+
+    last = context.split("\n\n")[-1]
+    assert last.startswith("[SOURCE: b]\n")
+    assert last.endswith("filler words.")
+    assert stats["chunks_out"] == 2
+    assert stats["tokens_after"] <= 150
+
+
+def test_build_context_keeps_everything_under_the_budget():
+    docs = [doc("One short chunk.", "a"), doc("Another short chunk.", "b")]
+    context, stats = build_context(docs, "chunk", budget=600)
+    assert context == "[SOURCE: a]\nOne short chunk.\n\n[SOURCE: b]\nAnother short chunk."
+    assert stats["chunks_out"] == 2
+    assert stats["tokens_saved"] == 0
+
+
+def test_build_context_can_extract_relevant_sentences():
+    docs = [doc("Bind variables stop SQL injection. The office is closed on Fridays.", "a")]
+    context, _ = build_context(docs, "How to stop SQL injection?", extract=True)
+    assert context == "[SOURCE: a]\nBind variables stop SQL injection."
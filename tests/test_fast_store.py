@@ -0,0 +1,139 @@
+import numpy as np
+import pytest
+from langchain_core.embeddings import Embeddings
+
+import fast_store
+from fast_store import MmapVectorStore
+
+VECTORS = {
+    "alpha": [1.0, 0.0, 0.0],
+    "beta": [0.9, 0.1, 0.0],
+    "gamma": [0.0, 1.0, 0.0],
+    "delta": [0.0, 0.0, 1.0],
+    "epsilon": [0.5, 0.5, 0.5],
+}
+METADATAS = [
+    {"type": "technique", "mitre_id": "T1"},
+    {"type": "technique", "mitre_id": "T2"},
+    {"type": "mitigation", "mitre_id": "M1"},
+    {"type": "technique"},
+    {"type": "group", "mitre_id": "G1"},
+]
+
+
+class FakeEmbeddings(Embeddings):
+    def embed_documents(self, texts):
+        return [VECTORS.get(t, [0.2, 0.2, 0.2]) for t in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+@pytest.fixture(params=["float32", "int8"])
+def store(request, tmp_path):
+    return MmapVectorStore.from_texts(list(VECTORS), FakeEmbeddings(), metadatas=METADATAS,
+                                      ids=[f"id-{t}" for t in VECTORS], path=str(tmp_path / "index"),
+                                      dtype=request.param)
+
+
+def contents(docs):
+    return [d.page_content for d in docs]
+
+
+# --- Search ---
+
+def test_search_matches_brute_force_squared_l2(store):
+    query = np.array([0.8, 0.3, 0.1], dtype=np.float32)
+    matrix = np.array(list(VECTORS.values()), dtype=np.float32)
+    expected = ((matrix - query) ** 2).sum(1)
+
+    results = store.similarity_search_by_vector_with_relevance_scores(query, k=3)
+    assert contents(d for d, _ in results) == [list(VECTORS)[i] for i in np.argsort(expected)[:3]]
+    for doc, score in results:
+        assert score == pytest.approx(expected[list(VECTORS).index(doc.page_content)], abs=0.02)
+
+
+def test_search_returns_ids_and_skips_missing_metadata(store):
+    doc = store.similarity_search("delta", k=1)[0]
+    assert (doc.id, doc.page_content, doc.metadata) == ("id-delta", "delta", {"type": "technique"})
+
+
+def test_k_larger_than_the_store(store):
+    assert len(store.similarity_search("alpha", k=50)) == len(VECTORS)
+
+
+# --- Metadata filters ---
+
+def test_eq_filter(store):
+    assert contents(store.similarity_search("alpha", k=5, filter={"type": "technique"})) == ["alpha", "beta", "delta"]
+    assert contents(store.similarity_search("alpha", k=5, filter={"type": {"$eq": "mitigation"}})) == ["gamma"]
+    assert store.similarity_search("alpha", k=5, filter={"type": "nothing"}) == []
+
+
+def test_in_filter_handles_missing_values(store):
+    found = store.get(where={"mitre_id": {"$in": ["T2", "G1", "unknown"]}})
+    assert found["ids"] == ["id-beta", "id-epsilon"]
+
+
+def test_and_or_filters(store):
+    where = {"$and": [{"type": "technique"}, {"$or": [{"mitre_id": "T1"}, {"mitre_id": "T2"}]}]}
+    assert contents(store.similarity_search("delta", k=5, filter=where)) == ["beta", "alpha"]
+
+
+def test_get_by_ids_and_filter(store):
+    found = store.get(ids=["id-alpha", "id-gamma"], where={"type": "technique"})
+    assert found == {"ids": ["id-alpha"], "documents": ["alpha"],
+                     "metadatas": [{"type": "technique", "mitre_id": "T1"}]}
+
+
+# --- Mask cache ---
+
+def test_only_low_cardinality_masks_are_cached(store, monkeypatch):
+    monkeypatch.setattr(fast_store, "MASK_CACHE_MAX_VALUES", 2)
+    store.get(where={"type": "technique"})        # 3 distinct values
+    store.get(where={"mitre_id": "T1"})
+    assert store._masks == {}
+
+    monkeypatch.setattr(fast_store, "MASK_CACHE_MAX_VALUES", 64)
+    store._distinct.clear()
+    store.get(where={"type": "technique"})
+    store.get(where={"type": "not-a-value"})
+    assert list(store._masks) == [("type", '"technique"')]
+
+
+def test_in_masks_are_never_cached(store):
+    store.get(where={"mitre_id": {"$in": ["T1", "T2"]}})
+    assert store._masks == {}
+
+
+# --- Index files ---
+
+def test_ivf_index_probes_the_nearest_lists(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(1500, 4)).astype(np.float32)
+    texts = [f"doc {i}" for i in range(len(vectors))]
+
+    class Fixed(Embeddings):
+        def embed_documents(self, docs):
+            return vectors.tolist()
+
+        def embed_query(self, text):
+            return vectors[7].tolist()
+
+    store = MmapVectorStore.from_texts(texts, Fixed(), path=str(tmp_path / "ivf"), ivf_lists=8)
+    assert store.centroids is not None
+    assert store.similarity_search("anything", k=1)[0].page_content == "doc 7"
+
+
+def test_rewriting_an_index_replaces_it(tmp_path):
+    path = str(tmp_path / "index")
+    MmapVectorStore.from_texts(["alpha"], FakeEmbeddings(), path=path)
+    store = MmapVectorStore.from_texts(["gamma", "delta"], FakeEmbeddings(), path=path)
+    assert store.ids == ["0", "1"]
+    assert MmapVectorStore(path, FakeEmbeddings()).documents == ["gamma", "delta"]
+    assert not (tmp_path / "index.tmp").exists() and not (tmp_path / "index.old").exists()
+
+
+def test_from_texts_needs_a_path():
+    with pytest.raises(ValueError):
+        MmapVectorStore.from_texts(["alpha"], FakeEmbeddings())
@@ -0,0 +1,91 @@
+from langchain_core.documents import Document
+
+from hybrid_retriever import BM25Index, hybrid_search, reciprocal_rank_fusion, tokenize
+
+
+def docs(*texts):
+    return [Document(page_content=t, metadata={"source": t}) for t in texts]
+
+
+class FakeVectorStore:
+    def __init__(self, results):
+        self.results = results
+        self.calls = []
+
+    def similarity_search(self, query, k=4):
+        self.calls.append(("query", query, k))
+        return self.results[:k]
+
+    def similarity_search_by_vector(self, vector, k=4):
+        self.calls.append(("vector", vector, k))
+        return self.results[:k]
+
+
+def test_tokenize_keeps_identifiers_whole():
+    assert tokenize("SSRF is CWE-918; see T1056.001 and X-Frame-Options.") == [
+        "ssrf", "is", "cwe-918", "see", "t1056.001", "and", "x-frame-options",
+    ]
+
+
+# --- BM25 ---
+
+def test_bm25_ranks_exact_identifier_matches_first():
+    index = BM25Index.from_documents(docs(
+        "Server-side request forgery, CWE-918.",
+        "Cross-site scripting, CWE-79.",
+        "Request smuggling between proxies.",
+    ))
+    results = index.search("cwe-918 request", k=2)
+    assert [d.page_content for d, _ in results][0] == "Server-side request forgery, CWE-918."
+    assert results[0][1] > results[1][1]
+
+
+def test_bm25_round_trips_through_disk(tmp_path):
+    index = BM25Index.from_documents(docs("alpha beta", "beta gamma"))
+    path = str(tmp_path / "bm25.json")
+    index.save(path)
+    loaded = BM25Index.load(path)
+    assert [(d.page_content, s) for d, s in loaded.search("gamma")] == [(d.page_content, s) for d, s in index.search("gamma")]
+
+
+# --- Reciprocal rank fusion ---
+
+def test_rrf_rewards_documents_found_by_both_retrievers():
+    fused = reciprocal_rank_fusion([docs("a", "b", "c"), docs("c", "d")])
+    # c: 1/63 + 1/61; a: 1/61; b and d tie at 1/62 and keep first-seen order.
+    assert [d.page_content for d in fused] == ["c", "a", "b", "d"]
+
+
+def test_rrf_fuses_by_content_and_keeps_the_first_copy():
+    dense = [Document(page_content="same chunk", metadata={"from": "dense"})]
+    sparse = [Document(page_content="same chunk", metadata={"from": "bm25"})]
+    fused = reciprocal_rank_fusion([dense, sparse])
+    assert len(fused) == 1
+    assert fused[0].metadata == {"from": "dense"}
+
+
+def test_hybrid_search_fuses_and_cuts_to_k():
+    store = FakeVectorStore(docs("dense only", "shared CWE-918 chunk"))
+    bm25 = BM25Index.from_documents(docs("shared CWE-918 chunk", "sparse only CWE-918"))
+
+    results = hybrid_search("cwe-918", store, bm25, k=2, fetch_k=5)
+    assert [d.page_content for d in results] == ["shared CWE-918 chunk", "dense only"]
+    assert store.calls == [("query", "cwe-918", 5)]
+
+
+def test_hybrid_search_reuses_a_precomputed_vector():
+    store = FakeVectorStore(docs("a"))
+    hybrid_search("q", store, BM25Index.from_documents(docs("b")), vector=[0.1, 0.2])
+    assert store.calls == [("vector", [0.1, 0.2], 20)]
+
+
+def test_hybrid_search_reranks_the_fused_head():
+    class Reranker:
+        def predict(self, pairs):
+            # Prefers shorter passages.
+            return [-len(text) for _, text in pairs]
+
+    store = FakeVectorStore(docs("a rather long passage", "mid passage"))
+    bm25 = BM25Index.from_documents(docs("short"))
+    results = hybrid_search("passage short", store, bm25, k=2, reranker=Reranker(), rerank_n=3)
+    assert [d.page_content for d in results] == ["short", "mid passage"]
@@ -0,0 +1,144 @@
+import json
+import uuid
+
+import pytest
+from langchain_community.vectorstores import Chroma
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+import ingest_mitre
+
+
+class FakeEmbeddings(Embeddings):
+    def embed_documents(self, texts):
+        return [[float(len(t)), 1.0, 0.5] for t in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def technique(stix_id, mitre_id, domain):
+    return {
+        "type": "attack-pattern", "id": stix_id, "name": f"Technique {mitre_id}",
+        "description": f"About {mitre_id}", "x_mitre_domains": [domain],
+        "external_references": [{"source_name": "mitre-attack", "external_id": mitre_id}],
+        "kill_chain_phases": [{"kill_chain_name": "mitre-attack", "phase_name": "credential-access"}],
+    }
+
+
+def write_bundle(path, objects):
+    path.write_text(json.dumps({"type": "bundle", "objects": objects}), encoding="utf-8")
+    return str(path)
+
+
+@pytest.fixture
+def collection(tmp_path, monkeypatch):
+    chroma_path = str(tmp_path / "chroma")
+    monkeypatch.setattr(ingest_mitre, "CHROMA_PATH", chroma_path)
+    monkeypatch.setattr(ingest_mitre, "GRAPH_PATH", str(tmp_path / "graph.json"))
+    monkeypatch.setattr(ingest_mitre, "MMAP_PATH", str(tmp_path / "mmap"))
+    monkeypatch.setattr(ingest_mitre, "VECTOR_BACKEND", "chroma")
+    monkeypatch.setattr(ingest_mitre, "get_embeddings", lambda model: FakeEmbeddings())
+    return Chroma(persist_directory=chroma_path, embedding_function=FakeEmbeddings(),
+                  collection_name=ingest_mitre.COLLECTION_NAME)
+
+
+@pytest.fixture
+def enterprise(tmp_path):
+    return write_bundle(tmp_path / "enterprise-attack.json", [
+        technique("attack-pattern--1", "T1056", "enterprise-attack"),
+        technique("attack-pattern--2", "T1056.001", "enterprise-attack"),
+    ])
+
+
+@pytest.fixture
+def mobile(tmp_path):
+    return write_bundle(tmp_path / "mobile-attack.json", [
+        technique("attack-pattern--m1", "T1417", "mobile-attack"),
+    ])
+
+
+def ids(store):
+    return set(store.get(include=[])["ids"])
+
+
+# --- in_scope ---
+
+def test_in_scope_follows_the_recorded_bundle():
+    assert ingest_mitre.in_scope("attack-pattern--1", "mobile-attack.json", "mobile-attack",
+                                 {"mobile-attack.json"}, {"mobile-attack"})
+    assert not ingest_mitre.in_scope("attack-pattern--1", "enterprise-attack.json", "enterprise-attack",
+                                     {"mobile-attack.json"}, {"mobile-attack"})
+
+
+def test_in_scope_falls_back_to_the_domain():
+    assert ingest_mitre.in_scope("attack-pattern--1", None, "ics-attack", {"ics.json"}, {"ics-attack"})
+    assert not ingest_mitre.in_scope("attack-pattern--1", None, "ics-attack", {"x.json"}, {"mobile-attack"})
+
+
+def test_baseline_documents_belong_to_the_enterprise_bundle():
+    legacy_id = str(uuid.uuid4())
+    assert ingest_mitre.in_scope(legacy_id, None, None, {"enterprise-attack.json"}, {"enterprise-attack"})
+    assert not ingest_mitre.in_scope(legacy_id, None, None, {"mobile-attack.json"}, {"mobile-attack"})
+    # A random-UUID id is legacy even if some metadata was recorded.
+    assert ingest_mitre.in_scope(legacy_id, None, "enterprise-attack", {"e.json"}, {"enterprise-attack"})
+
+
+# --- iter_upserts ---
+
+def hashed(content_hash):
+    return Document(page_content="text", metadata={"content_hash": content_hash})
+
+
+def test_iter_upserts_yields_only_new_and_changed_documents():
+    diff = {"added": [], "changed": [], "unchanged": 0, "deleted": [], "seen": set()}
+    documents = [("a", hashed("h1")), ("b", hashed("h2-new")), ("c", hashed("h3")), ("a", hashed("h1"))]
+
+    upserts = list(ingest_mitre.iter_upserts(documents, {"a": "h1", "b": "h2"}, diff))
+    assert [doc_id for doc_id, _ in upserts] == ["b", "c"]
+    assert (diff["added"], diff["changed"], diff["unchanged"]) == (["c"], ["b"], 1)
+    # The repeated "a" (the same object in two bundles) is counted once.
+    assert diff["seen"] == {"a", "b", "c"}
+
+
+# --- existing_metadata ---
+
+def test_existing_metadata_pages_and_keeps_only_the_diff_fields(collection):
+    metas = [{"content_hash": f"h{i}", "bundle": "b.json", "domain": "d", "detection_blob": "x" * 100} for i in range(5)]
+    collection.add_texts([f"doc {i}" for i in range(5)], metadatas=metas, ids=[f"attack-pattern--{i}" for i in range(5)])
+
+    existing = ingest_mitre.existing_metadata(collection, page=2)
+    assert existing == {f"attack-pattern--{i}": (f"h{i}", "b.json", "d") for i in range(5)}
+
+
+# --- Incremental runs ---
+
+def test_first_run_after_baseline_removes_legacy_duplicates(collection, enterprise):
+    legacy = [str(uuid.uuid4()) for _ in range(2)]
+    collection.add_texts(
+        ["ID: T1056", "ID: T1056.001"],
+        metadatas=[{"mitre_id": "T1056", "type": "attack-pattern", "detection_blob": "d"},
+                   {"mitre_id": "T1056.001", "type": "attack-pattern", "detection_blob": "d"}],
+        ids=legacy,
+    )
+
+    ingest_mitre.main([enterprise])
+    assert ids(collection) == {"attack-pattern--1", "attack-pattern--2"}
+
+
+def test_partial_run_leaves_other_bundles_alone(collection, enterprise, mobile, tmp_path):
+    legacy = str(uuid.uuid4())
+    collection.add_texts(["ID: T1056"], metadatas=[{"mitre_id": "T1056"}], ids=[legacy])
+    ingest_mitre.main([enterprise, mobile])
+
+    # The mobile bundle drops its only technique and gains another one.
+    smaller = write_bundle(tmp_path / "mobile-attack.json", [technique("attack-pattern--m2", "T1418", "mobile-attack")])
+    ingest_mitre.main([smaller])
+    assert ids(collection) == {"attack-pattern--1", "attack-pattern--2", "attack-pattern--m2"}
+
+
+def test_rerun_without_changes_writes_nothing(collection, enterprise, capsys):
+    ingest_mitre.main([enterprise])
+    capsys.readouterr()
+    ingest_mitre.main([enterprise])
+    assert "already up to date" in capsys.readouterr().out
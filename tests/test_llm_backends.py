@@ -0,0 +1,154 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from llm_backends import BackendError, CircuitBreaker, LLMPool, StubBackend
+
+
+class ScriptedBackend(StubBackend):
+    # Raises for the first `failures` calls, then answers with `text`.
+    def __init__(self, name, text="answer", failures=0, tokens=None):
+        super().__init__()
+        self.name = name
+        self.text = text
+        self.failures = failures
+        self.tokens = tokens
+        self.supports_stream = tokens is not None
+        self.calls = 0
+
+    def generate(self, prompt, timeout):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise ConnectionError(f"{self.name} is down")
+        return self.text
+
+    def stream(self, prompt, timeout):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise ConnectionError(f"{self.name} is down")
+        yield from self.tokens
+
+
+def pool(*backends, **options):
+    options = {"retries": 0, "backoff": 0.0, "hedge": False, "deadline": 5.0, **options}
+    return LLMPool(backends=list(backends), **options)
+
+
+# --- Failover and retries ---
+
+def test_stub_backend_answers_the_last_line():
+    assert pool(StubBackend()).invoke("Context: ...\nWhat is XSS?") == "Stub answer for: What is XSS?"
+
+
+def test_fails_over_to_the_next_backend():
+    primary, fallback = ScriptedBackend("primary", failures=99), ScriptedBackend("fallback", "from fallback")
+    assert pool(primary, fallback).invoke("q") == "from fallback"
+    assert primary.breaker.failures == 1
+
+
+def test_retries_before_failing_over():
+    primary, fallback = ScriptedBackend("primary", "from primary", failures=1), ScriptedBackend("fallback")
+    assert pool(primary, fallback, retries=1).invoke("q") == "from primary"
+    assert (primary.calls, fallback.calls) == (2, 0)
+    assert primary.breaker.failures == 0
+
+
+def test_every_backend_failing_raises():
+    with pytest.raises(BackendError, match="every backend"):
+        pool(ScriptedBackend("a", failures=99), ScriptedBackend("b", failures=99)).invoke("q")
+
+
+def test_slow_attempt_is_hedged():
+    class SlowFirst(ScriptedBackend):
+        def generate(self, prompt, timeout):
+            if self.calls == 0:
+                self.calls += 1
+                time.sleep(1.0)
+                return "slow"
+            return super().generate(prompt, timeout)
+
+    backend = SlowFirst("b", "hedged")
+    started = time.monotonic()
+    assert pool(backend, hedge=True, hedge_floor=0.05).invoke("q") == "hedged"
+    assert time.monotonic() - started < 0.8
+    assert backend.calls == 2
+
+
+# --- Circuit breaker ---
+
+def test_open_circuit_is_skipped_until_the_cooldown():
+    primary, fallback = ScriptedBackend("primary", failures=2), ScriptedBackend("fallback", "from fallback")
+    primary.breaker = CircuitBreaker(threshold=2, cooldown=60.0)
+    llm = pool(primary, fallback)
+
+    assert [llm.invoke("q") for _ in range(3)] == ["from fallback"] * 3
+    assert primary.calls == 2
+    assert primary.breaker.state == "open"
+
+    # Half-open after the cooldown: one trial call, which closes it again.
+    primary.breaker.cooldown = 0.0
+    assert llm.invoke("q") == "answer"
+    assert primary.breaker.state == "closed"
+
+
+def test_all_circuits_open_raises():
+    backend = ScriptedBackend("only", failures=99)
+    backend.breaker = CircuitBreaker(threshold=1, cooldown=60.0)
+    llm = pool(backend)
+    with pytest.raises(BackendError):
+        llm.invoke("q")
+    with pytest.raises(BackendError, match="circuits open"):
+        llm.invoke("q")
+
+
+# --- Stop sequences ---
+
+def test_generate_is_cut_at_the_earliest_stop_sequence():
+    llm = pool(ScriptedBackend("b", "The answer.\nQuestion: next\nObservation: more"))
+    assert llm.invoke("q", stop=["\nObservation", "\nQuestion"]) == "The answer."
+    assert llm.invoke("q") == "The answer.\nQuestion: next\nObservation: more"
+
+
+def test_stream_holds_back_a_stop_sequence_split_across_tokens():
+    backend = ScriptedBackend("b", tokens=["The ans", "wer.\nQues", "tion: never sent"])
+    chunks = list(pool(backend).stream("q", stop=["\nQuestion"]))
+    assert "".join(chunks) == "The answer."
+    assert all("\n" not in chunk for chunk in chunks)
+
+
+def test_stream_flushes_the_held_back_tail():
+    backend = ScriptedBackend("b", tokens=["The answer", " ends here\n"])
+    assert "".join(pool(backend).stream("q", stop=["\nQuestion"])) == "The answer ends here\n"
+
+
+def test_stream_falls_back_to_a_full_answer():
+    streaming = ScriptedBackend("streaming", failures=99, tokens=[])
+    plain = ScriptedBackend("plain", "whole answer")
+    assert list(pool(streaming, plain).stream("q")) == ["whole answer"]
+
+
+# --- Async ---
+
+def test_async_calls_run_on_the_io_pool():
+    callers = []
+
+    class RecordingPool(LLMPool):
+        def _call_backends(self, prompt, attrs):
+            callers.append(threading.current_thread().name)
+            return super()._call_backends(prompt, attrs)
+
+    llm = RecordingPool(backends=[ScriptedBackend("b", "async answer")], hedge=False)
+    assert asyncio.run(llm.ainvoke("q")) == "async answer"
+    # Not the loop's default executor, which is the bounded CPU pool.
+    assert callers[0].startswith("llm-io")
+
+
+def test_astream_yields_the_same_chunks():
+    backend = ScriptedBackend("b", tokens=["one ", "two ", "three"])
+
+    async def collect():
+        return [chunk async for chunk in pool(backend).astream("q")]
+
+    assert "".join(asyncio.run(collect())) == "one two three"